@@ -12,17 +12,29 @@ the Free Software Foundation; either version 2 of the License, or
 Find more information about this on the LICENSE file.
 """
 
-import jsonbak
-import requestsbak
+import codec
 import csv
+import zlib
+import cherrypy
 from io import StringIO
 import splunk.appserver.mrsparkle.controllers as controllers
 from splunk.appserver.mrsparkle.lib.decorators import expose_page
 from db import database
 from log import log
 from splunk.clilib import cli_common as cli
-from requirements import pci_requirements,gdpr_requirements,hipaa_requirements,nist_requirements
-import time
+from app_config import get_stanza
+from compliance import get_compliance_service
+from response_cache import get_cache
+from daemons_state import get_daemons_state, is_restart_endpoint
+from credentials_cache import get_credentials_cache
+from fan_out import fan_out, fetch_pages
+from retry_policy import get_breaker, get_retry_policy, breakers_status
+from requestsbak.exceptions import ConnectionError, Timeout
+from http_pool import get_session
+from single_flight import get_single_flight
+from admission import admit, buckets_status, BusyError, INTERACTIVE, BACKGROUND
+from raw_json import RawResponse, needs_redaction
+from item_stream import ItemStream, CHUNK_SIZE
 
 class api(controllers.BaseController):
     
@@ -39,28 +51,22 @@ class api(controllers.BaseController):
             self.timeout = int(self.config['timeout'])
             self.db = database()
             controllers.BaseController.__init__(self)
-            self.session = requestsbak.Session()
-            self.session.trust_env = False
+            self.session = get_session()
+            self.cache = get_cache()
+            self.daemons_state = get_daemons_state()
+            self.credentials = get_credentials_cache()
+            self.compliance_service = get_compliance_service()
+            self.single_flight = get_single_flight()
         except Exception as e:
             self.logger.error("api: Error in API module constructor: %s" % (e))
 
     def get_credentials(self, the_id):
         try:
             self.logger.debug("api: Getting API credentials.")
-            api = self.db.get(the_id)
-            api = jsonbak.loads(api)
-            if api:
-                opt_username = api['data']["userapi"]
-                opt_password = api['data']["passapi"]
-                opt_base_url = api['data']["url"]
-                opt_base_port = api['data']["portapi"]
-                url = str(opt_base_url) + ":" + str(opt_base_port)
-                auth = requestsbak.auth.HTTPBasicAuth(opt_username, opt_password)
-                verify = False
-                cluster_enabled = True if api['data']['filterType'] == "cluster.name" else False
-                return url, auth, verify, cluster_enabled
-            else:
-                raise Exception('API not found')
+            api, url, auth = self.credentials.get(the_id)
+            verify = False
+            cluster_enabled = True if api['filterType'] == "cluster.name" else False
+            return url, auth, verify, cluster_enabled
         except Exception as e:
             raise e
 
@@ -69,7 +75,7 @@ class api(controllers.BaseController):
         """
         try:
             apikeyconf = cli.getConfStanza('config', 'configuration')
-            # parsed_data = jsonbak.dumps(apikeyconf)
+            # parsed_data = codec.dumps(apikeyconf)
         except Exception as e:
             raise e
         return apikeyconf
@@ -116,37 +122,29 @@ class api(controllers.BaseController):
             self.logger.error("api: Error while cleaning keys in request response: %s" % (e))
             raise e
 
-    def format_output(self, arr):
-        """Format the data for the CSV file generation.
+    def format_row(self, keys, item):
+        """Format an item as a CSV row.
 
         Parameters
         ----------
-        arr : list
-            A list of dicts
+        keys : list
+            The CSV columns
+        item : dict
+            The item returned by the API
         """
-        try:
-            self.logger.debug("api: Formatting data to generate CSV file.")
-            if isinstance(arr, list):
-                for item in arr:
-                    if isinstance(item, dict):
-                        for key, value in item.items():
-                            if isinstance(value, dict):
-                                item[key] = jsonbak.dumps(value)
-                            elif isinstance(value, list):
-                                i = 0
-                                while i < len(value):
-                                    value[i] = str(value[i])
-                                    i += 1
-                            else:
-                                item[key] = str(value)
-                    elif isinstance(item, list):
-                        for each in item:
-                            each = str(each)
-                    else:
-                        item = str(item)
-            return arr
-        except Exception as e:
-            raise e
+        row = []
+        for key in keys:
+            if key not in item:
+                row.append('')
+                continue
+            value = item[key]
+            if isinstance(value, dict):
+                row.append(codec.dumps_compatible(value))
+            elif isinstance(value, list):
+                row.append(str([str(each) for each in value]))
+            else:
+                row.append(str(value))
+        return tuple(row)
 
     def format_cdb_list_content(self, dic):
         """Format the response of custom CDB list.
@@ -166,52 +164,128 @@ class api(controllers.BaseController):
             raise e
 
 
-    def make_request(self, method, url, opt_endpoint, kwargs, auth, verify, counter = 3):
+    def relay_body(self, body):
+        """Wrap an upstream body, decoding it only when some key must be hidden.
+
+        Parameters
+        ----------
+        body : bytes
+            The Wazuh API response body
+        """
+        response = RawResponse(body)
+        # A body cut short still starts with the error code, decoding it raises
+        if response.error is None or needs_redaction(body) or not body.rstrip().endswith(b'}'):
+            data = self.clean_keys(response.json())
+            response = RawResponse(codec.dumps(data).encode('utf-8'), data)
+        return response
+
+    def send_request(self, method, url, opt_endpoint, kwargs, auth, verify, timeout):
+        """Send a single request to the Wazuh API and return the response."""
+        if method == 'GET':
+            return self.session.get(
+                url + opt_endpoint, params=kwargs, auth=auth,
+                timeout=timeout, verify=verify)
+        if method == 'POST':
+            if 'origin' in kwargs:
+                if kwargs['origin'] == 'xmleditor':
+                    headers = {'Content-Type': 'application/xml'} 
+                elif kwargs['origin'] == 'json':
+                    headers = {'Content-Type':  'application/json'} 
+                elif kwargs['origin'] == 'raw':
+                    headers = {'Content-Type':  'application/octet-stream'} 
+                data = str(kwargs['content'])
+                return self.session.post(url + opt_endpoint, data=data, auth=auth, timeout=timeout, verify=verify, headers=headers)
+            return self.session.post(
+                url + opt_endpoint, data=kwargs, auth=auth,
+                timeout=timeout, verify=verify)
+        if method == 'PUT':
+            return self.session.put(
+                url + opt_endpoint, data=kwargs, auth=auth,
+                timeout=timeout, verify=verify)
+        if method == 'DELETE':
+            return self.session.delete(
+                url + opt_endpoint, data=kwargs, auth=auth,
+                timeout=timeout, verify=verify)
+        raise Exception("Unsupported method %s." % method)
+
+    def make_request(self, method, url, opt_endpoint, kwargs, auth, verify, api_id = None, priority = INTERACTIVE):
+        """Request the Wazuh API and return the parsed response."""
+        return self.proxy_request(method, url, opt_endpoint, kwargs, auth, verify, api_id, priority).json()
+
+    def proxy_request(self, method, url, opt_endpoint, kwargs, auth, verify, api_id = None, priority = INTERACTIVE):
+        """Request the Wazuh API and return the response as a RawResponse, ready to be relayed."""
         try:
-            socket_errors = (1013, 1014, 1017, 1018, 1019)
+            cache_id = api_id if api_id else url
             if method == 'GET':
-                request = self.session.get(
-                    url + opt_endpoint, params=kwargs, auth=auth,
-                    verify=verify).json()
-            if method == 'POST':
-                if 'origin' in kwargs:
-                    if kwargs['origin'] == 'xmleditor':
-                        headers = {'Content-Type': 'application/xml'} 
-                    elif kwargs['origin'] == 'json':
-                        headers = {'Content-Type':  'application/json'} 
-                    elif kwargs['origin'] == 'raw':
-                        headers = {'Content-Type':  'application/octet-stream'} 
-                    kwargs = str(kwargs['content'])
-                    request = self.session.post(url + opt_endpoint, data=kwargs, auth=auth,verify=verify, headers=headers).json()
-                else:
-                    request = self.session.post(
-                        url + opt_endpoint, data=kwargs, auth=auth,
-                        verify=verify).json()
-            if method == 'PUT':
-                request = self.session.put(
-                    url + opt_endpoint, data=kwargs, auth=auth,
-                    verify=verify).json()
-            if method == 'DELETE':
-                request = self.session.delete(
-                    url + opt_endpoint, data=kwargs, auth=auth,
-                    verify=verify).json()
-            self.logger.debug("api: %s: %s%s - %s" % (method, url, opt_endpoint, kwargs))                    
-            if request['error'] and request['error'] in socket_errors:
-                self.logger.debug("api: Trying the previous request again.")                    
-                if counter > 0:
-                    time.sleep(0.5)
-                    return self.make_request(method, url, opt_endpoint, kwargs, auth, verify, counter - 1)
-                else:                    
-                    raise Exception("Tried to execute %s %s three times with no success, aborted." % (method, opt_endpoint))
-            return self.clean_keys(request)
+                cached = self.cache.get(cache_id, opt_endpoint, kwargs)
+                if cached is not None:
+                    self.logger.debug("api: %s: %s%s - %s (cached)" % (method, url, opt_endpoint, kwargs))
+                    return cached
+                # Identical GETs in flight share a single upstream call
+                key = (cache_id, opt_endpoint, self.cache.normalize_params(kwargs))
+                return self.single_flight.do(
+                    key, lambda: self.upstream_request(method, url, opt_endpoint, kwargs, auth, verify, cache_id, priority))
+            # Any write may change what the cached GETs of this API return
+            self.cache.invalidate(cache_id)
+            self.compliance_service.invalidate(cache_id)
+            return self.upstream_request(method, url, opt_endpoint, kwargs, auth, verify, cache_id, priority)
+        except BusyError as e:
+            self.logger.debug("api: Request not admitted: %s" % (e))
+            raise e
         except Exception as e:
             self.logger.error("api: Error while requesting to Wazuh API: %s" % (e))
+            self.daemons_state.mark_stale(url)
             raise e
 
+    def upstream_request(self, method, url, opt_endpoint, kwargs, auth, verify, cache_id, priority):
+        """Send a request to the Wazuh API applying admission control, the retry policy and the circuit breaker."""
+        socket_errors = (1013, 1014, 1017, 1018, 1019)
+        admit(url, priority)
+        breaker = get_breaker(url)
+        policy = get_retry_policy()
+        deadline = policy.start()
+        attempt = 0
+        while True:
+            breaker.before_request()
+            attempt += 1
+            timeout = min(self.timeout, policy.remaining(deadline))
+            try:
+                response = self.send_request(method, url, opt_endpoint, kwargs, auth, verify, timeout)
+                request = self.relay_body(response.content)
+            except (ConnectionError, Timeout) as e:
+                breaker.record_failure()
+                # Writes may have reached the API, so only reads are sent again
+                if method == 'GET' and policy.backoff(attempt, deadline):
+                    self.logger.debug("api: Trying the previous request again: %s" % (e))
+                    continue
+                raise e
+            except Exception:
+                # Bodies that aren't JSON, e.g. an HTML 502 from a proxy. This also releases the probe.
+                breaker.record_failure()
+                raise
+            self.logger.debug("api: %s: %s%s - %s" % (method, url, opt_endpoint, kwargs))                    
+            if request.error and request.error in socket_errors:
+                # Counted before retrying so a half-open probe slot is released
+                breaker.record_failure()
+                if method == 'GET' and policy.backoff(attempt, deadline):
+                    self.logger.debug("api: Trying the previous request again.")                    
+                    continue
+                raise Exception("Tried to execute %s %s %s times with no success, aborted." % (method, opt_endpoint, attempt))
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            break
+        if method == 'GET' and request.error == 0:
+            self.cache.set(cache_id, opt_endpoint, kwargs, request)
+        if method == 'PUT' and is_restart_endpoint(opt_endpoint):
+            self.daemons_state.mark_stale(url)
+        return request
+
     def exec_request(self, kwargs):
         try:
             if 'id' not in kwargs or 'endpoint' not in kwargs:
-                return jsonbak.dumps({'error': 'Missing ID or endpoint.'})
+                return codec.dumps({'error': 'Missing ID or endpoint.'})
             if 'method' not in kwargs:
                 method = 'GET'
             elif kwargs['method'] == 'GET':
@@ -220,7 +294,7 @@ class api(controllers.BaseController):
             else:
                 if str(self.getSelfAdminStanza()['admin']) != 'true':
                     self.logger.error('Admin mode is disabled.')
-                    return jsonbak.dumps({'error': 'Forbidden. Enable admin mode.'})
+                    return codec.dumps({'error': 'Forbidden. Enable admin mode.'})
                 method = kwargs['method']
                 del kwargs['method']
             the_id = kwargs['id']
@@ -230,16 +304,21 @@ class api(controllers.BaseController):
             del kwargs['endpoint']
             daemons_ready = self.check_daemons(url, auth, verify, cluster_enabled)
             if not daemons_ready:
-                return jsonbak.dumps({"status": "200", "error": 3099, "message": "Wazuh not ready yet."})
-            request = self.make_request(method, url, opt_endpoint, kwargs, auth, verify)
-            result = jsonbak.dumps(request)
+                return codec.dumps({"status": "200", "error": 3099, "message": "Wazuh not ready yet."})
+            request = self.make_request(method, url, opt_endpoint, kwargs, auth, verify, api_id=the_id, priority=BACKGROUND)
+            result = codec.dumps(request)
+        except BusyError as e:
+            return self.busy_response(e)
         except Exception as e:
             self.logger.error("Error making API request: %s" % (e))
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return result
 
     def check_daemons(self, url, auth, verify, check_cluster):
-        """ Request to check the status of this daemons: execd, modulesd, wazuhdb and clusterd
+        """ Check the status of this daemons: execd, modulesd, wazuhdb and clusterd
+
+        The readiness is shared by every controller and refreshed in background,
+        so the daemons are only probed when the known state is stale.
 
         Parameters
         ----------
@@ -250,28 +329,13 @@ class api(controllers.BaseController):
         """
         try:
             self.logger.debug("api: Checking Wazuh daemons.")
-            request_cluster = self.session.get(
-                url + '/cluster/status', auth=auth, timeout=self.timeout, verify=verify).json()
-            # Try to get cluster is enabled if the request fail set to false
-            try:
-                cluster_enabled = request_cluster['data']['enabled'] == 'yes'
-            except Exception as e:
-                cluster_enabled = False
-            cc = check_cluster and cluster_enabled # Var to check the cluster demon or not
-            opt_endpoint = "/manager/status"
-            daemons_status = self.session.get(
-                    url + opt_endpoint, auth=auth,
-                    verify=verify).json()
-            if not daemons_status['error']:
-                d = daemons_status['data']
-                daemons = {"execd": d['ossec-execd'], "modulesd": d['wazuh-modulesd'], "db": d['wazuh-db']}
-                if cc:
-                    daemons['clusterd'] = d['wazuh-clusterd']
-                values = list(daemons.values())
-                wazuh_ready = len(set(values)) == 1 and values[0] == "running" # Checks all the status are equals, and running
-                checked_debug_msg = "Wazuh daemons ready" if wazuh_ready else "Wazuh daemons not ready yet"
-                self.logger.debug("api: %s" % checked_debug_msg)
-                return wazuh_ready
+            # Fail fast instead of probing an API known to be down
+            get_breaker(url).check_open()
+            wazuh_ready = self.daemons_state.is_ready(
+                self.session, url, auth, verify, check_cluster, self.timeout)
+            checked_debug_msg = "Wazuh daemons ready" if wazuh_ready else "Wazuh daemons not ready yet"
+            self.logger.debug("api: %s" % checked_debug_msg)
+            return wazuh_ready
         except Exception as e:
             self.logger.error("api: Error checking daemons: %s" % (e))
             raise e
@@ -289,16 +353,16 @@ class api(controllers.BaseController):
         try:
             self.logger.debug("api: Checking if Wazuh is ready.")
             if 'apiId' not in kwargs:
-                return jsonbak.dumps({'error': 'Missing API ID.'})
+                return codec.dumps({'error': 'Missing API ID.'})
             the_id = kwargs['apiId']
             url, auth, verify, cluster_enabled = self.get_credentials(the_id)
             daemons_ready = self.check_daemons(url, auth, verify, cluster_enabled)
             msg = "Wazuh is now ready." if daemons_ready else "Wazuh not ready yet."
             self.logger.debug("api: %s" % msg)
-            return jsonbak.dumps({"status": "200", "ready": daemons_ready, "message": msg})
+            return codec.dumps({"status": "200", "ready": daemons_ready, "message": msg})
         except Exception as e:
             self.logger.error("api: Error checking daemons: %s" % (e))
-            return jsonbak.dumps({"status": "200", "ready": False, "message": "Error getting the Wazuh daemons status."})
+            return codec.dumps({"status": "200", "ready": False, "message": "Error getting the Wazuh daemons status."})
 
     @expose_page(must_login=False, methods=['POST'])
     def request(self, **kwargs):
@@ -312,7 +376,7 @@ class api(controllers.BaseController):
         try:
             self.logger.debug("api: Preparing request.")
             if 'apiId' not in kwargs or 'endpoint' not in kwargs:
-                return jsonbak.dumps({'error': 'Missing ID or endpoint.'})
+                return codec.dumps({'error': 'Missing ID or endpoint.'})
             if 'method' not in kwargs:
                 method = 'GET'
             elif kwargs['method'] == 'GET':
@@ -321,7 +385,7 @@ class api(controllers.BaseController):
             else:
                 if str(self.getSelfAdminStanza()['admin']) != 'true':
                     self.logger.error('api: Admin mode is disabled.')
-                    return jsonbak.dumps({'error': 'Forbidden. Enable admin mode.'})
+                    return codec.dumps({'error': 'Forbidden. Enable admin mode.'})
                 method = kwargs['method']
                 del kwargs['method']
             the_id = kwargs['apiId']
@@ -331,22 +395,144 @@ class api(controllers.BaseController):
             del kwargs['endpoint']
             daemons_ready = self.check_daemons(url, auth, verify, cluster_enabled)
             if not daemons_ready:
-                return jsonbak.dumps({"status": "200", "error": 3099, "message": "Wazuh not ready yet."})
-            request = self.make_request(method, url, opt_endpoint, kwargs, auth, verify)
-            result = jsonbak.dumps(request)
+                return codec.dumps({"status": "200", "error": 3099, "message": "Wazuh not ready yet."})
+            # The upstream bytes are relayed as they are unless some key had to be hidden
+            result = self.proxy_request(method, url, opt_endpoint, kwargs, auth, verify, api_id=the_id).body
+        except BusyError as e:
+            return self.busy_response(e)
         except Exception as e:
             self.logger.error("api: Error making API request: %s" % (e))
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return result
 
+    def busy_response(self, error):
+        """Answer a request that was not admitted because the Wazuh API is busy.
+
+        Parameters
+        ----------
+        error : BusyError
+            The admission error
+        """
+        self.logger.info("api: %s" % (error))
+        cherrypy.response.headers['Retry-After'] = str(error.retry_after)
+        return codec.dumps({"status": "429", "error": 3098, "message": str(error), "retry_after": error.retry_after})
+
+    @expose_page(must_login=False, methods=['POST'])
+    def batch(self, **kwargs):
+        """Make several requests to the same Wazuh API in a single call.
+
+        Parameters
+        ----------
+        kwargs : dict
+            Request parameters. `requests` is a JSON list of objects with
+            `id`, `endpoint`, `method` and `params`. `parallelism` optionally
+            lowers the number of requests executed at the same time.
+        """
+        try:
+            self.logger.debug("api: Preparing batch request.")
+            if 'apiId' not in kwargs or 'requests' not in kwargs:
+                return codec.dumps({'error': 'Missing ID or requests.'})
+            items = codec.loads(kwargs['requests'])
+            if not isinstance(items, list):
+                return codec.dumps({'error': 'Requests must be a list.'})
+            request_ids = [str(item.get('id', index)) if isinstance(item, dict) else str(index)
+                           for index, item in enumerate(items)]
+            seen, duplicated = set(), set()
+            for request_id in request_ids:
+                if request_id in seen:
+                    duplicated.add(request_id)
+                seen.add(request_id)
+            if duplicated:
+                return codec.dumps({'error': 'Duplicated request ids: %s.' % ', '.join(sorted(duplicated))})
+            max_parallelism = self.get_batch_parallelism()
+            parallelism = min(int(kwargs.get('parallelism', max_parallelism)), max_parallelism)
+            the_id = kwargs['apiId']
+            url, auth, verify, cluster_enabled = self.get_credentials(the_id)
+            daemons_ready = self.check_daemons(url, auth, verify, cluster_enabled)
+            if not daemons_ready:
+                return codec.dumps({"status": "200", "error": 3099, "message": "Wazuh not ready yet."})
+            admin_enabled = str(self.getSelfAdminStanza()['admin']) == 'true'
+            output = {}
+            tasks = {}
+
+            def task(method, endpoint, params):
+                return lambda: self.make_request(method, url, endpoint, params, auth, verify, api_id=the_id)
+
+            for request_id, item in zip(request_ids, items):
+                if not isinstance(item, dict):
+                    output[request_id] = {'status': 'error', 'error': 'Request must be an object.'}
+                    continue
+                if 'endpoint' not in item:
+                    output[request_id] = {'status': 'error', 'error': 'Missing endpoint.'}
+                    continue
+                method = item.get('method', 'GET')
+                if method != 'GET' and not admin_enabled:
+                    self.logger.error('api: Admin mode is disabled.')
+                    output[request_id] = {'status': 'error', 'error': 'Forbidden. Enable admin mode.'}
+                    continue
+                tasks[request_id] = task(method, item['endpoint'], item.get('params') or {})
+            results, errors = fan_out(tasks, max_workers=max(parallelism, 1))
+            for request_id, response in results.items():
+                output[request_id] = {'status': 'ok', 'data': response}
+            for request_id, error in errors.items():
+                output[request_id] = {'status': 'error', 'error': str(error)}
+                if isinstance(error, BusyError):
+                    output[request_id]['retry_after'] = error.retry_after
+            result = codec.dumps({'data': output, 'error': 0})
+        except Exception as e:
+            self.logger.error("api: Error making batch API request: %s" % (e))
+            return codec.dumps({'error': str(e)})
+        return result
+
+    def get_batch_parallelism(self):
+        """Get the maximum number of requests of a batch executed at the same time."""
+        try:
+            return int(get_stanza('batch', {'max_parallelism': 4})['max_parallelism'])
+        except Exception:
+            return 4
+
+    @expose_page(must_login=False, methods=['GET'])
+    def circuit_breakers(self, **kwargs):
+        """Return the circuit breaker and rate limit state of every Wazuh API in use.
+
+        Parameters
+        ----------
+        kwargs : dict
+            Request parameters
+        """
+        try:
+            self.logger.debug("api: Getting circuit breakers status.")
+            return codec.dumps({"data": breakers_status(), "rate_limit": buckets_status(), "error": 0})
+        except Exception as e:
+            self.logger.error("api: Error getting circuit breakers status: %s" % (e))
+            return codec.dumps({'error': str(e)})
+
+    @expose_page(must_login=False, methods=['GET'])
+    def cache_stats(self, **kwargs):
+        """Return the counters of the API response cache and request coalescing.
+
+        Parameters
+        ----------
+        kwargs : dict
+            Request parameters
+        """
+        try:
+            self.logger.debug("api: Getting response cache stats.")
+            stats = self.cache.stats()
+            stats['coalescing'] = self.single_flight.stats()
+            return codec.dumps({"data": stats, "error": 0})
+        except Exception as e:
+            self.logger.error("api: Error getting response cache stats: %s" % (e))
+            return codec.dumps({'error': str(e)})
+
     @expose_page(must_login=False, methods=['GET'])
     def autocomplete(self, **kwargs):
         """Provisional method for returning the full list of Wazuh API endpoints."""
         try:
             self.logger.debug("Returning autocomplet for devtools.")
-            parsed_json = jsonbak.dumps([{"method":'PUT',"endpoints":[{"name":'/active-response/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/group/:group_id',"args":[{"name":':agent_id'},{"name":':group_id'}]},{"name":'/agents/:agent_id/restart',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/upgrade',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/upgrade_custom',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_name',"args":[{"name":':agent_name'}]},{"name":'/agents/groups/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/restart',"args":[]},{"name":'/cluster/:node_id/restart',"args":[{"name":':node_id'}]},{"name":'/cluster/restart',"args":[]},{"name":'/manager/restart',"args":[]},{"name":'/rootcheck',"args":[]},{"name":'/rootcheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/syscheck',"args":[]},{"name":'/syscheck/:agent_id',"args":[{"name":':agent_id'}]}]},{"method":'DELETE',"endpoints":[{"name":'/agents',"args":[]},{"name":'/agents/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/group',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/group/:group_id',"args":[{"name":':agent_id'},{"name":':group_id'}]},{"name":'/agents/group/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/groups',"args":[]},{"name":'/agents/groups/:group_id',"args":[{"name":':group_id'}]},{"name":'/cache',"args":[]},{"name":'/cache',"args":[]},{"name":'/rootcheck',"args":[]},{"name":'/rootcheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/syscheck/:agent_id',"args":[{"name":':agent_id'}]}]},{"method":'GET',"endpoints":[{"name":'/agents',"args":[]},{"name":'/agents/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/config/:component/:configuration',"args":[{"name":':agent_id'},{"name":':component'},{"name":':configuration'}]},{"name":'/agents/:agent_id/group/is_sync',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/key',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/upgrade_result',"args":[{"name":':agent_id'}]},{"name":'/agents/groups',"args":[]},{"name":'/agents/groups/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/configuration',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/files',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/files/:filename',"args":[{"name":':group_id'},{"name":':filename'}]},{"name":'/agents/name/:agent_name',"args":[{"name":':agent_name'}]},{"name":'/agents/no_group',"args":[]},{"name":'/agents/outdated',"args":[]},{"name":'/agents/stats/distinct',"args":[]},{"name":'/agents/summary',"args":[]},{"name":'/agents/summary/os',"args":[]},{"name":'/cache',"args":[]},{"name":'/cache/config',"args":[]},{"name":'/ciscat/:agent_id/results',"args":[{"name":':agent_id'}]},{"name":'/cluster/:node_id/configuration',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/configuration/validation',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/files',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/info',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/logs',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/logs/summary',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/analysisd',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/hourly',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/remoted',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/weekly',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/status',"args":[{"name":':node_id'}]},{"name":'/cluster/config',"args":[]},{"name":'/cluster/configuration/validation',"args":[]},{"name":'/cluster/healthcheck',"args":[]},{"name":'/cluster/node',"args":[]},{"name":'/cluster/nodes',"args":[]},{"name":'/cluster/nodes/:node_name',"args":[{"name":':node_name'}]},{"name":'/cluster/status',"args":[]},{"name":'/manager/stats/remoted',"args":[]},{"name":'/sca/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/sca/:agent_id/checks/:id',"args":[{"name":':agent_id'},{"name":':id'}]},{"name":'/decoders',"args":[]},{"name":'/decoders/:decoder_name',"args":[{"name":':decoder_name'}]},{"name":'/decoders/files',"args":[]},{"name":'/decoders/parents',"args":[]},{"name":'/lists',"args":[]},{"name":'/lists/files',"args":[]},{"name":'/manager/configuration',"args":[]},{"name":'/manager/configuration/validation',"args":[]},{"name":'/manager/files',"args":[]},{"name":'/manager/info',"args":[]},{"name":'/manager/logs',"args":[]},{"name":'/manager/logs/summary',"args":[]},{"name":'/manager/stats',"args":[]},{"name":'/manager/stats/analysisd',"args":[]},{"name":'/manager/stats/hourly',"args":[]},{"name":'/manager/stats/remoted',"args":[]},{"name":'/manager/stats/weekly',"args":[]},{"name":'/manager/status',"args":[]},{"name":'/rootcheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/rootcheck/:agent_id/cis',"args":[{"name":':agent_id'}]},{"name":'/rootcheck/:agent_id/last_scan',"args":[{"name":':agent_id'}]},{"name":'/rootcheck/:agent_id/pci',"args":[{"name":':agent_id'}]},{"name":'/rules',"args":[]},{"name":'/rules/:rule_id',"args":[{"name":':rule_id'}]},{"name":'/rules/files',"args":[]},{"name":'/rules/gdpr',"args":[]},{"name":'/rules/nist-800-53',"args":[]},{"name":'/rules/hipaa',"args":[]},{"name":'/rules/groups',"args":[]},{"name":'/rules/pci',"args":[]},{"name":'/syscheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/syscheck/:agent_id/last_scan',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/hardware',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/netaddr',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/netiface',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/netproto',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/os',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/packages',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/ports',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/processes',"args":[{"name":':agent_id'}]}]},{"method":'POST',"endpoints":[{"name":'/agents',"args":[]},{"name":'/agents/group/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/configuration',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/files/:file_name',"args":[{"name":':group_id'},{"name":':file_name'}]},{"name":'/agents/insert',"args":[]},{"name":'/agents/restart',"args":[]},{"name":'/cluster/:node_id/files',"args":[{"name":':node_id'}]},{"name":'/manager/files',"args":[]}]}])
+            parsed_json = codec.dumps([{"method":'PUT',"endpoints":[{"name":'/active-response/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/group/:group_id',"args":[{"name":':agent_id'},{"name":':group_id'}]},{"name":'/agents/:agent_id/restart',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/upgrade',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/upgrade_custom',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_name',"args":[{"name":':agent_name'}]},{"name":'/agents/groups/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/restart',"args":[]},{"name":'/cluster/:node_id/restart',"args":[{"name":':node_id'}]},{"name":'/cluster/restart',"args":[]},{"name":'/manager/restart',"args":[]},{"name":'/rootcheck',"args":[]},{"name":'/rootcheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/syscheck',"args":[]},{"name":'/syscheck/:agent_id',"args":[{"name":':agent_id'}]}]},{"method":'DELETE',"endpoints":[{"name":'/agents',"args":[]},{"name":'/agents/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/group',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/group/:group_id',"args":[{"name":':agent_id'},{"name":':group_id'}]},{"name":'/agents/group/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/groups',"args":[]},{"name":'/agents/groups/:group_id',"args":[{"name":':group_id'}]},{"name":'/cache',"args":[]},{"name":'/cache',"args":[]},{"name":'/rootcheck',"args":[]},{"name":'/rootcheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/syscheck/:agent_id',"args":[{"name":':agent_id'}]}]},{"method":'GET',"endpoints":[{"name":'/agents',"args":[]},{"name":'/agents/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/config/:component/:configuration',"args":[{"name":':agent_id'},{"name":':component'},{"name":':configuration'}]},{"name":'/agents/:agent_id/group/is_sync',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/key',"args":[{"name":':agent_id'}]},{"name":'/agents/:agent_id/upgrade_result',"args":[{"name":':agent_id'}]},{"name":'/agents/groups',"args":[]},{"name":'/agents/groups/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/configuration',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/files',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/files/:filename',"args":[{"name":':group_id'},{"name":':filename'}]},{"name":'/agents/name/:agent_name',"args":[{"name":':agent_name'}]},{"name":'/agents/no_group',"args":[]},{"name":'/agents/outdated',"args":[]},{"name":'/agents/stats/distinct',"args":[]},{"name":'/agents/summary',"args":[]},{"name":'/agents/summary/os',"args":[]},{"name":'/cache',"args":[]},{"name":'/cache/config',"args":[]},{"name":'/ciscat/:agent_id/results',"args":[{"name":':agent_id'}]},{"name":'/cluster/:node_id/configuration',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/configuration/validation',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/files',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/info',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/logs',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/logs/summary',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/analysisd',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/hourly',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/remoted',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/stats/weekly',"args":[{"name":':node_id'}]},{"name":'/cluster/:node_id/status',"args":[{"name":':node_id'}]},{"name":'/cluster/config',"args":[]},{"name":'/cluster/configuration/validation',"args":[]},{"name":'/cluster/healthcheck',"args":[]},{"name":'/cluster/node',"args":[]},{"name":'/cluster/nodes',"args":[]},{"name":'/cluster/nodes/:node_name',"args":[{"name":':node_name'}]},{"name":'/cluster/status',"args":[]},{"name":'/manager/stats/remoted',"args":[]},{"name":'/sca/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/sca/:agent_id/checks/:id',"args":[{"name":':agent_id'},{"name":':id'}]},{"name":'/decoders',"args":[]},{"name":'/decoders/:decoder_name',"args":[{"name":':decoder_name'}]},{"name":'/decoders/files',"args":[]},{"name":'/decoders/parents',"args":[]},{"name":'/lists',"args":[]},{"name":'/lists/files',"args":[]},{"name":'/manager/configuration',"args":[]},{"name":'/manager/configuration/validation',"args":[]},{"name":'/manager/files',"args":[]},{"name":'/manager/info',"args":[]},{"name":'/manager/logs',"args":[]},{"name":'/manager/logs/summary',"args":[]},{"name":'/manager/stats',"args":[]},{"name":'/manager/stats/analysisd',"args":[]},{"name":'/manager/stats/hourly',"args":[]},{"name":'/manager/stats/remoted',"args":[]},{"name":'/manager/stats/weekly',"args":[]},{"name":'/manager/status',"args":[]},{"name":'/rootcheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/rootcheck/:agent_id/cis',"args":[{"name":':agent_id'}]},{"name":'/rootcheck/:agent_id/last_scan',"args":[{"name":':agent_id'}]},{"name":'/rootcheck/:agent_id/pci',"args":[{"name":':agent_id'}]},{"name":'/rules',"args":[]},{"name":'/rules/:rule_id',"args":[{"name":':rule_id'}]},{"name":'/rules/files',"args":[]},{"name":'/rules/gdpr',"args":[]},{"name":'/rules/nist-800-53',"args":[]},{"name":'/rules/hipaa',"args":[]},{"name":'/rules/groups',"args":[]},{"name":'/rules/pci',"args":[]},{"name":'/syscheck/:agent_id',"args":[{"name":':agent_id'}]},{"name":'/syscheck/:agent_id/last_scan',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/hardware',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/netaddr',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/netiface',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/netproto',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/os',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/packages',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/ports',"args":[{"name":':agent_id'}]},{"name":'/syscollector/:agent_id/processes',"args":[{"name":':agent_id'}]}]},{"method":'POST',"endpoints":[{"name":'/agents',"args":[]},{"name":'/agents/group/:group_id',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/configuration',"args":[{"name":':group_id'}]},{"name":'/agents/groups/:group_id/files/:file_name',"args":[{"name":':group_id'},{"name":':file_name'}]},{"name":'/agents/insert',"args":[]},{"name":'/agents/restart',"args":[]},{"name":'/cluster/:node_id/files',"args":[{"name":':node_id'}]},{"name":'/manager/files',"args":[]}]}])
         except Exception as e:
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return parsed_json
     
     # POST /api/csv : Generates a CSV file with the returned data from API
@@ -368,7 +554,7 @@ class api(controllers.BaseController):
             filters['offset'] = 0
 
             if 'filters' in kwargs and kwargs['filters'] != '':
-                parsed_filters = jsonbak.loads(kwargs['filters'])
+                parsed_filters = codec.loads(kwargs['filters'])
                 keys_to_delete = []
                 for key, value in parsed_filters.items():
                     if parsed_filters[key] == "":
@@ -379,222 +565,271 @@ class api(controllers.BaseController):
                 filters.update(parsed_filters)
 
             the_id = kwargs['id']
-            api = self.db.get(the_id)
-            api = jsonbak.loads(api)
-            opt_username = api["data"]["userapi"]
-            opt_password = api["data"]["passapi"]
-            opt_base_url = api["data"]["url"]
-            opt_base_port = api["data"]["portapi"]
+            url, auth, verify, cluster_enabled = self.get_credentials(the_id)
             opt_endpoint = kwargs['path']
-            url = str(opt_base_url) + ":" + str(opt_base_port)
-            auth = requestsbak.auth.HTTPBasicAuth(opt_username, opt_password)
-            verify = False
-            # init csv writer
-            output_file = StringIO()
+            compress = kwargs.get('compress') == 'gzip'
             # get total items and keys
-            request = self.session.get(
-                url + opt_endpoint, params=filters, auth=auth,
-                verify=verify).json()
+            admit(url, BACKGROUND)
+            if "?path=etc/list" in opt_endpoint:
+                request = self.session.get(
+                    url + opt_endpoint, params=filters, auth=auth,
+                    verify=verify).json()
+                if not ('items' in request['data'] and
+                        len(request['data']['items']) > 0):
+                    return '[]'
+                formatted = self.format_cdb_list_content(request)
+                final_obj = formatted["data"]["items"]
+                keys = list(final_obj[0].keys())
+                first_rows = [self.format_row(keys, item) for item in final_obj]
+                total_items = request["data"]["totalItems"]
+            else :
+                keys, first_rows, total_items = self.fetch_rows(
+                    url + opt_endpoint, filters, auth, verify)
             self.logger.debug("api: Data obtained for generate CSV file.")
-            if ('items' in request['data'] and
-                    len(request['data']['items']) > 0):
-                if "?path=etc/list" in opt_endpoint:
-                    formatted = self.format_cdb_list_content(request)
-                    final_obj = formatted["data"]["items"]
-                else :
-                    final_obj = request["data"]["items"]
-                if isinstance(final_obj, list):
-                    keys = final_obj[0].keys()
-                    self.format_output(keys)
-                    final_obj_dict = self.format_output(final_obj)
-                    total_items = request["data"]["totalItems"]
-                    # initializes CSV buffer
-                    if total_items > 0:
-                        dict_writer = csv.DictWriter(
-                          output_file,
-                          delimiter=',',
-                          fieldnames=keys,
-                          extrasaction='ignore',
-                          lineterminator='\n',
-                          quotechar='"')
-                        # write CSV header
-                        dict_writer.writeheader()
-                        dict_writer.writerows(final_obj_dict)
-
-                        offset = 0
-                        # get the rest of results
-                        while offset <= total_items:
-                            offset += filters['limit']
-                            filters['offset'] = offset
-                            req = self.session.get(
-                                url + opt_endpoint, params=filters, auth=auth,
-                                verify=verify).json()
-                            paginated_result = req['data']['items']
-                            format_paginated_results = self.format_output(
-                                paginated_result)
-                            dict_writer.writerows(format_paginated_results)
-
-                        csv_result = output_file.getvalue()
-                        self.logger.info("api: CSV generated successfully.")
-                else:
-                    csv_result = '[]'
+            if not first_rows or not total_items or total_items <= 0:
+                return '[]'
+            if compress:
+                cherrypy.response.headers['Content-Type'] = 'application/gzip'
+                cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="export.csv.gz"'
             else:
-                csv_result = '[]'
+                cherrypy.response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+            rows = self.csv_rows(url, opt_endpoint, filters, auth, verify, keys, first_rows, total_items)
+            return self.gzip_chunks(rows) if compress else rows
+        except BusyError as e:
+            return self.busy_response(e)
+        except Exception as e:
+            self.logger.error("api: Error in CSV generation!: %s" % (str(e)))
+            return codec.dumps({"error": str(e)})
+    # Send every chunk to the browser as soon as it is generated
+    csv._cp_config = {'response.stream': True}
+
+    def fetch_rows(self, url, params, auth, verify, keys=None, timeout=None):
+        """Request a page of items and format them as CSV rows while it's received.
+
+        Returns the columns, the rows and the number of items reported by
+        the API. Only the rows are kept, never the whole parsed page.
+
+        Parameters
+        ----------
+        url : str
+            The endpoint url
+        params : dict
+            The request's query parameters
+        auth : requestsbak.auth.HTTPBasicAuth
+            The API credentials
+        verify : bool
+            Whether to verify the API certificate
+        keys : list
+            The CSV columns, taken from the first item when missing
+        timeout : float
+            Timeout of the request
+        """
+        response = self.session.get(
+            url, params=params, auth=auth, timeout=timeout,
+            verify=verify, stream=True)
+        try:
+            stream = ItemStream(response.iter_content(CHUNK_SIZE))
+            rows = []
+            for item in stream:
+                if keys is None:
+                    keys = list(item.keys())
+                rows.append(self.format_row(keys, item))
+        finally:
+            response.close()
+        if stream.error:
+            raise Exception(stream.message or stream.error)
+        return keys, rows, stream.total_items
+
+    def csv_rows(self, url, opt_endpoint, filters, auth, verify, keys, first_rows, total_items):
+        """Yield the CSV content one page at a time.
+
+        Parameters
+        ----------
+        url : str
+            The API url
+        opt_endpoint : str
+            The Wazuh API endpoint
+        filters : dict
+            The request's query parameters
+        auth : requestsbak.auth.HTTPBasicAuth
+            The API credentials
+        verify : bool
+            Whether to verify the API certificate
+        keys : list
+            The CSV columns
+        first_rows : list
+            The rows of the already fetched first page
+        total_items : int
+            The number of items reported by the API
+        """
+        try:
+            output_file = StringIO()
+            csv_writer = csv.writer(
+              output_file,
+              delimiter=',',
+              lineterminator='\n',
+              quotechar='"')
+            # write CSV header
+            csv_writer.writerow(keys)
+            csv_writer.writerows(first_rows)
+            yield self.flush_buffer(output_file)
+
+            def fetch_page(offset):
+                params = dict(filters)
+                params['offset'] = offset
+                admit(url, BACKGROUND)
+                return self.fetch_rows(
+                    url + opt_endpoint, params, auth, verify,
+                    keys=keys, timeout=self.timeout)[1]
+
+            # get the rest of results, several windows at a time
+            offsets = range(filters['limit'], total_items, filters['limit'])
+            export_config = self.get_export_config()
+            pages = fetch_pages(
+                fetch_page, offsets,
+                max_in_flight=export_config['max_in_flight'],
+                retries=export_config['retries'])
+            for paginated_rows in pages:
+                csv_writer.writerows(paginated_rows)
+                yield self.flush_buffer(output_file)
             output_file.close()
-            self.logger.debug("api: CSV file generated.")
+            self.logger.info("api: CSV generated successfully.")
         except Exception as e:
+            # The response is already being sent: abort it, so the download
+            # fails instead of ending as a well-formed but truncated file
             self.logger.error("api: Error in CSV generation!: %s" % (str(e)))
-            return jsonbak.dumps({"error": str(e)})
-        return csv_result
+            raise
+
+    def get_export_config(self):
+        """Get the concurrency settings of the paginated exports."""
+        defaults = {'max_in_flight': 4, 'retries': 2}
+        stanza = get_stanza('export', defaults)
+        try:
+            return dict((key, int(stanza[key])) for key in defaults)
+        except ValueError as e:
+            self.logger.debug("api: Using the default export settings: %s" % (e))
+            return defaults
+
+    def flush_buffer(self, output_file):
+        """Return the buffer content as UTF-8 bytes and empty it.
+
+        Parameters
+        ----------
+        output_file : StringIO
+            The CSV buffer
+        """
+        content = output_file.getvalue()
+        output_file.seek(0)
+        output_file.truncate()
+        return content.encode('utf-8')
+
+    def gzip_chunks(self, chunks):
+        """Compress a stream of chunks in gzip format.
+
+        Parameters
+        ----------
+        chunks : iterable
+            The chunks to compress
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def compliance_requirements(self, framework, kwargs):
+        """Return the requirements of a compliance framework.
+
+        Parameters
+        ----------
+        framework : str
+            pci, gdpr, hipaa or nist
+        kwargs : dict
+            Request parameters
+        """
+        if not 'requirement' in kwargs:
+            raise Exception('Missing requirement.')
+        requirement = kwargs['requirement']
+        if requirement == 'all':
+            if not 'apiId' in kwargs:
+                return self.compliance_service.all_descriptions(framework)
+            the_id = kwargs['apiId']
+            return self.compliance_service.requirements(the_id, framework, self.compliance_fetcher(the_id))
+        description = self.compliance_service.describe(framework, requirement)
+        if description is None:
+            return codec.dumps({'error':'Requirement not found.'})
+        result = {}
+        result[framework] = {}
+        result[framework]['requirement'] = requirement
+        result[framework]['description'] = description
+        return codec.dumps(result)
+
+    def compliance_fetcher(self, the_id):
+        """Return a function that requests a Wazuh API endpoint of the given API.
+
+        Parameters
+        ----------
+        the_id : str
+            The API id
+        """
+        url,auth,verify,cluster_enabled = self.get_credentials(the_id)
+        return lambda endpoint: self.make_request('GET', url, endpoint, {}, auth, verify, api_id=the_id)
+
+    @expose_page(must_login=False, methods=['GET'])
+    def compliance(self, **kwargs):
+        """Return the requirements of every compliance framework used by the API ruleset.
+
+        Parameters
+        ----------
+        kwargs : dict
+            Request parameters
+        """
+        try:
+            self.logger.debug("api: Getting compliance data.")
+            if not 'apiId' in kwargs:
+                return codec.dumps({'error': 'Missing API ID.'})
+            the_id = kwargs['apiId']
+            return self.compliance_service.all_requirements(the_id, self.compliance_fetcher(the_id))
+        except Exception as e:
+            self.logger.error("api: Error getting compliance requirements: %s" % (str(e)))
+            return codec.dumps({"error": str(e)})
 
     @expose_page(must_login=False, methods=['GET'])
     def pci(self, **kwargs):
         try:
             self.logger.debug("api: Getting PCI data.")
-            if not 'requirement' in kwargs:
-                raise Exception('Missing requirement.')
-            pci_description = ''
-            requirement = kwargs['requirement']
-            if requirement == 'all':
-                if not 'apiId' in kwargs:
-                    return jsonbak.dumps(pci_requirements.pci)
-                the_id = kwargs['apiId']
-                url,auth,verify,cluster_enabled = self.get_credentials(the_id)
-                opt_endpoint = '/rules/pci'
-                request = self.session.get(
-                    url + opt_endpoint, params=kwargs, auth=auth,
-                    verify=verify).json()
-                if request['error'] != 0:
-                    return jsonbak.dumps({'error':request['error']})
-                data = request['data']['items']
-                result = {}
-                for item in data:
-                    result[item] = pci_requirements.pci[item]
-                return jsonbak.dumps(result)
-            else:
-                if not requirement in pci_requirements.pci:
-                    return jsonbak.dumps({'error':'Requirement not found.'})
-                pci_description = pci_requirements.pci[requirement]
-                result = {}
-                result['pci'] = {}
-                result['pci']['requirement'] = requirement
-                result['pci']['description'] = pci_description
-                return jsonbak.dumps(result)
+            return self.compliance_requirements('pci', kwargs)
         except Exception as e:
             self.logger.error("api: Error getting PCI-DSS requirements: %s" % (str(e)))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
 
     @expose_page(must_login=False, methods=['GET'])
     def gdpr(self, **kwargs):
         try:
             self.logger.debug("api: Getting GDPR data.")
-            if not 'requirement' in kwargs:
-                raise Exception('Missing requirement.')
-            pci_description = ''
-            requirement = kwargs['requirement']
-            if requirement == 'all':
-                if not 'apiId' in kwargs:
-                    return jsonbak.dumps(gdpr_requirements.gdpr)
-                the_id = kwargs['apiId']
-                url,auth,verify,cluster_enabled = self.get_credentials(the_id)
-                opt_endpoint = '/rules/gdpr'
-                request = self.session.get(
-                    url + opt_endpoint, params=kwargs, auth=auth,
-                    verify=verify).json()
-                if request['error'] != 0:
-                    return jsonbak.dumps({'error':request['error']})
-                data = request['data']['items']
-                result = {}
-                for item in data:
-                    result[item] = gdpr_requirements.gdpr[item]
-                return jsonbak.dumps(result)
-            else:
-                if not requirement in gdpr_requirements.gdpr:
-                    return jsonbak.dumps({'error':'Requirement not found.'})
-                pci_description = gdpr_requirements.gdpr[requirement]
-                result = {}
-                result['gdpr'] = {}
-                result['gdpr']['requirement'] = requirement
-                result['gdpr']['description'] = pci_description
-                return jsonbak.dumps(result)
+            return self.compliance_requirements('gdpr', kwargs)
         except Exception as e:
-            self.logger.error("api: Error getting PCI-DSS requirements: %s" % (str(e)))
-            return jsonbak.dumps({"error": str(e)})
+            self.logger.error("api: Error getting GDPR requirements: %s" % (str(e)))
+            return codec.dumps({"error": str(e)})
 
-            
     @expose_page(must_login=False, methods=['GET'])
     def hipaa(self, **kwargs):
         try:
             self.logger.debug("api: Getting HIPAA data.")
-            if not 'requirement' in kwargs:
-                raise Exception('Missing requirement.')
-            hipaa_description = ''
-            requirement = kwargs['requirement']
-            if requirement == 'all':
-                if not 'apiId' in kwargs:
-                    return jsonbak.dumps(hipaa_requirements.hipaa)
-                the_id = kwargs['apiId']
-                url,auth,verify = self.get_credentials(the_id)
-                opt_endpoint = '/rules/hipaa'
-                request = self.session.get(
-                    url + opt_endpoint, params=kwargs, auth=auth,
-                    verify=verify).json()
-                if request['error'] != 0:
-                    return jsonbak.dumps({'error':request['error']})
-                data = request['data']['items']
-                result = {}
-                for item in data:
-                    result[item] = hipaa_requirements.hipaa[item]
-                return jsonbak.dumps(result)
-            else:
-                if not requirement in hipaa_requirements.hipaa:
-                    return jsonbak.dumps({'error':'Requirement not found.'})
-                hipaa_description = hipaa_requirements.hipaa[requirement]
-                result = {}
-                result['hipaa'] = {}
-                result['hipaa']['requirement'] = requirement
-                result['hipaa']['description'] = hipaa_description
-                return jsonbak.dumps(result)
+            return self.compliance_requirements('hipaa', kwargs)
         except Exception as e:
             self.logger.error("api: Error getting HIPAA requirements: %s" % (str(e)))
-            return jsonbak.dumps({"error": str(e)})
-         
+            return codec.dumps({"error": str(e)})
+
     @expose_page(must_login=False, methods=['GET'])
     def nist(self, **kwargs):
         try:
             self.logger.debug("api: Getting NIST 800-53 data.")
-            if not 'requirement' in kwargs:
-                raise Exception('Missing requirement.')
-            nist_description = ''
-            requirement = kwargs['requirement']
-            if requirement == 'all':
-                if not 'apiId' in kwargs:
-                    return jsonbak.dumps(nist_requirements.nist)
-                the_id = kwargs['apiId']
-                url,auth,verify = self.get_credentials(the_id)
-                opt_endpoint = '/rules/nist-800-53'
-                request = self.session.get(
-                    url + opt_endpoint, params=kwargs, auth=auth,
-                    verify=verify).json()
-                if request['error'] != 0:
-                    return jsonbak.dumps({'error':request['error']})
-                data = request['data']['items']
-                result = {}
-                for item in data:
-                    result[item] = nist_requirements.nist[item]
-                return jsonbak.dumps(result)
-            else:
-                if not requirement in nist_requirements.nist:
-                    return jsonbak.dumps({'error':'Requirement not found.'})
-                nist_description = nist_requirements.nist[requirement]
-                result = {}
-                result['nist'] = {}
-                result['nist']['requirement'] = requirement
-                result['nist']['description'] = nist_description
-                return jsonbak.dumps(result)
+            return self.compliance_requirements('nist', kwargs)
         except Exception as e:
             self.logger.error("api: Error getting NIST 800-53 requirements: %s" % (str(e)))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
 
 
     def get_config_on_memory(self):
@@ -604,7 +839,7 @@ class api(controllers.BaseController):
             return config
         except Exception as e:
             self.logger.error("api: Error getting the configuration on memory: %s" % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
 
     """
     Get basic syscollector information for a given agent.
@@ -627,68 +862,46 @@ class api(controllers.BaseController):
             apiId = kwargs['apiId']
             agentId = kwargs['agentId']
             url,auth,verify,cluster_enabled = self.get_credentials(apiId)
-            # Hardware
-            endpoint_hardware = '/syscollector/' +  str(agentId) + '/hardware'
-            hardware_data = self.session.get(
-                    url + endpoint_hardware, params={}, auth=auth,
-                    verify=verify).json()
-            if 'error' in hardware_data and hardware_data['error'] == 0 and 'data' in hardware_data:
-                syscollectorData['hardware'] = hardware_data['data']
-            
-            # OS
-            endpoint_os = '/syscollector/' +  str(agentId) + '/os'
-            os_data = self.session.get(
-                    url + endpoint_os, params={}, auth=auth,
-                    verify=verify).json()
-            if 'error' in os_data and os_data['error'] == 0 and 'data' in os_data:
-                syscollectorData['os'] = os_data['data']
-            
-            # Ports
-            endpoint_ports = '/syscollector/' +  str(agentId) + '/ports'
-            ports_data = self.session.get(
-                    url + endpoint_ports, params={ 'limit' : 1 }, auth=auth,
-                    verify=verify).json()
-            if 'error' in ports_data and ports_data['error'] == 0 and 'data' in ports_data:
-                syscollectorData['ports'] = ports_data['data']
-
-            # Packages
-            endpoint_packages = '/syscollector/' +  str(agentId) + '/packages'
-            packages_data = self.session.get(
-                    url + endpoint_packages, params={ 'limit' : 1, 'select' : 'scan_time'}, auth=auth,
-                    verify=verify).json()
-            if 'error' in packages_data and packages_data['error'] == 0 and 'data' in packages_data:
-                if 'items' in packages_data['data'] and len(packages_data['data']['items']) > 0 and 'scan_time' in packages_data['data']['items'][0]:
-                    syscollectorData['packagesDate'] = packages_data['data']['items'][0]['scan_time']
-                else:
-                    syscollectorData['packagesDate'] = 'Unknown'
-
-            # Processes
-            endpoint_processes = '/syscollector/' +  str(agentId) + '/processes'
-            processes_data = self.session.get(
-                    url + endpoint_processes, params={ 'limit' : 1, 'select' : 'scan_time'}, auth=auth,
-                    verify=verify).json()
-            if 'error' in processes_data and processes_data['error'] == 0 and 'data' in processes_data:
-                if 'items' in processes_data['data'] and len(processes_data['data']['items']) > 0 and 'scan_time' in processes_data['data']['items'][0]:
-                    syscollectorData['processesDate'] = processes_data['data']['items'][0]['scan_time']
-                else:
-                    syscollectorData['processesDate'] = 'Unknown'
-
-            # Netiface
-            endpoint_netiface = '/syscollector/' +  str(agentId) + '/netiface'
-            netiface_data = self.session.get(
-                    url + endpoint_netiface, params={}, auth=auth,
-                    verify=verify).json()
-            if 'error' in netiface_data and netiface_data['error'] == 0 and 'data' in netiface_data:
-                syscollectorData['netiface'] = netiface_data['data']
-
-            # Netaddr
-            endpoint_netaddr = '/syscollector/' +  str(agentId) + '/netaddr'
-            netaddr_data = self.session.get(
-                    url + endpoint_netaddr, params={ 'limit' : 1 }, auth=auth,
-                    verify=verify).json()
-            if 'error' in netaddr_data and netaddr_data['error'] == 0 and 'data' in netaddr_data:
-                syscollectorData['netaddr'] = netaddr_data['data']
-            return jsonbak.dumps(syscollectorData)
+            base_endpoint = url + '/syscollector/' + str(agentId)
+
+            def fetch(section, params):
+                def request():
+                    admit(url)
+                    return self.session.get(
+                        base_endpoint + '/' + section, params=params, auth=auth,
+                        timeout=self.timeout, verify=verify).json()
+                return request
+
+            responses, errors = fan_out({
+                'hardware': fetch('hardware', {}),
+                'os': fetch('os', {}),
+                'ports': fetch('ports', { 'limit' : 1 }),
+                'packages': fetch('packages', { 'limit' : 1, 'select' : 'scan_time'}),
+                'processes': fetch('processes', { 'limit' : 1, 'select' : 'scan_time'}),
+                'netiface': fetch('netiface', {}),
+                'netaddr': fetch('netaddr', { 'limit' : 1 })
+            }, max_workers=7, timeout=self.timeout)
+            for section, error in errors.items():
+                self.logger.error("api: Error getting syscollector %s of agent %s: %s" % (section, agentId, error))
+
+            def valid(section):
+                data = responses.get(section)
+                return data is not None and 'error' in data and data['error'] == 0 and 'data' in data
+
+            # Hardware, OS, ports, netiface and netaddr
+            for section in ['hardware', 'os', 'ports', 'netiface', 'netaddr']:
+                if valid(section):
+                    syscollectorData[section] = responses[section]['data']
+
+            # Packages and processes scan dates
+            for section in ['packages', 'processes']:
+                if valid(section):
+                    data = responses[section]['data']
+                    if 'items' in data and len(data['items']) > 0 and 'scan_time' in data['items'][0]:
+                        syscollectorData[section + 'Date'] = data['items'][0]['scan_time']
+                    else:
+                        syscollectorData[section + 'Date'] = 'Unknown'
+            return codec.dumps(syscollectorData)
         except Exception as e:
             self.logger.error("Error getting syscollector information for a given agent: %s" % (str(e)))
-            return jsonbak.dumps({"error": str(e)})
\ No newline at end of file
+            return codec.dumps({"error": str(e)})
\ No newline at end of file
@@ -12,7 +12,7 @@ the Free Software Foundation; either version 2 of the License, or
 Find more information about this on the LICENSE file.
 """
 
-import jsonbak
+import codec
 import splunk.appserver.mrsparkle.controllers as controllers
 from splunk.appserver.mrsparkle.lib.decorators import expose_page
 from log import log
@@ -45,10 +45,10 @@ class Configuration(controllers.BaseController):
         try:
             self.logger.debug("config: Updating configuration.")
             result = self.config.update_config(kwargs)
-            return jsonbak.dumps({"data": result, "error": 0})
+            return codec.dumps({"data": result, "error": 0})
         except Exception as e:
             self.logger.error("config: Error updating the configuration: %s" % (e))
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
 
     @expose_page(must_login=False, methods=['GET'])
     def get_config(self):
@@ -62,7 +62,7 @@ class Configuration(controllers.BaseController):
         try:
             self.logger.debug("config: Reading the config.conf file.")
             config = self.config.get_config()
-            return jsonbak.dumps({"data": config, "error": 0})
+            return codec.dumps({"data": config, "error": 0})
         except Exception as e:
             self.logger.error("config: Error getting the configuration: %s" % (e))
-            return jsonbak.dumps({'error': str(e)})
\ No newline at end of file
+            return codec.dumps({'error': str(e)})
\ No newline at end of file
@@ -14,17 +14,27 @@ Find more information about this on the LICENSE file.
 
 
 from . import api
-import jsonbak
+import codec
 import requestsbak
 import uuid
+import cherrypy
 # from splunk import AuthorizationFailed as AuthorizationFailed
 from splunk.clilib import cli_common as cli
 import splunk.appserver.mrsparkle.controllers as controllers
 from splunk.appserver.mrsparkle.lib.decorators import expose_page
 from db import database
 from log import log
+from daemons_state import get_daemons_state
+from credentials_cache import get_credentials_cache
+from http_pool import get_session
+from compliance import get_compliance_service
+from response_cache import get_cache
+from metrics import collect, summarize, to_prometheus
 from requestsbak.exceptions import ConnectionError
 
+# Cached endpoints whose answers may change when a file is uploaded
+UPLOAD_ENDPOINTS = ('/rules', '/decoders', '/lists', '/manager/files')
+
 def getSelfConfStanza(file, stanza):
     """Get the configuration from a stanza.
 
@@ -36,7 +46,7 @@ def getSelfConfStanza(file, stanza):
     """
     try:
         apikeyconf = cli.getConfStanza(file, stanza)
-        parsed_data = jsonbak.dumps(apikeyconf)
+        parsed_data = codec.dumps(apikeyconf)
     except Exception as e:
         raise e
     return parsed_data
@@ -76,8 +86,9 @@ class manager(controllers.BaseController):
             self.config =  self.get_config_on_memory()
             self.timeout = int(self.config['timeout'])
             self.wazuh_api = api.api()
-            self.session = requestsbak.Session()            
-            self.session.trust_env = False
+            self.session = get_session()
+            self.daemons_state = get_daemons_state()
+            self.credentials = get_credentials_cache()
         except Exception as e:
             self.logger.error("manager: Error in manager module constructor: %s" % (e))
 
@@ -100,9 +111,9 @@ class manager(controllers.BaseController):
             disabled = app.get('disabled')
             polling_dict = {}
             polling_dict['disabled'] = disabled
-            data_temp = jsonbak.dumps(polling_dict)
+            data_temp = codec.dumps(polling_dict)
         except Exception as e:
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return data_temp
 
     @expose_page(must_login=False, methods=['GET'])
@@ -120,7 +131,7 @@ class manager(controllers.BaseController):
             stanza = getSelfConfStanza("config", "extensions")
             data_temp = stanza
         except Exception as e:
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return data_temp
 
     @expose_page(must_login=False, methods=['GET'])
@@ -138,7 +149,7 @@ class manager(controllers.BaseController):
             stanza = getSelfConfStanza("config", "admin_extensions")
             data_temp = stanza
         except Exception as e:
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return data_temp
 
     @expose_page(must_login=False, methods=['GET'])
@@ -156,7 +167,7 @@ class manager(controllers.BaseController):
             stanza = getSelfConfStanza("config", "configuration")
             data_temp = stanza
         except Exception as e:
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return data_temp
 
     @expose_page(must_login=False, methods=['GET'])
@@ -179,9 +190,9 @@ class manager(controllers.BaseController):
                 'package',
                 'splunk')
             data_temp['splunk_version'] = stanza['version']
-            parsed_data = jsonbak.dumps(data_temp)
+            parsed_data = codec.dumps(data_temp)
         except Exception as e:
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return parsed_data
 
     @expose_page(must_login=False, methods=['GET'])
@@ -197,13 +208,13 @@ class manager(controllers.BaseController):
         try:
             self.logger.debug("manager: Getting API info from _key.")
             if 'apiId' not in kwargs:
-                return jsonbak.dumps({'error': 'Missing ID.'})
+                return codec.dumps({'error': 'Missing ID.'})
             id = kwargs['apiId']
             data_temp = self.db.get(id)
-            parsed_data = jsonbak.dumps(data_temp)
+            parsed_data = codec.dumps(data_temp)
         except Exception as e:
             self.logger.error("manager: Error in get_apis endpoint: %s" % (e))
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return parsed_data
 
     @expose_page(must_login=False, methods=['GET'])
@@ -219,15 +230,15 @@ class manager(controllers.BaseController):
         try:
             self.logger.debug("manager: Getting API list.")
             apis = self.db.all()
-            parsed_apis = jsonbak.loads(apis)
+            parsed_apis = codec.loads(apis)
             # Remove the password from the list of apis
             for api in parsed_apis:
                 if "passapi" in api:
                     del api["passapi"]
-            result = jsonbak.dumps(parsed_apis)
+            result = codec.dumps(parsed_apis)
         except Exception as e:
-            self.logger.error(jsonbak.dumps({"error": str(e)}))
-            return jsonbak.dumps({"error": str(e)})
+            self.logger.error(codec.dumps({"error": str(e)}))
+            return codec.dumps({"error": str(e)})
         return result
 
     @expose_page(must_login=False, methods=['POST'])
@@ -246,14 +257,15 @@ class manager(controllers.BaseController):
             keys_list = ['url', 'portapi', 'userapi', 'passapi',
                          'managerName', 'filterType', 'filterName']
             if set(record.keys()) == set(keys_list):
-                key = self.db.insert(jsonbak.dumps(record))
-                parsed_data = jsonbak.dumps({'result': key})
+                key = self.db.insert(codec.dumps(record))
+                self.credentials.invalidate(key)
+                parsed_data = codec.dumps({'result': key})
                 return parsed_data
             else:
                 raise Exception('Invalid number of arguments')
         except Exception as e:
             self.logger.error({'manager - add_api': str(e)})
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
 
     @expose_page(must_login=False, methods=['POST'])
     def remove_api(self, **kwargs):
@@ -269,12 +281,13 @@ class manager(controllers.BaseController):
             self.logger.debug("manager: Removing API.")
             api_id = kwargs
             if '_key' not in api_id:
-                return jsonbak.dumps({'error': 'Missing ID'})
+                return codec.dumps({'error': 'Missing ID'})
             self.db.remove(api_id['_key'])
-            parsed_data = jsonbak.dumps({'data': 'success'})
+            self.credentials.invalidate(api_id['_key'])
+            parsed_data = codec.dumps({'data': 'success'})
         except Exception as e:
             self.logger.error("manager: Error in remove_api endpoint: %s" % (e))
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
         return parsed_data
 
     @expose_page(must_login=False, methods=['POST'])
@@ -295,14 +308,16 @@ class manager(controllers.BaseController):
             if not "passapi" in entry:
                 opt_id = entry["_key"]
                 data_temp = self.db.get(opt_id)
-                current_api = jsonbak.loads(data_temp)
+                current_api = codec.loads(data_temp)
                 current_api = current_api["data"]
                 entry["passapi"] = current_api["passapi"]
             keys_list = ['_key', 'url', 'portapi', 'userapi',
                          'passapi', 'filterName', 'filterType', 'managerName']
             if set(entry.keys()) == set(keys_list):
+                api_key = entry['_key']
                 self.db.update(entry)
-                parsed_data = jsonbak.dumps({'data': 'success'})
+                self.credentials.invalidate(api_key)
+                parsed_data = codec.dumps({'data': 'success'})
             else:
                 missing_params = diff_keys_dic_update_api(entry)
                 raise Exception(
@@ -310,7 +325,7 @@ class manager(controllers.BaseController):
                     % str(missing_params))
         except Exception as e:
             self.logger.error("manager: Error in update_api endpoint: %s" % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
         return parsed_data
 
     @expose_page(must_login=False, methods=['GET'])
@@ -326,12 +341,35 @@ class manager(controllers.BaseController):
         try:
             self.logger.debug("manager: Getting last log lines.")
             lines = self.logger.get_last_log_lines(20)
-            parsed_data = jsonbak.dumps({'logs': lines})
+            parsed_data = codec.dumps({'logs': lines})
         except Exception as e:
             self.logger.error("manager: Get_log_lines endpoint: %s" % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
         return parsed_data
 
+    @expose_page(must_login=False, methods=['GET'])
+    def metrics(self, **kwargs):
+        """Get the latency, payload size and error histograms of the Wazuh API calls.
+
+        Includes the calls of this process and the last runs of the scripts.
+
+        Parameters
+        ----------
+        kwargs : dict
+            The request's parameters. format can be prometheus (default) or json
+
+        """
+        try:
+            self.logger.debug("manager: Getting Wazuh API metrics.")
+            items = collect()
+            if kwargs.get('format') == 'json':
+                return codec.dumps({'data': summarize(items), 'codec': codec.backend_info(), 'error': 0})
+            cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+            return to_prometheus(items)
+        except Exception as e:
+            self.logger.error("manager: Error in metrics endpoint: %s" % (e))
+            return codec.dumps({"error": str(e)})
+
     @expose_page(must_login=False, methods=['GET'])
     def check_connection(self, **kwargs):
         """Check API connection.
@@ -358,7 +396,7 @@ class manager(controllers.BaseController):
                     url + '/agents/000?select=name', auth=auth, timeout=20, verify=verify)
                 if request_manager.status_code == 401:
                     self.logger.error("Cannot connect to API; Invalid credentials.")
-                    return jsonbak.dumps({"status": "400", "error": "Invalid credentials, please check the username and password."})
+                    return codec.dumps({"status": "400", "error": "Invalid credentials, please check the username and password."})
                 request_manager = request_manager.json()  
                 request_cluster = self.session.get(
                     url + '/cluster/status', auth=auth, timeout=20, verify=verify).json()
@@ -366,13 +404,13 @@ class manager(controllers.BaseController):
                     url + '/cluster/node', auth=auth, timeout=20, verify=verify).json()
             except ConnectionError as e:
                 self.logger.error("manager: Cannot connect to API : %s" % (e))
-                return jsonbak.dumps({"status": "400", "error": "Unreachable API, please check the URL and port."})
+                return codec.dumps({"status": "400", "error": "Unreachable API, please check the URL and port."})
             output = {}
             try:
                 self.check_wazuh_version(kwargs)
             except Exception as e:
                 error = {"status": 400, "error": str(e)}
-                return jsonbak.dumps(error)
+                return codec.dumps(error)
             daemons_ready = self.check_daemons(url, auth, verify, opt_cluster)
             # Pass the cluster status instead of always False
             if not daemons_ready:
@@ -381,14 +419,14 @@ class manager(controllers.BaseController):
             output['clusterMode'] = request_cluster['data']
             output['clusterName'] = request_cluster_name['data']
             del kwargs['pass']
-            result = jsonbak.dumps(output) 
+            result = codec.dumps(output) 
         except Exception as e:
             if not daemons_ready:
                 self.logger.error("manager: Cannot connect to API; Wazuh not ready yet.")
-                return jsonbak.dumps({"status": "200", "error": 3099, "message": "Wazuh not ready yet."})
+                return codec.dumps({"status": "200", "error": 3099, "message": "Wazuh not ready yet."})
             else:
                 self.logger.error("manager: Cannot connect to API : %s" % (e))
-                return jsonbak.dumps({"status": 400, "error": "Cannot connect to the API"})
+                return codec.dumps({"status": 400, "error": "Cannot connect to the API"})
         return result
 
     @expose_page(must_login=False, methods=['GET'])
@@ -405,9 +443,9 @@ class manager(controllers.BaseController):
             self.logger.debug("manager: Checking API connection by id.")
             opt_id = kwargs["apiId"]
             current_api = self.get_api(apiId=opt_id)
-            current_api_json = jsonbak.loads(jsonbak.loads(current_api))
+            current_api_json = codec.loads(codec.loads(current_api))
             if not "data" in current_api_json:
-                return jsonbak.dumps({"status": "400", "error": "Error when checking API connection."})
+                return codec.dumps({"status": "400", "error": "Error when checking API connection."})
             opt_username = str(current_api_json["data"]["userapi"])
             opt_password = str(current_api_json["data"]["passapi"])
             opt_base_url = str(current_api_json["data"]["url"])
@@ -424,16 +462,16 @@ class manager(controllers.BaseController):
                 manager_info = manager_info.json()
             except ConnectionError as e:
                 self.logger.error("manager: Cannot connect to API : %s" % (e))
-                return jsonbak.dumps({"status": "400", "error": "Unreachable API, please check the URL and port."})
+                return codec.dumps({"status": "400", "error": "Unreachable API, please check the URL and port."})
             output = {}
             if "error" in manager_info and manager_info["error"] != 0: #Checks if daemons are up and running
-                return jsonbak.dumps({"status": "400", "error": manager_info["message"]})
+                return codec.dumps({"status": "400", "error": manager_info["message"]})
             output['managerName'] = { 'name' : manager_info['data']['name'] }
             output['clusterMode'] = { "enabled" : manager_info['data']['cluster']['enabled'], "running" : manager_info['data']['cluster']['running'] }
             output['clusterName'] = { "type" : manager_info['data']['cluster']['node_type'], "cluster" : manager_info['data']['cluster']['name'], "node" : manager_info['data']['cluster']['node_name'] }
             del current_api_json["data"]["passapi"]
             output['api'] = current_api_json
-            result = jsonbak.dumps(output)             
+            result = codec.dumps(output)             
         except Exception as e:
             self.logger.error("Error when checking API connection: %s" % (e))
             raise e
@@ -478,7 +516,7 @@ class manager(controllers.BaseController):
             raise e
             
     def check_daemons(self, url, auth, verify, check_cluster):
-        """ Request to check the status of this daemons: execd, modulesd, wazuhdb and clusterd
+        """ Check the status of this daemons: execd, modulesd, wazuhdb and clusterd
 
         Parameters
         ----------
@@ -489,26 +527,8 @@ class manager(controllers.BaseController):
         """
         try:
             self.logger.debug("manager: Checking Wazuh daemons.")
-            request_cluster = self.session.get(
-                url + '/cluster/status', auth=auth, timeout=self.timeout, verify=verify).json()
-            # Try to get cluster is enabled if the request fail set to false
-            try:
-                cluster_enabled = request_cluster['data']['enabled'] == 'yes'
-            except Exception as e:
-                cluster_enabled = False
-            cc = check_cluster and cluster_enabled # Var to check the cluster demon or not
-            opt_endpoint = "/manager/status"
-            daemons_status = self.session.get(
-                    url + opt_endpoint, auth=auth,
-                    verify=verify).json()
-            if not daemons_status['error']:
-                d = daemons_status['data']
-                daemons = {"execd": d['ossec-execd'], "modulesd": d['wazuh-modulesd'], "db": d['wazuh-db']}
-                if cc:
-                    daemons['clusterd'] = d['wazuh-clusterd']
-                values = list(daemons.values())
-                wazuh_ready = len(set(values)) == 1 and values[0] == "running" # Checks all the status are equals, and running
-                return wazuh_ready
+            return self.daemons_state.is_ready(
+                self.session, url, auth, verify, check_cluster, self.timeout)
         except Exception as e:
             self.logger.error("manager: Error checking daemons: %s" % (e))
             raise e
@@ -532,7 +552,7 @@ class manager(controllers.BaseController):
             # Get current API data
             opt_id = kwargs["apiId"]
             current_api_json = self.db.get(opt_id)
-            current_api_json = jsonbak.loads(current_api_json)
+            current_api_json = codec.loads(current_api_json)
             opt_username = str(current_api_json["data"]["userapi"])
             opt_password = str(current_api_json["data"]["passapi"])
             opt_base_url = str(current_api_json["data"]["url"])
@@ -553,10 +573,12 @@ class manager(controllers.BaseController):
             else:
                 file_content = file_content.replace('\\n','')
                 result = self.session.post(url + '/manager/files?path='+ dest_path +file_name, data=file_content, headers= {"Content-type": "application/xml"}, auth=auth, timeout=20, verify=verify)
-            result = jsonbak.loads(result.text)
+            result = codec.loads(result.text)
+            get_compliance_service().invalidate(opt_id)
+            get_cache().invalidate(opt_id, UPLOAD_ENDPOINTS)
             if 'error' in result and result['error'] != 0:
-                return jsonbak.dumps({"status": "400", "text": "Error adding file: %s. Cause: %s" % (file_name,result["message"])})
-            return jsonbak.dumps({"status": "200", "text": "File %s was updated successfully. " % file_name})
+                return codec.dumps({"status": "400", "text": "Error adding file: %s. Cause: %s" % (file_name,result["message"])})
+            return codec.dumps({"status": "200", "text": "File %s was updated successfully. " % file_name})
         except Exception as e:
             self.logger.error("manager: Error trying to upload a file(s): %s" % (e))
 
@@ -565,7 +587,7 @@ class manager(controllers.BaseController):
         try:
             self.logger.debug("manager: Getting configuration on memory.")
             config_str = getSelfConfStanza("config", "configuration")
-            config = jsonbak.loads(config_str)
+            config = codec.loads(config_str)
             return config
         except Exception as e:
             self.logger.error("manager: Error getting the configuration on memory: %s" % (e))
@@ -12,9 +12,10 @@ the Free Software Foundation; either version 2 of the License, or
 Find more information about this on the LICENSE file.
 """
 
-import jsonbak
+import codec
 import splunk.appserver.mrsparkle.controllers as controllers
 from splunk.appserver.mrsparkle.lib.decorators import expose_page
+from splunk.clilib import cli_common as cli
 from db import database
 from log import log
 from jobs_queue import JobsQueue
@@ -37,6 +38,21 @@ class Queue(controllers.BaseController):
             controllers.BaseController.__init__(self)
         except Exception as e:
             self.logger.error("queue: Error in Jobs queue module constructor: %s" % (e))
+
+    def admin_enabled(self):
+        """Check if admin mode, required to queue write requests, is enabled."""
+        return str(cli.getConfStanza('config', 'configuration')['admin']) == 'true'
+
+    def is_write(self, job):
+        """Check if a job sends a request other than GET.
+
+        Parameters
+        ----------
+        job : dict
+            The job parameters
+        """
+        return str(job.get('method', 'GET')).upper() != 'GET'
+
     @expose_page(must_login=False, methods=['POST'])
     def add_job(self, **kwargs):
         """Add job to the queue.
@@ -48,12 +64,50 @@ class Queue(controllers.BaseController):
         """
         try:
             self.logger.debug("queue: Adding job to the jobs queue.")
+            if self.is_write(kwargs) and not self.admin_enabled():
+                self.logger.error('queue: Admin mode is disabled.')
+                return codec.dumps({'error': 'Forbidden. Enable admin mode.'})
             now = time.time()
             exec_time = now + float(kwargs['delay'])
             del kwargs['delay']
-            job = {"job": kwargs, "added": now, "exec_time": exec_time, "done": 0}
+            job = {"job": kwargs, "added": now, "exec_time": exec_time, "done": False}
             self.queue.insert_job(job)
-            return jsonbak.dumps({"data": "Job added to the queue.", "error": 0})
+            return codec.dumps({"data": "Job added to the queue.", "error": 0})
         except Exception as e:
             self.logger.error("queue: Error adding job: %s" % (e))
-            return jsonbak.dumps({'error': str(e)})
+            return codec.dumps({'error': str(e)})
+
+    @expose_page(must_login=False, methods=['POST'])
+    def add_jobs(self, **kwargs):
+        """Add several jobs to the queue in a single call.
+
+        Parameters
+        ----------
+        kwargs : dict
+            Request parameters. `jobs` is a JSON list of objects with the
+            same parameters as add_job, `delay` included.
+        """
+        try:
+            self.logger.debug("queue: Adding jobs to the jobs queue.")
+            if 'jobs' not in kwargs:
+                return codec.dumps({'error': 'Missing jobs.'})
+            items = codec.loads(kwargs['jobs'])
+            if not isinstance(items, list):
+                return codec.dumps({'error': 'Jobs must be a list.'})
+            now = time.time()
+            jobs = []
+            admin_enabled = self.admin_enabled()
+            for item in items:
+                if not isinstance(item, dict) or 'delay' not in item:
+                    raise Exception('Every job needs a delay.')
+                if self.is_write(item) and not admin_enabled:
+                    self.logger.error('queue: Admin mode is disabled.')
+                    return codec.dumps({'error': 'Forbidden. Enable admin mode.'})
+                item = dict(item)
+                exec_time = now + float(item.pop('delay'))
+                jobs.append({"job": item, "added": now, "exec_time": exec_time, "done": False})
+            keys = self.queue.insert_jobs(jobs) if jobs else []
+            return codec.dumps({"data": {"message": "%s jobs added to the queue." % len(keys), "keys": keys}, "error": 0})
+        except Exception as e:
+            self.logger.error("queue: Error adding jobs: %s" % (e))
+            return codec.dumps({'error': str(e)})
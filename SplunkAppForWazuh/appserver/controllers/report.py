@@ -16,7 +16,7 @@ from . import api
 from . import report_vars
 import os
 import time
-import jsonbak
+import codec
 import datetime
 from operator import itemgetter
 import splunk.appserver.mrsparkle.controllers as controllers
@@ -684,12 +684,12 @@ class report(controllers.BaseController):
             first_page = True
             self.logger.info("Start generating configuration report ")
             json_acceptable_string = kwargs['data']
-            data = jsonbak.loads(json_acceptable_string)
+            data = codec.loads(json_acceptable_string)
             report_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             time_diff = data['timeZone']
             today = datetime.datetime.utcnow() - datetime.timedelta(minutes=time_diff)
             today = today.strftime('%Y.%m.%d %H:%M')
-            parsed_data = jsonbak.dumps({'data': 'success'})
+            parsed_data = codec.dumps({'data': 'success'})
             section_title = data['sectionTitle']
             # Add title and filters 
             pdf.alias_nb_pages()
@@ -743,7 +743,7 @@ class report(controllers.BaseController):
                         if 'groupConfig' in currentSection:
                             config_request = {'endpoint': '/agents/groups/'+data['groupName']['name']+'/configuration' , 'id':str(data['apiId']['_key'])}
                             conf_data = self.miapi.exec_request(config_request)
-                            conf_data = jsonbak.loads(conf_data)
+                            conf_data = codec.loads(conf_data)
                             if not conf_data or 'data' not in conf_data:
                                 pass
                             elif 'items' not in conf_data['data']:
@@ -795,7 +795,7 @@ class report(controllers.BaseController):
                         if 'agentList' in currentSection:
                             config_request = {'endpoint': '/agents/groups/'+data['groupName']['name'] , 'id':str(data['apiId']['_key'])}
                             conf_data = self.miapi.exec_request(config_request)
-                            conf_data = jsonbak.loads(conf_data)
+                            conf_data = codec.loads(conf_data)
                             if conf_data['data']['totalItems'] > 0 and 'items' in conf_data['data'] and conf_data['data']['items']:
                                 table = { "Agent List" : {} }
                                 fields = ['ID', 'Name', 'IP', 'Version', 'Manager', 'OS']
@@ -844,7 +844,7 @@ class report(controllers.BaseController):
                                 component = currentConfig['component']
                                 config_request = {'endpoint': '/agents/'+str(data['agentId'])+'/config/'+component+'/'+configuration , 'id':str(data['apiId']['_key'])}
                                 conf_data = self.miapi.exec_request(config_request)
-                                conf_data = jsonbak.loads(conf_data) 
+                                conf_data = codec.loads(conf_data) 
                                 if not conf_data or 'data' not in conf_data or configuration not in conf_data['data']:
                                     pass
                                 else:
@@ -860,7 +860,7 @@ class report(controllers.BaseController):
                             if not wmodules_conf_data: # ask for all wodles just once
                                 config_request = {'endpoint': '/agents/'+str(data['agentId'])+'/config/'+'wmodules'+'/'+'wmodules' , 'id':str(data['apiId']['_key'])}
                                 conf_data = self.miapi.exec_request(config_request)
-                                wmodules_conf_data = jsonbak.loads(conf_data)
+                                wmodules_conf_data = codec.loads(conf_data)
 
                             currentWodle_data = {}
                             for tmpWodle in wmodules_conf_data['data']['wmodules']:
@@ -881,7 +881,7 @@ class report(controllers.BaseController):
             self.logger.info('report agent configuration successful' + self.path+'wazuh-'+pdf_name+'-'+report_id+'.pdf')
         except Exception as e:
             self.logger.error("Error generating report: %s" % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
         return parsed_data
 
 
@@ -901,11 +901,11 @@ class report(controllers.BaseController):
             metrics_exists = False
             first_page = True
             json_acceptable_string = kwargs['data']
-            data = jsonbak.loads(json_acceptable_string)
+            data = codec.loads(json_acceptable_string)
             #Replace "'" in images
-            clean_images = jsonbak.dumps(data['images'])
+            clean_images = codec.dumps(data['images'])
             clean_images.replace("'", "\"")
-            data['images'] = jsonbak.loads(clean_images)
+            data['images'] = codec.loads(clean_images)
             report_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             #Get filters and other information
             filters = data['queryFilters']
@@ -918,11 +918,11 @@ class report(controllers.BaseController):
             today = datetime.datetime.utcnow() - datetime.timedelta(minutes=time_diff)
             today = today.strftime('%Y.%m.%d %H:%M:%S')
             if metrics:
-                metrics = jsonbak.loads(metrics)
+                metrics = codec.loads(metrics)
             agent_data = data['isAgents']
             #Save the images
             saved_images = self.save_images(data['images'])
-            parsed_data = jsonbak.dumps({'data': 'success'})
+            parsed_data = codec.dumps({'data': 'success'})
             # Add title and filters 
             pdf.alias_nb_pages()
             pdf.add_page()
@@ -1039,7 +1039,7 @@ class report(controllers.BaseController):
             self.delete_images(saved_images)
         except Exception as e:
             self.logger.error("report: Error generating report: %s" % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
         return parsed_data
 
 
@@ -1124,10 +1124,10 @@ class report(controllers.BaseController):
                         file['date'] = time.strftime('%Y.%m.%d %H:%M:%S', time.gmtime(os.path.getmtime(self.path+f)))
                         pdf_files.append(file)
 
-            parsed_data = jsonbak.dumps({'data': pdf_files})
+            parsed_data = codec.dumps({'data': pdf_files})
         except Exception as e:
             self.logger.error("report: Error getting PDF files: %s" % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
         return parsed_data
 
     # Deletes a report from disk
@@ -1147,11 +1147,11 @@ class report(controllers.BaseController):
             filename = kwargs['name']
             os.remove(self.path+filename)
             self.logger.debug("Removing report %s" % kwargs['name'])
-            parsed_data = jsonbak.dumps({"data": "Deleted file"})
+            parsed_data = codec.dumps({"data": "Deleted file"})
             self.logger.info("report: Report %s deleted." % filename)
         except Exception as e:
             self.logger.error("report: Error deleting PDF file: %s" % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
         return parsed_data
 
     #Cut value string
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Admission control for the Wazuh API requests.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import codec
+import hashlib
+import heapq
+import math
+import os
+import threading
+import time
+from app_config import get_stanza
+from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
+
+# Lower values are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+DEFAULT_CONFIG = {
+    'enabled': 'true',
+    'rate': '20',
+    'burst': '40',
+    'max_queue': '100',
+    'max_wait': '10',
+    'shared': 'true'
+}
+
+# Directory of the bucket state shared by the app server and the scripts
+STATE_PATH = make_splunkhome_path(['var', 'run', 'splunk', 'SplunkAppForWazuh', 'admission'])
+
+# How long a process waiting with an interactive request holds back the
+# background requests of the other processes, renewed while it waits
+CLAIM_TTL = 1.0
+
+# Longest sleep of a shared bucket waiter, tokens may be taken elsewhere
+POLL_INTERVAL = 0.1
+
+
+class BusyError(Exception):
+    """Raised when a request cannot be admitted in time."""
+
+    def __init__(self, retry_after):
+        """Constructor."""
+        Exception.__init__(self, "Wazuh API busy, retry after %s seconds." % retry_after)
+        self.retry_after = retry_after
+
+
+class TokenBucket():
+    """Token bucket with a bounded, prioritized wait queue.
+
+    Requests take a token when one is available. Otherwise they wait in a
+    queue ordered by priority and arrival, up to `max_wait` seconds. When
+    the queue is full, new requests are rejected straight away.
+    """
+
+    def __init__(self, rate=20.0, burst=40, max_queue=100, max_wait=10.0):
+        """Constructor."""
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.cond = threading.Condition(threading.Lock())
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.waiters = []
+        self.seq = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def refill(self, now):
+        """Add the tokens generated since the last refill."""
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self):
+        """Estimate the seconds until the queue has been drained."""
+        return int(math.ceil((len(self.waiters) + 1) / float(self.rate)))
+
+    def take(self, priority, now):
+        """Take a token for the head of the queue.
+
+        Return 0 when the token was taken, otherwise the seconds to wait
+        before trying again.
+
+        Parameters
+        ----------
+        priority : int
+            INTERACTIVE or BACKGROUND
+        now : float
+            Current timestamp
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self, priority=INTERACTIVE):
+        """Take a token, waiting for it if needed.
+
+        Parameters
+        ----------
+        priority : int
+            INTERACTIVE or BACKGROUND
+        """
+        with self.cond:
+            now = time.time()
+            if not self.waiters and self.take(priority, now) == 0:
+                self.admitted += 1
+                return
+            if len(self.waiters) >= self.max_queue:
+                self.rejected += 1
+                raise BusyError(self.retry_after())
+            entry = (priority, self.seq)
+            self.seq += 1
+            heapq.heappush(self.waiters, entry)
+            deadline = now + self.max_wait
+            while True:
+                now = time.time()
+                head = self.waiters[0] == entry
+                wait = deadline - now
+                if head:
+                    needed = self.take(priority, now)
+                    if needed == 0:
+                        heapq.heappop(self.waiters)
+                        self.admitted += 1
+                        # Let the next waiter check whether it's its turn
+                        self.cond.notify_all()
+                        return
+                    wait = min(wait, needed)
+                if now >= deadline:
+                    self.waiters.remove(entry)
+                    heapq.heapify(self.waiters)
+                    self.cond.notify_all()
+                    self.rejected += 1
+                    raise BusyError(self.retry_after())
+                self.cond.wait(max(wait, 0.001))
+
+    def stats(self):
+        """Return the bucket counters."""
+        with self.cond:
+            return {
+                'tokens': round(self.tokens, 2),
+                'waiting': len(self.waiters),
+                'admitted': self.admitted,
+                'rejected': self.rejected
+            }
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket whose tokens are shared by every process of the app.
+
+    The tokens live in a state file locked while it's read and updated, so
+    the app server, check_queue.py and get_agents_status.py draw from the
+    same bucket. Each process keeps its own prioritized wait queue, and
+    while the head of the queue of a process is an interactive request, it
+    keeps a claim in the state file that makes the background requests of
+    every process wait.
+    """
+
+    def __init__(self, path, rate=20.0, burst=40, max_queue=100, max_wait=10.0):
+        """Constructor.
+
+        Parameters
+        ----------
+        path : str
+            The state file of the bucket
+        """
+        TokenBucket.__init__(self, rate=rate, burst=burst, max_queue=max_queue, max_wait=max_wait)
+        self.path = path
+        self.claim = str(os.getpid())
+
+    def take(self, priority, now):
+        """Take a token from the shared state, see TokenBucket.take.
+
+        Falls back to the tokens of this process if the state file can't
+        be used.
+        """
+        import fcntl
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                f.seek(0)
+                content = f.read()
+                state = codec.loads(content) if content else {}
+                self.tokens = min(
+                    float(self.burst),
+                    float(state.get('tokens', self.burst)) + max(now - float(state.get('updated', now)), 0) * self.rate)
+                self.updated = now
+                claims = dict((pid, expires) for pid, expires in state.get('interactive', {}).items()
+                              if expires > now and pid != self.claim)
+                needed = 0
+                if self.tokens >= 1 and (priority == INTERACTIVE or not claims):
+                    self.tokens -= 1
+                else:
+                    if priority == INTERACTIVE:
+                        claims[self.claim] = now + CLAIM_TTL
+                    needed = POLL_INTERVAL if self.tokens >= 1 else min((1 - self.tokens) / self.rate, POLL_INTERVAL)
+                f.seek(0)
+                f.truncate()
+                f.write(codec.dumps({'tokens': self.tokens, 'updated': now, 'interactive': claims}))
+                f.flush()
+                return needed
+        except (IOError, OSError, ValueError):
+            return TokenBucket.take(self, priority, now)
+
+
+_config = None
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_config():
+    """Return the [rate_limit] stanza of config.conf merged with the defaults."""
+    global _config
+    if _config is None:
+        _config = get_stanza('rate_limit', DEFAULT_CONFIG)
+    return _config
+
+
+def state_path(name):
+    """Return the state file of the shared bucket of an API.
+
+    Parameters
+    ----------
+    name : str
+        The API url
+    """
+    return os.path.join(STATE_PATH, hashlib.md5(name.encode('utf-8')).hexdigest() + '.json')
+
+
+def admit(name, priority=INTERACTIVE):
+    """Wait for permission to send a request to an API.
+
+    Raises BusyError when the API queue is full or the wait takes too long.
+
+    Parameters
+    ----------
+    name : str
+        The API url
+    priority : int
+        INTERACTIVE or BACKGROUND
+    """
+    config = get_config()
+    if str(config['enabled']) != 'true':
+        return
+    with _lock:
+        bucket = _buckets.get(name)
+        if bucket is None:
+            limits = {
+                'rate': float(config['rate']),
+                'burst': int(config['burst']),
+                'max_queue': int(config['max_queue']),
+                'max_wait': float(config['max_wait'])
+            }
+            if str(config['shared']) == 'true' and os.name == 'posix':
+                bucket = SharedTokenBucket(state_path(name), **limits)
+            else:
+                bucket = TokenBucket(**limits)
+            _buckets[name] = bucket
+    bucket.acquire(priority)
+
+
+def buckets_status():
+    """Return the state of every known bucket."""
+    with _lock:
+        buckets = list(_buckets.items())
+    return dict((name, bucket.stats()) for name, bucket in buckets)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Settings of the app from config.conf.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+from splunk.clilib import cli_common as cli
+
+
+def get_stanza(name, defaults):
+    """Return a stanza of config.conf merged over its defaults.
+
+    Settings missing from the stanza, or the whole stanza when it can't be
+    read, take the default value. Values are kept as strings, the callers
+    convert them.
+
+    Parameters
+    ----------
+    name : str
+        The stanza name
+    defaults : dict
+        The default value of every setting
+    """
+    config = dict(defaults)
+    try:
+        config.update(cli.getConfStanza('config', name))
+    except Exception:
+        pass
+    return config
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Atomic replacement of the state files of the scripts.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import os
+import codec
+
+
+def write_json(path, obj):
+    """Write an object as JSON to a file, replacing it only once written.
+
+    Readers see either the previous content or the new one, never a
+    partially written file.
+
+    Parameters
+    ----------
+    path : str
+        The file to replace
+    obj : object
+        The object to serialize
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        codec.dump(obj, f)
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, path)
+    else:
+        # Python 2 can't rename over an existing file on Windows
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
@@ -15,11 +15,55 @@ Find more information about this on the LICENSE file.
 from log import log
 import time
 import datetime
-import jsonbak
-import requestsbak
+import codec
+import heapq
+import os
+import re
 import sys
-from jobs_queue import JobsQueue
+import threading
+from collections import OrderedDict
+from jobs_queue import JobsQueue, job_fingerprint, last_change
 from db import database
+from credentials_cache import get_credentials_cache
+from http_pool import get_session
+from admission import admit, BusyError, BACKGROUND
+from metrics import get_metrics
+from response_cache import signal_write
+from fan_out import fan_out
+from long_running import LongRunningProcess
+from app_config import get_stanza
+from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
+
+DEFAULT_CONFIG = {
+    'max_workers': '8',
+    'max_per_api': '2',
+    'job_timeout': '20',
+    'deadline': '60',
+    'max_jobs': '1000',
+    'mode': 'cron',
+    'poll_interval': '0.5',
+    'resync_interval': '60',
+    'coalesce_restarts': 'false'
+}
+
+# Restart of a single agent, which the API can also do in bulk
+RESTART_ENDPOINT = re.compile(r'^/agents/([0-9]+)/restart$')
+
+# Pidfile of the persistent scheduler
+PID_PATH = make_splunkhome_path(['var', 'run', 'splunk', 'SplunkAppForWazuh', 'check_queue.pid'])
+
+
+def get_queue_config():
+    """Return the [jobs_queue] stanza of config.conf merged with the defaults."""
+    return get_stanza('jobs_queue', DEFAULT_CONFIG)
+
+
+def percentile(values, q):
+    """Return the q-th percentile of a list of numbers, None if it's empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
 
 
 class CheckQueue():
@@ -28,21 +72,29 @@ class CheckQueue():
         """Constructor."""
         self.logger = log()
         self.now = time.time()  # Get the date in seconds
-        self.session = requestsbak.Session()
+        self.session = get_session()
         self.auth_key = sys.stdin.readline().strip()
         self.q = JobsQueue()
         self.db = database()
+        self.credentials = get_credentials_cache()
+        self.config = get_queue_config()
+        self.job_timeout = float(self.config['job_timeout'])
+        # Keys of the finished jobs not removed from the queue yet
+        self.finished = []
+        self.finished_lock = threading.Lock()
+        # Jobs running now, in total and by API, shared by the concurrent runs
+        self.running = 0
+        self.running_by_api = {}
+        self.slots = threading.Condition()
 
     def init(self):
         """Inits the jobs
         """
         try:
             self.logger.debug("bin.check_queue: Checking jobs queue.")
-            jobs = self.q.get_jobs(self.auth_key)
+            jobs = self.q.get_jobs(self.auth_key, due_before=self.now, limit=int(self.config['max_jobs']))
             todo_jobs = self.get_todo_jobs(jobs)
             self.check_todo_jobs(todo_jobs)
-            jobs = jsonbak.loads(jobs)
-            self.check_todo_jobs(jobs)
         except Exception as e:
             self.logger.error('bin.check_queue: Error at init in the CheckQueue module: {}'.format(e))
 
@@ -57,90 +109,314 @@ class CheckQueue():
 
         try:
             self.logger.debug("bin.check_queue: Gettings todo jobs.")
-            jobs = jsonbak.loads(jobs)
-            todo_jobs = filter(lambda j: j['done'] == False, jobs)
+            jobs = codec.loads(jobs)
+            todo_jobs = [j for j in jobs if j['done'] == False]
         except TypeError as e:
             todo_jobs = []
             self.logger.error('bin.check_queue: Error filtering the fields in the CheckQueue module: {}'.format(e))
         return todo_jobs
 
-    def check_todo_jobs(self, jobs):
-        """Check the to do jobs
+    def check_todo_jobs(self, jobs, now=None):
+        """Check the to do jobs, running the due ones concurrently.
+
+        Every job runs at most once per run, oldest first, and is removed from
+        the queue as soon as it finishes. Jobs with the same request run once,
+        and their copies are removed when it succeeds. Jobs of the same API
+        share `max_per_api` workers, and the jobs not finished when the run
+        deadline is reached are left for the next run. The limits hold across
+        the runs going on at the same time.
 
         Parameters
         ----------
         dic: jobs
             A dictionary with the todo jobs
+        float: now
+            The jobs due before it are run, the start of the run by default
         """
         try:
             self.logger.debug("bin.check_queue: Checking todo jobs.")
-            for job in jobs:
-                if job['exec_time'] < self.now:
-                    self.exec_job(job)
+            start = time.time()
+            now = self.now if now is None else now
+            deadline = start + float(self.config['deadline'])
+            due = sorted([job for job in jobs if job['exec_time'] < now], key=lambda job: job['exec_time'])
+            duplicates = {}
+            if str(self.config['coalesce_restarts']) == 'true':
+                due, duplicates = self.coalesce_restarts(due)
+            tasks = OrderedDict()
+            groups = {}
+            fingerprints = {}
+            for job in due:
+                key = job.get('_key')
+                if key in tasks:
+                    continue
+                fingerprint = self.get_job_fingerprint(job)
+                if fingerprint in fingerprints:
+                    duplicates.setdefault(fingerprints[fingerprint], []).append(key)
+                    continue
+                fingerprints[fingerprint] = key
+                tasks[key] = self.job_task(job, deadline, duplicates.setdefault(key, []))
+                groups[key] = self.get_job_api_id(job)
+            if not tasks:
+                return
+            results, errors = fan_out(
+                tasks,
+                max_workers=max(int(self.config['max_workers']), 1),
+                timeout=float(self.config['deadline']),
+                groups=groups,
+                max_per_group=max(int(self.config['max_per_api']), 1))
+            # Removals that failed while the jobs finished are tried again
+            self.remove_finished_jobs()
+            self.log_summary(results, errors, time.time() - start,
+                             sum(len(keys) for keys in duplicates.values()))
         except Exception as e:
             self.logger.error('bin.check_queue: Error checking to do jobs in the CheckQueue module: {}'.format(e))
 
+    def job_task(self, job, deadline, duplicates):
+        """Return a callable that runs a job and reports how it went.
+
+        Parameters
+        ----------
+        dic: job
+            A dictionary with the job
+        float: deadline
+            End of the run the job belongs to
+        list: duplicates
+            Keys of the jobs merged into this one
+        """
+        return lambda: self.run_job(job, deadline, duplicates)
+
+    def acquire_slot(self, api_id, deadline):
+        """Wait for a free worker for an API, return False if none is free by the deadline.
+
+        Parameters
+        ----------
+        str: api_id
+            The id of the API the job calls
+        float: deadline
+            When to give up
+        """
+        max_workers = max(int(self.config['max_workers']), 1)
+        max_per_api = max(int(self.config['max_per_api']), 1)
+        with self.slots:
+            while self.running >= max_workers or self.running_by_api.get(api_id, 0) >= max_per_api:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.slots.wait(min(remaining, 1))
+            self.running += 1
+            self.running_by_api[api_id] = self.running_by_api.get(api_id, 0) + 1
+            return True
+
+    def release_slot(self, api_id):
+        """Free the worker taken by a job.
+
+        Parameters
+        ----------
+        str: api_id
+            The id of the API the job called
+        """
+        with self.slots:
+            self.running -= 1
+            self.running_by_api[api_id] -= 1
+            if not self.running_by_api[api_id]:
+                del self.running_by_api[api_id]
+            self.slots.notify_all()
+
+    def run_job(self, job, deadline, duplicates=()):
+        """Run a job, returning its outcome, its delay and how long it took.
+
+        The job, and its duplicates when it succeeds, are removed from the
+        queue right away, so they don't run again if the run is interrupted.
+
+        Parameters
+        ----------
+        dic: job
+            A dictionary with the job
+        float: deadline
+            End of the run the job belongs to
+        list: duplicates
+            Keys of the jobs merged into this one
+        """
+        api_id = self.get_job_api_id(job)
+        if not self.acquire_slot(api_id, deadline):
+            self.logger.info('bin.check_queue: Job postponed to the next run: no free worker for API {}.'.format(api_id))
+            return 'postponed', time.time() - job['exec_time'], 0.0
+        start = time.time()
+        try:
+            outcome = 'done' if self.exec_job(job) is not None else 'removed'
+        except BusyError as e:
+            outcome = 'postponed'
+            self.logger.info('bin.check_queue: Job postponed to the next run: {}'.format(e))
+        except Exception as e:
+            outcome = 'failed'
+            self.logger.error('bin.check_queue: Error executing the job in CheckQueue module: {}'.format(e))
+        finally:
+            self.release_slot(api_id)
+        if outcome == 'done':
+            for duplicate in duplicates:
+                self.finish_job(duplicate)
+        self.remove_finished_jobs()
+        return outcome, start - job['exec_time'], time.time() - start
+
+    def log_summary(self, results, errors, elapsed, merged=0):
+        """Log the throughput and latency of a run.
+
+        Parameters
+        ----------
+        dict: results
+            Outcome, delay and duration of the finished jobs, by key
+        dict: errors
+            The jobs not finished in time, by key
+        float: elapsed
+            Duration of the run in seconds
+        int: merged
+            Jobs not run because they were merged into another one
+        """
+        outcomes = {'done': 0, 'removed': 0, 'postponed': 0, 'failed': 0}
+        durations = []
+        delays = []
+        for outcome, delay, duration in results.values():
+            outcomes[outcome] += 1
+            durations.append(duration)
+            delays.append(delay)
+        self.logger.info(
+            "bin.check_queue: Run finished: %s jobs due, %s merged, %s done, %s failed, %s postponed, %s removed, "
+            "%s timed out in %.2f seconds (%.1f jobs/s). Job duration p50 %.2f s, p95 %.2f s. "
+            "Started %.2f s after exec_time on average." % (
+                len(results) + len(errors) + merged, merged, outcomes['done'], outcomes['failed'], outcomes['postponed'],
+                outcomes['removed'], len(errors), elapsed, len(results) / elapsed if elapsed else 0.0,
+                percentile(durations, 0.5) or 0.0, percentile(durations, 0.95) or 0.0,
+                sum(delays) / len(delays) if delays else 0.0))
+
+    def coalesce_restarts(self, jobs):
+        """Merge the due restarts of single agents of every API into a bulk restart.
+
+        Returns the jobs to run, sorted by exec_time, and the keys of the
+        restarts merged into every bulk restart, by the key of the latter.
+
+        Parameters
+        ----------
+        list: jobs
+            The due jobs, sorted by exec_time
+        """
+        restarts = OrderedDict()
+        to_run = []
+        for job in jobs:
+            req = job.get('job')
+            match = RESTART_ENDPOINT.match(str(req.get('endpoint', ''))) if isinstance(req, dict) else None
+            if match and str(req.get('method', 'GET')).upper() == 'PUT':
+                restarts.setdefault(self.get_job_api_id(job), []).append((match.group(1), job))
+            else:
+                to_run.append(job)
+        merged = {}
+        for api_id, items in restarts.items():
+            if len(items) == 1:
+                to_run.append(items[0][1])
+                continue
+            first = items[0][1]
+            ids = sorted(set(agent_id for agent_id, job in items))
+            self.logger.debug("bin.check_queue: Restarting %s agents of API %s at once." % (len(ids), api_id))
+            to_run.append({
+                '_key': first['_key'],
+                'job': {'apiId': api_id, 'endpoint': '/agents/restart', 'method': 'POST', 'ids': ids},
+                'exec_time': first['exec_time'],
+                'done': False
+            })
+            merged[first['_key']] = [job['_key'] for agent_id, job in items[1:]]
+        to_run.sort(key=lambda job: job['exec_time'])
+        return to_run, merged
+
+    def get_job_fingerprint(self, job):
+        """Return the fingerprint of the request of a job, its key if it's malformed.
+
+        Parameters
+        ----------
+        dic: job
+            A dictionary with the job
+        """
+        if job.get('fingerprint'):
+            return job['fingerprint']
+        try:
+            return job_fingerprint(job['job'])
+        except Exception:
+            return job.get('_key')
+
+    def get_job_api_id(self, job):
+        """Return the id of the API a job calls.
+
+        Parameters
+        ----------
+        dic: job
+            A dictionary with the job
+        """
+        req = job.get('job') or {}
+        return req.get('id', req.get('apiId'))
+
     def exec_job(self, job):
         """Exec the passed job
 
+        Returns the API response, or None if the job was removed because
+        its API is gone. Raises an exception when the job failed.
+
         Parameters
         ----------
         dic: job
             A dictionary with the job
         """
+        self.logger.debug("bin.check_queue: Executing job.")
+        req = job['job']
+        method = 'GET'
+
+        # Checks if are missing params
+        if ('id' not in req and 'apiId' not in req) or 'endpoint' not in req:
+            raise Exception('Missing ID or endpoint')
+        if 'method' in req.keys() and req['method'] != 'GET':
+            method = req['method']
+            del req['method']
+
+        api_id = 0
+        if 'id' in req:
+            api_id = req['id']
+        elif 'apiId' in req:
+            api_id = req['apiId']
+        else:
+            raise Exception('Missing API ID')
         try:
-            self.logger.debug("bin.check_queue: Executing job.")
-            req = job['job']
-            method = 'GET'
-
-            # Checks if are missing params
-            if ('id' not in req and 'apiId' not in req) or 'endpoint' not in req:
-                raise Exception('Missing ID or endpoint')
-            if 'method' in req.keys() and req['method'] != 'GET':
-                method = req['method']
-                del req['method']
-            
-            api_id = 0
-            if 'id' in req:
-                api_id = req['id']
-            elif 'apiId' in req:
-                api_id = req['apiId']
-            else:
-                raise Exception('Missing API ID')
-            try:
-                url, auth, verify = self.get_api_credentials(api_id)
-            except Exception as e:
-                self.logger.error("bin.check_queue: Error executing the job, job will be deleted from the queue. Reason: {}".format(e))
-                self.remove_job(job['_key'])
-                return 
-            endpoint = req['endpoint']
-
-            # Checks methods
-            if method == 'GET':
-                request = self.session.get(
-                    url + endpoint, params=req, auth=auth,
-                    verify=verify).json()
-            if method == 'POST':
-                request = self.session.post(
-                    url + endpoint, data=req, auth=auth,
-                    verify=verify).json()
-            if method == 'PUT':
-                request = self.session.put(
-                    url + endpoint, data=req, auth=auth,
-                    verify=verify).json()
-            if method == 'DELETE':
-                request = self.session.delete(
-                    url + endpoint, data=req, auth=auth,
-                    verify=verify).json()
-
-            if request['error'] == 0:
-                # self.mark_as_done(job)
-                self.remove_job(job['_key'])
-            else:
-                raise Exception('Job cannot be executed properly.')
-            return request
+            url, auth, verify = self.get_api_credentials(api_id)
         except Exception as e:
-            self.logger.error('bin.check_queue: Error executing the job in CheckQueue module: {}'.format(e))
+            self.logger.error("bin.check_queue: Error executing the job, job will be deleted from the queue. Reason: {}".format(e))
+            self.finish_job(job['_key'])
+            return
+        endpoint = req['endpoint']
+        admit(url, BACKGROUND)
+
+        # Checks methods
+        if method == 'GET':
+            request = self.session.get(
+                url + endpoint, params=req, auth=auth,
+                timeout=self.job_timeout, verify=verify).json()
+        if method == 'POST':
+            request = self.session.post(
+                url + endpoint, data=req, auth=auth,
+                timeout=self.job_timeout, verify=verify).json()
+        if method == 'PUT':
+            request = self.session.put(
+                url + endpoint, data=req, auth=auth,
+                timeout=self.job_timeout, verify=verify).json()
+        if method == 'DELETE':
+            request = self.session.delete(
+                url + endpoint, data=req, auth=auth,
+                timeout=self.job_timeout, verify=verify).json()
+        if method != 'GET':
+            # The app server drops what it cached from this API
+            signal_write(api_id)
+
+        if request['error'] == 0:
+            # self.mark_as_done(job)
+            self.finish_job(job['_key'])
+        else:
+            raise Exception('Job cannot be executed properly.')
+        return request
 
     def mark_as_done(self, job):
         """Update the job and mark as done.
@@ -157,6 +433,36 @@ class CheckQueue():
         except Exception as e:
             self.logger.error('bin.check_queue: Error updating the job in CheckQueue module: {}'.format(e))
 
+    def finish_job(self, job_key):
+        """Mark a job to be removed from the queue.
+
+        Parameters
+        ----------
+        str: job_key
+            The job key in the kvStore
+        """
+        with self.finished_lock:
+            self.finished.append(job_key)
+
+    def remove_finished_jobs(self):
+        """Remove the jobs finished so far from the queue in a single request.
+
+        When the request fails the keys are kept to be removed with the next
+        finished jobs.
+        """
+        with self.finished_lock:
+            keys = self.finished
+            self.finished = []
+        if not keys:
+            return
+        try:
+            self.logger.debug("bin.check_queue: Removing %s finished jobs." % len(keys))
+            self.q.remove_jobs(keys, self.auth_key)
+        except Exception as e:
+            self.logger.error('bin.check_queue: Error removing the finished jobs in CheckQueue module: {}'.format(e))
+            with self.finished_lock:
+                self.finished.extend(keys)
+
     def remove_job(self, job_key):
         """Remove the job of the queue.
 
@@ -181,30 +487,170 @@ class CheckQueue():
         """
         try:
             self.logger.debug("bin.check_queue: Getting API credentials.")
-            api = self.db.get(api_id, self.auth_key)
-            api = jsonbak.loads(api)
-            if "data" in api and "messages" in api["data"] and api["data"]["messages"][0] and "type" in api["data"]["messages"][0] and api["data"]["messages"][0]["type"] == "ERROR":
-                raise Exception('API does not exist')
-            elif api:
-                opt_username = api['data']["userapi"]
-                opt_password = api['data']["passapi"]
-                opt_base_url = api['data']["url"]
-                opt_base_port = api['data']["portapi"]
-                url = str(opt_base_url) + ":" + str(opt_base_port)
-                auth = requestsbak.auth.HTTPBasicAuth(
-                    opt_username, opt_password)
-                verify = False
-                return url, auth, verify
-            else:
-                raise Exception('API not found')
+            api, url, auth = self.credentials.get(api_id, self.auth_key)
+            verify = False
+            return url, auth, verify
         except Exception as e:
             raise e
 
 
+class Scheduler(LongRunningProcess):
+    """Run the queued jobs on time from a single long-running process.
+
+    The pending jobs due before the next resync are kept in a heap ordered
+    by exec_time, and the scheduler sleeps until the earliest one. Added
+    jobs are noticed through the change signal of the jobs queue. The heap
+    is rebuilt from the KV store every `resync_interval` seconds, which is
+    also how often a failed job is tried again.
+
+    The due jobs run in a background thread, so the heap and the change
+    signal keep being serviced while they run. Jobs still running are left
+    out of the heap until their run finishes.
+    """
+
+    name = 'bin.check_queue'
+
+    def __init__(self, check_queue, clock=time.time):
+        """Constructor.
+
+        Parameters
+        ----------
+        CheckQueue: check_queue
+            Runs the jobs and keeps the connections between runs
+        callable: clock
+            Returns the current timestamp
+        """
+        LongRunningProcess.__init__(self, PID_PATH)
+        self.cq = check_queue
+        self.clock = clock
+        self.config = check_queue.config
+        self.poll_interval = float(self.config['poll_interval'])
+        self.resync_interval = float(self.config['resync_interval'])
+        self.heap = []
+        self.version = None
+        self.next_resync = 0
+        # Last run of the jobs still in the queue, by key
+        self.ran = {}
+        # Keys of the jobs being run, and the threads running them
+        self.running = set()
+        self.threads = []
+        self.running_lock = threading.Lock()
+        # Set when a run finishes, to save the metrics from the main thread
+        self.run_finished = threading.Event()
+
+    def load(self):
+        """Rebuild the heap with the pending jobs due before the next resync."""
+        # Read before the query, so a job added meanwhile triggers another load
+        self.version = last_change()
+        now = self.clock()
+        self.next_resync = now + self.resync_interval
+        jobs = self.cq.get_todo_jobs(self.cq.q.get_jobs(
+            self.cq.auth_key, due_before=self.next_resync, limit=int(self.config['max_jobs'])))
+        self.ran = dict((key, ran) for key, ran in self.ran.items() if ran + self.resync_interval > now)
+        with self.running_lock:
+            running = set(self.running)
+        heap = []
+        for index, job in enumerate(jobs):
+            if job.get('_key') in running:
+                continue
+            exec_time = job['exec_time']
+            if job.get('_key') in self.ran:
+                exec_time = max(exec_time, self.ran[job['_key']] + self.resync_interval)
+            heap.append((exec_time, index, job))
+        heapq.heapify(heap)
+        self.heap = heap
+        self.logger.debug("bin.check_queue: %s jobs scheduled." % len(heap))
+
+    def run_due(self):
+        """Start running the jobs whose time has come in a background thread."""
+        now = self.clock()
+        due = []
+        while self.heap and self.heap[0][0] < now:
+            due.append(heapq.heappop(self.heap)[2])
+        if not due:
+            return
+        keys = set(job.get('_key') for job in due)
+        with self.running_lock:
+            self.running.update(keys)
+        for key in keys:
+            self.ran[key] = now
+        thread = threading.Thread(target=self.run_jobs, args=(due, now, keys))
+        thread.daemon = True
+        thread.start()
+        self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+
+    def run_jobs(self, jobs, now, keys):
+        """Run a batch of due jobs.
+
+        Parameters
+        ----------
+        list: jobs
+            The due jobs
+        float: now
+            When the jobs were taken from the heap
+        set: keys
+            The keys of the jobs
+        """
+        try:
+            self.cq.check_todo_jobs(jobs, now)
+        finally:
+            with self.running_lock:
+                self.running.difference_update(keys)
+            self.run_finished.set()
+
+    def save_metrics(self):
+        """Save the metrics if a run finished since the last time."""
+        if not self.run_finished.is_set():
+            return
+        self.run_finished.clear()
+        try:
+            get_metrics().save('check_queue')
+        except Exception as e:
+            self.logger.error('bin.check_queue: Error saving metrics in CheckQueue module: {}'.format(e))
+
+    def tick(self):
+        """Reload the queue if needed and start the due jobs, return the seconds to sleep."""
+        if self.clock() >= self.next_resync or last_change() != self.version:
+            try:
+                self.load()
+            except Exception as e:
+                self.logger.error('bin.check_queue: Error loading the jobs queue: {}'.format(e))
+        self.run_due()
+        self.save_metrics()
+        next_time = min(self.heap[0][0], self.next_resync) if self.heap else self.next_resync
+        return min(max(next_time - self.clock(), 0), self.poll_interval)
+
+    def run(self):
+        """Run the jobs until splunkd stops the scheduler."""
+        if not self.lock():
+            self.logger.debug("bin.check_queue: Another scheduler is running.")
+            return
+        self.handle_signals()
+        self.logger.info("bin.check_queue: Scheduler started with pid %s." % os.getpid())
+        try:
+            while not self.stop.is_set():
+                self.wait(self.tick())
+        finally:
+            # Let the runs going on finish, up to their deadline
+            end = time.time() + float(self.config['deadline'])
+            for thread in self.threads:
+                thread.join(max(end - time.time(), 0))
+            self.unlock()
+            self.logger.info("bin.check_queue: Scheduler stopped.")
+
+
 if __name__ == '__main__':
     try:
         cq = CheckQueue()
-        cq.init()
+        if cq.config['mode'] == 'persistent' and os.name == 'posix':
+            Scheduler(cq).run()
+        else:
+            cq.init()
     except Exception as e:
         log().error(
             'Error at main function in CheckQueue module: {}'.format(e))
+    try:
+        get_metrics().save('check_queue')
+    except Exception as e:
+        log().error(
+            'Error saving metrics in CheckQueue module: {}'.format(e))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - JSON codec.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import json
+import jsonbak
+from jsonbak.encoder import c_make_encoder, encode_basestring_ascii, INFINITY
+from jsonbak.scanner import c_make_scanner
+from app_config import get_stanza
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+DEFAULT_CONFIG = {
+    'backend': 'auto'
+}
+
+
+def json_accelerated():
+    """Check if the standard library json module uses its C scanner and encoder."""
+    return json.scanner.c_make_scanner is not None and json.encoder.c_make_encoder is not None
+
+
+def available_backends():
+    """Return the names of the backends that can be used, from fastest to slowest."""
+    available = []
+    if orjson is not None:
+        available.append('orjson')
+    if ujson is not None:
+        available.append('ujson')
+    if json_accelerated():
+        available.append('json')
+    available.append('jsonbak')
+    return available
+
+
+def orjson_loads(s):
+    """Parse a JSON document with orjson."""
+    return orjson.loads(s)
+
+
+def orjson_dumps(obj):
+    """Serialize an object with orjson, which returns bytes."""
+    try:
+        return orjson.dumps(obj).decode('utf-8')
+    except TypeError:
+        # Non string keys or integers wider than 64 bits
+        return json.dumps(obj)
+
+
+def ujson_loads(s):
+    """Parse a JSON document with ujson."""
+    return ujson.loads(s)
+
+
+def ujson_dumps(obj):
+    """Serialize an object with ujson, keeping slashes unescaped like json."""
+    return ujson.dumps(obj, escape_forward_slashes=False)
+
+
+IMPLEMENTATIONS = {
+    'orjson': (orjson_loads, orjson_dumps),
+    'ujson': (ujson_loads, ujson_dumps),
+    'json': (json.loads, json.dumps),
+    'jsonbak': (jsonbak.loads, jsonbak.dumps)
+}
+
+
+def select_backend():
+    """Return the configured backend, or the fastest available one."""
+    config = get_stanza('codec', DEFAULT_CONFIG)
+    available = available_backends()
+    if config['backend'] in available:
+        return config['backend']
+    return available[0]
+
+
+_backend = select_backend()
+_loads, _dumps = IMPLEMENTATIONS[_backend]
+
+
+def backend_info():
+    """Return the active backend and whether it runs native code."""
+    return {
+        'backend': _backend,
+        'accelerated': _backend != 'jsonbak' or (c_make_scanner is not None and c_make_encoder is not None),
+        'available': available_backends()
+    }
+
+
+def loads(s, **kwargs):
+    """Parse a JSON document.
+
+    Parameters
+    ----------
+    s : str or bytes
+        The JSON document
+    kwargs : dict
+        Options of json.loads, they force the jsonbak backend
+    """
+    if kwargs:
+        return jsonbak.loads(s, **kwargs)
+    return _loads(s)
+
+
+def dumps(obj, **kwargs):
+    """Serialize an object to a JSON string.
+
+    The layout depends on the backend: orjson and ujson write compact JSON,
+    and orjson writes NaN and Infinity as null. Use dumps_compatible when the
+    text must be the one json.dumps writes.
+
+    Parameters
+    ----------
+    obj : object
+        The object to serialize
+    kwargs : dict
+        Options of json.dumps, they force the jsonbak backend
+    """
+    if kwargs:
+        return jsonbak.dumps(obj, **kwargs)
+    return _dumps(obj)
+
+
+def dumps_compatible(obj):
+    """Serialize an object to the same JSON string json.dumps returns.
+
+    Used where the text itself is shown or compared, like the cells of the
+    CSV exports, so it doesn't change with the backend.
+
+    Parameters
+    ----------
+    obj : object
+        The object to serialize
+    """
+    if _backend in ('orjson', 'ujson'):
+        return json.dumps(obj)
+    return _dumps(obj)
+
+
+def load(fp):
+    """Parse a JSON document from a file."""
+    return loads(fp.read())
+
+
+def dump(obj, fp):
+    """Serialize an object as JSON to a file."""
+    fp.write(dumps(obj))
+
+
+def encode_value(value):
+    """Encode a value of a record, using shortcuts for strings, numbers, booleans and null."""
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, int):
+        return '%d' % value
+    if isinstance(value, float) and value == value and value not in (INFINITY, -INFINITY):
+        return float.__repr__(value)
+    return _dumps(value)
+
+
+def dumps_records(records):
+    """Serialize every record of a list, returning one JSON string per record.
+
+    orjson and ujson are faster per record; with json and jsonbak, reusing
+    the encoded keys beats calling the encoder for every record.
+
+    Parameters
+    ----------
+    records : list
+        The dicts to serialize
+    """
+    if _backend in ('orjson', 'ujson'):
+        return [_dumps(record) for record in records]
+    return encode_flat_records(records)
+
+
+def encode_flat_records(records):
+    """Serialize a list of flat dicts, one JSON string per record.
+
+    Agents, rules and most Wazuh API items are flat dicts sharing the same
+    keys, so the encoded keys of each key layout are reused and only the
+    values are encoded. Nested values use the generic encoder.
+
+    Parameters
+    ----------
+    records : list
+        The dicts to serialize
+    """
+    layouts = {}
+    output = []
+    for record in records:
+        keys = tuple(record)
+        prefixes = layouts.get(keys)
+        if prefixes is None:
+            if not all(isinstance(key, str) for key in keys):
+                output.append(_dumps(record))
+                continue
+            prefixes = layouts[keys] = [
+                ('{' if i == 0 else ', ') + encode_basestring_ascii(key) + ': '
+                for i, key in enumerate(keys)]
+        if prefixes:
+            output.append(''.join(
+                [prefix + encode_value(record[key]) for prefix, key in zip(prefixes, keys)]) + '}')
+        else:
+            output.append('{}')
+    return output
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Compliance requirements service.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+import time
+import codec
+from response_cache import written_since
+from requirements import pci_requirements, gdpr_requirements, hipaa_requirements, nist_requirements
+
+# Wazuh API endpoint and descriptions table of every framework
+FRAMEWORKS = {
+    'pci': ('/rules/pci', pci_requirements.pci),
+    'gdpr': ('/rules/gdpr', gdpr_requirements.gdpr),
+    'hipaa': ('/rules/hipaa', hipaa_requirements.hipaa),
+    'nist': ('/rules/nist-800-53', nist_requirements.nist)
+}
+
+DEFAULT_TTL = 300
+
+
+class ComplianceService():
+    """Serve the compliance requirements used by the ruleset of each manager.
+
+    The requirements of every framework are requested once per API and kept
+    as serialized JSON until the TTL expires or the ruleset of the API may
+    have changed, also through a write signaled by another process.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        """Constructor."""
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.static = dict(
+            (name, codec.dumps(table)) for name, (endpoint, table) in FRAMEWORKS.items())
+
+    def all_descriptions(self, framework):
+        """Return the serialized descriptions of every requirement of a framework.
+
+        Parameters
+        ----------
+        framework : str
+            pci, gdpr, hipaa or nist
+        """
+        return self.static[framework]
+
+    def describe(self, framework, requirement):
+        """Return the description of a requirement or None if it's unknown.
+
+        Parameters
+        ----------
+        framework : str
+            pci, gdpr, hipaa or nist
+        requirement : str
+            The requirement id
+        """
+        return FRAMEWORKS[framework][1].get(requirement)
+
+    def load(self, api_id, fetch):
+        """Request the requirements of every framework used by the API ruleset.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        fetch : callable
+            Receives a Wazuh API endpoint and returns the parsed response
+        """
+        frameworks = {}
+        for name, (endpoint, table) in FRAMEWORKS.items():
+            response = fetch(endpoint)
+            if response['error'] != 0:
+                return codec.dumps({'error': response['error']}), None
+            frameworks[name] = dict(
+                (item, table[item]) for item in response['data']['items'] if item in table)
+        now = time.time()
+        entry = {
+            'loaded': now,
+            'expires': now + self.ttl,
+            'all': codec.dumps(frameworks),
+            'frameworks': dict((name, codec.dumps(value)) for name, value in frameworks.items())
+        }
+        with self.lock:
+            self.entries[api_id] = entry
+        return None, entry
+
+    def get_entry(self, api_id, fetch):
+        """Return the cached entry of an API, loading it when needed."""
+        with self.lock:
+            entry = self.entries.get(api_id)
+        if entry is not None and entry['expires'] > time.time() and not written_since(api_id, entry['loaded']):
+            return None, entry
+        return self.load(api_id, fetch)
+
+    def requirements(self, api_id, framework, fetch):
+        """Return the serialized requirements of a framework used by the API ruleset.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        framework : str
+            pci, gdpr, hipaa or nist
+        fetch : callable
+            Receives a Wazuh API endpoint and returns the parsed response
+        """
+        error, entry = self.get_entry(api_id, fetch)
+        return error if error else entry['frameworks'][framework]
+
+    def all_requirements(self, api_id, fetch):
+        """Return the serialized requirements of every framework used by the API ruleset.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        fetch : callable
+            Receives a Wazuh API endpoint and returns the parsed response
+        """
+        error, entry = self.get_entry(api_id, fetch)
+        return error if error else entry['all']
+
+    def invalidate(self, api_id=None):
+        """Forget the requirements of an API, or of every API when no id is given.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        """
+        with self.lock:
+            if api_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(api_id, None)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_compliance_service():
+    """Return the process wide compliance service."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = ComplianceService()
+    return _service
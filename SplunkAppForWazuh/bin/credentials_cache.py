@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Wazuh API credentials cache.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+import time
+import codec
+import requestsbak
+from db import database
+from log import log
+from metrics import get_metrics
+from app_config import get_stanza
+
+DEFAULT_TTL = 60
+
+
+class CredentialsCache():
+    """Keep the Wazuh API entries of the KV store in memory.
+
+    Entries are read again from the KV store once their TTL expires, so
+    changes made from other search heads are eventually picked up. The
+    manager controller invalidates them explicitly when an API is added,
+    updated or removed.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        """Constructor."""
+        self.logger = log()
+        self.db = database()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.reads = 0
+
+    def get(self, api_id, session_key=False):
+        """Return the API entry, its url and its auth object.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        session_key : str
+            The authorized session key
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(api_id)
+            if entry is not None and entry['expires'] > now:
+                return entry['api'], entry['url'], entry['auth']
+        self.logger.debug("bin.credentials_cache: Reading API %s from the KV store." % api_id)
+        api = codec.loads(self.db.get(api_id, session_key))
+        with self.lock:
+            self.reads += 1
+        if not api or 'data' not in api:
+            raise Exception('API not found')
+        data = api['data']
+        if "messages" in data and data["messages"] and "type" in data["messages"][0] and data["messages"][0]["type"] == "ERROR":
+            raise Exception('API does not exist')
+        url = str(data["url"]) + ":" + str(data["portapi"])
+        auth = requestsbak.auth.HTTPBasicAuth(data["userapi"], data["passapi"])
+        get_metrics().register_api(url, api_id)
+        with self.lock:
+            self.entries[api_id] = {
+                'api': data, 'url': url, 'auth': auth, 'expires': now + self.ttl}
+        return data, url, auth
+
+    def invalidate(self, api_id=None):
+        """Forget an API entry, or every entry when no id is given.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        """
+        with self.lock:
+            if api_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(api_id, None)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_credentials_cache():
+    """Return the process wide credentials cache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = get_stanza('cache', {'credentials_ttl': DEFAULT_TTL})
+                _cache = CredentialsCache(int(config['credentials_ttl']))
+    return _cache
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Wazuh daemons readiness state.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+import time
+from log import log
+from single_flight import get_single_flight
+from app_config import get_stanza
+
+DEFAULT_CONFIG = {
+    'ttl': '10',
+    'not_ready_ttl': '2',
+    'refresh_interval': '5',
+    'idle_timeout': '300'
+}
+
+# Endpoints that restart the daemons of the manager when requested with PUT
+RESTART_ENDPOINTS = ('/manager/restart', '/cluster/restart')
+
+
+def is_restart_endpoint(endpoint):
+    """Check if an endpoint restarts the Wazuh daemons.
+
+    Parameters
+    ----------
+    endpoint : str
+        The Wazuh API endpoint
+    """
+    endpoint = endpoint.split('?')[0].rstrip('/')
+    return endpoint in RESTART_ENDPOINTS or (endpoint.startswith('/cluster/') and endpoint.endswith('/restart'))
+
+
+def probe_daemons(session, url, auth, verify, check_cluster, timeout):
+    """Request the status of this daemons: execd, modulesd, wazuhdb and clusterd
+
+    Parameters
+    ----------
+    session : requestsbak.Session
+    url: str
+    auth: str
+    verify: str
+    check_cluster: bool
+    timeout: int
+    """
+    request_cluster = session.get(
+        url + '/cluster/status', auth=auth, timeout=timeout, verify=verify).json()
+    # Try to get cluster is enabled if the request fail set to false
+    try:
+        cluster_enabled = request_cluster['data']['enabled'] == 'yes'
+    except Exception:
+        cluster_enabled = False
+    cc = check_cluster and cluster_enabled  # Var to check the cluster demon or not
+    daemons_status = session.get(
+        url + '/manager/status', auth=auth, timeout=timeout,
+        verify=verify).json()
+    if daemons_status['error']:
+        return False
+    d = daemons_status['data']
+    daemons = {"execd": d['ossec-execd'], "modulesd": d['wazuh-modulesd'], "db": d['wazuh-db']}
+    if cc:
+        daemons['clusterd'] = d['wazuh-clusterd']
+    values = list(daemons.values())
+    # Checks all the status are equals, and running
+    return len(set(values)) == 1 and values[0] == "running"
+
+
+class DaemonsState():
+    """Keep the daemons readiness of every Wazuh API.
+
+    The state of each API is probed on demand the first time and then kept
+    fresh by a background thread while the API keeps being used.
+    """
+
+    def __init__(self, ttl=10, not_ready_ttl=2, refresh_interval=5, idle_timeout=300):
+        """Constructor."""
+        self.logger = log()
+        self.ttl = ttl
+        self.not_ready_ttl = not_ready_ttl
+        self.refresh_interval = refresh_interval
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.thread = None
+
+    def is_ready(self, session, url, auth, verify, check_cluster, timeout):
+        """Return the readiness of an API, probing it when the state is stale.
+
+        Parameters
+        ----------
+        session : requestsbak.Session
+        url: str
+        auth: str
+        verify: str
+        check_cluster: bool
+        timeout: int
+        """
+        key = (url, bool(check_cluster))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['last_used'] = now
+                if entry['expires'] > now:
+                    return entry['ready']
+        ready = get_single_flight().do(
+            ('daemons',) + key,
+            lambda: probe_daemons(session, url, auth, verify, check_cluster, timeout))
+        self.store(key, ready, {
+            'session': session, 'auth': auth, 'verify': verify, 'timeout': timeout})
+        self.start_refresher()
+        return ready
+
+    def store(self, key, ready, probe_args):
+        """Save the result of a probe.
+
+        Parameters
+        ----------
+        key : tuple
+            The (url, check_cluster) tuple
+        ready : bool
+            The daemons readiness
+        probe_args : dict
+            Arguments needed to probe the API again
+        """
+        now = time.time()
+        ttl = self.ttl if ready else self.not_ready_ttl
+        with self.lock:
+            entry = self.entries.get(key)
+            last_used = entry['last_used'] if entry else now
+            self.entries[key] = {
+                'ready': ready, 'expires': now + ttl, 'last_used': last_used,
+                'probe_args': probe_args}
+
+    def mark_stale(self, url):
+        """Force the next check of an API to probe the daemons again.
+
+        Parameters
+        ----------
+        url : str
+            The API url
+        """
+        with self.lock:
+            for key, entry in self.entries.items():
+                if key[0] == url:
+                    entry['expires'] = 0
+
+    def start_refresher(self):
+        """Start the background refresh thread if it's not running."""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.refresh_loop, name='wazuh-daemons-state')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def refresh_loop(self):
+        """Refresh the entries about to expire and forget the idle ones."""
+        while True:
+            time.sleep(self.refresh_interval)
+            now = time.time()
+            to_refresh = []
+            with self.lock:
+                for key in list(self.entries.keys()):
+                    entry = self.entries[key]
+                    if now - entry['last_used'] > self.idle_timeout:
+                        del self.entries[key]
+                    elif entry['expires'] - now < self.refresh_interval:
+                        to_refresh.append((key, entry['probe_args']))
+            for key, args in to_refresh:
+                try:
+                    ready = probe_daemons(
+                        args['session'], key[0], args['auth'], args['verify'], key[1], args['timeout'])
+                    self.store(key, ready, args)
+                except Exception as e:
+                    self.logger.debug("bin.daemons_state: Error refreshing daemons state of %s: %s" % (key[0], e))
+                    self.mark_stale(key[0])
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_daemons_state():
+    """Return the process wide daemons state, reading the [daemons_check] stanza the first time."""
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                config = get_stanza('daemons_check', DEFAULT_CONFIG)
+                _state = DaemonsState(
+                    ttl=float(config['ttl']),
+                    not_ready_ttl=float(config['not_ready_ttl']),
+                    refresh_interval=float(config['refresh_interval']),
+                    idle_timeout=float(config['idle_timeout']))
+    return _state
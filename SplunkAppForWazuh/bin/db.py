@@ -9,19 +9,18 @@
 #
 # Find more information about this on the LICENSE file.
 #
-import jsonbak
-import requestsbak
+import codec
 import os
 from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
 from log import log
+from http_pool import get_session, SPLUNKD
 import splunk
 from splunk import entity, rest
 
 class database():
     def __init__(self):
         self.logger = log()
-        self.session = requestsbak.Session()
-        self.session.trust_env = False
+        self.session = get_session(SPLUNKD)
         self.kvstoreUri = entity.buildEndpoint(
             entityClass=["storage", "collections", "data"],
             entityName="credentials",
@@ -67,10 +66,10 @@ class database():
                 raise Exception('Missing Key')
             id = obj['_key']
             del obj['_key']
-            obj = jsonbak.dumps(obj)
+            obj = codec.dumps(obj)
             kvstoreUri = self.kvstoreUri+'/'+id+'?output_mode=json'
             result = self.session.post(kvstoreUri, data=obj, headers={"Authorization": "Splunk %s" % splunk.getSessionKey(), "Content-Type": "application/json"}, verify=False).json()
-            parsed_result = jsonbak.dumps({'data': result})
+            parsed_result = codec.dumps({'data': result})
             return parsed_result
         except Exception as e:
             self.logger.error("Error updating in DB module: %s" % (e))
@@ -92,9 +91,9 @@ class database():
             kvstoreUri = self.kvstoreUri+'/'+str(_key)+'?output_mode=json'
             result = self.session.delete(kvstoreUri,headers={"Authorization": "Splunk %s" % splunk.getSessionKey(), "Content-Type": "application/json"}, verify=False)
             if result.status_code == 200:
-                parsed_result = jsonbak.dumps({'data': 'API removed.'})
+                parsed_result = codec.dumps({'data': 'API removed.'})
             else:
-                msg = jsonbak.loads(result.text)
+                msg = codec.loads(result.text)
                 text = msg['messages'][0]['text']
                 raise Exception(text)
             return parsed_result
@@ -108,10 +107,10 @@ class database():
             kvstoreUri = self.kvstoreUri+'?output_mode=json'
             auth_key = session_key if session_key else splunk.getSessionKey()
             result = self.session.get(kvstoreUri, headers={"Authorization": "Splunk %s" % auth_key, "Content-Type": "application/json"}, verify=False).json()
-            return jsonbak.dumps(result)
+            return codec.dumps(result)
         except Exception as e:
             self.logger.error('Error returning all API rows in DB module: %s ' % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
 
     def get(self, id, session_key=False):
         try:
@@ -121,7 +120,7 @@ class database():
             kvstoreUri = self.kvstoreUri+'/'+id+'?output_mode=json'
             auth_key = session_key if session_key else splunk.getSessionKey()
             result = self.session.get(kvstoreUri,headers={"Authorization": "Splunk %s" % auth_key, "Content-Type": "application/json"}, verify=False).json()
-            parsed_result = jsonbak.dumps({'data': result})
+            parsed_result = codec.dumps({'data': result})
         except Exception as e:
             self.logger.error("Error getting an API in DB module : %s" % (e))
             raise e
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Batched output of the events of the scripted inputs.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import gzip
+import io
+import sys
+import threading
+import time
+from collections import deque
+import codec
+from log import log
+from http_pool import get_session, SPLUNKD
+from retry_policy import RetryPolicy
+from requestsbak.exceptions import ConnectionError, Timeout
+from app_config import get_stanza
+
+DEFAULT_CONFIG = {
+    'output': 'stdout',
+    'flush_bytes': '1048576',
+    'url': 'https://localhost:8088',
+    'token': '',
+    'index': 'wazuh-monitoring-3x',
+    'source': '',
+    'sourcetype': '_json',
+    'verify': 'false',
+    'gzip': 'true',
+    'batch_bytes': '1048576',
+    'max_pending': '8',
+    'max_attempts': '5',
+    'timeout': '10'
+}
+
+# HEC answers these statuses when it's overloaded or restarting
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class StdoutWriter():
+    """Write events to stdout, one JSON object per line, in large blocks."""
+
+    def __init__(self, stream=None, flush_bytes=1048576):
+        """Constructor."""
+        self.stream = stream if stream is not None else sys.stdout
+        self.flush_bytes = flush_bytes
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.size = 0
+
+    def write_records(self, records, timeout=None):
+        """Serialize a list of events and buffer them.
+
+        Parameters
+        ----------
+        records : list
+            Dicts to write as events
+        timeout : float
+            Unused, stdout does not apply back-pressure
+        """
+        block = '\n'.join(codec.dumps_records(records)) + '\n'
+        with self.lock:
+            self.buffer.append(block)
+            self.size += len(block)
+            if self.size >= self.flush_bytes:
+                self.flush_buffer()
+
+    def flush_buffer(self):
+        """Write the buffered events, the lock must be held."""
+        if self.buffer:
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self.size = 0
+            self.stream.write(data)
+            self.stream.flush()
+
+    def flush(self, timeout=None):
+        """Write every buffered event."""
+        with self.lock:
+            self.flush_buffer()
+
+    def close(self, timeout=None):
+        """Write every buffered event."""
+        self.flush(timeout)
+
+
+class HecWriter():
+    """Send events to a Splunk HTTP Event Collector in gzipped batches.
+
+    Batches are sent by a background thread. At most `max_pending` batches
+    wait to be sent, so when HEC slows down the callers block instead of
+    piling up events in memory. A batch is sent again with exponential
+    backoff when HEC is unreachable or overloaded, and dropped once the
+    attempts are exhausted.
+    """
+
+    def __init__(self, url, token, index='', source='', sourcetype='_json', verify=False,
+                 compress=True, batch_bytes=1048576, max_pending=8, max_attempts=5, timeout=10,
+                 session=None):
+        """Constructor."""
+        self.logger = log()
+        self.url = url.rstrip('/') + '/services/collector/event'
+        self.headers = {'Authorization': 'Splunk %s' % token}
+        if compress:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.metadata = {}
+        if index:
+            self.metadata['index'] = index
+        if source:
+            self.metadata['source'] = source
+        if sourcetype:
+            self.metadata['sourcetype'] = sourcetype
+        self.verify = verify
+        self.compress = compress
+        self.batch_bytes = batch_bytes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.policy = RetryPolicy(max_attempts=max_attempts, base_delay=0.5, max_delay=10.0, deadline=120.0)
+        self.session = session if session is not None else get_session(SPLUNKD)
+        self.cond = threading.Condition(threading.Lock())
+        self.pending = deque()
+        self.buffer = []
+        self.size = 0
+        self.thread = None
+        self.sent = 0
+        self.dropped = 0
+
+    def write_records(self, records, timeout=None):
+        """Serialize a list of events and queue them for sending.
+
+        Raises an exception if HEC is too far behind to accept them in time.
+
+        Parameters
+        ----------
+        records : list
+            Dicts to send as events
+        timeout : float
+            Seconds to wait for room in the queue, None waits forever
+        """
+        now = time.time()
+        events = []
+        for record in records:
+            event = dict(self.metadata)
+            event['time'] = now
+            event['event'] = record
+            events.append(event)
+        block = '\n'.join(codec.dumps_records(events)) + '\n'
+        with self.cond:
+            self.buffer.append(block)
+            self.size += len(block)
+            if self.size >= self.batch_bytes:
+                self.enqueue(timeout)
+
+    def enqueue(self, timeout):
+        """Move the buffer to the send queue, waiting for room. The lock must be held."""
+        if not self.buffer:
+            return
+        deadline = time.time() + timeout if timeout is not None else None
+        while len(self.pending) >= self.max_pending:
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise Exception("HTTP Event Collector is not keeping up, %s batches waiting." % len(self.pending))
+            self.cond.wait(remaining)
+        self.pending.append(''.join(self.buffer))
+        self.buffer = []
+        self.size = 0
+        self.start_sender()
+        self.cond.notify_all()
+
+    def start_sender(self):
+        """Start the sender thread if it's not running. The lock must be held."""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.send_loop, name='wazuh-hec-sender')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send_loop(self):
+        """Send the queued batches in order."""
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                batch = self.pending[0]
+            try:
+                self.send(batch)
+            except Exception as e:
+                self.logger.error("bin.event_writer: Batch dropped after sending it failed: %s" % str(e))
+                with self.cond:
+                    self.dropped += 1
+            with self.cond:
+                self.pending.popleft()
+                self.cond.notify_all()
+
+    def send(self, batch):
+        """Post a batch to HEC, retrying while it's unreachable or overloaded.
+
+        Parameters
+        ----------
+        batch : str
+            Concatenated HEC events
+        """
+        body = batch.encode('utf-8')
+        if self.compress:
+            compressed = io.BytesIO()
+            with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+                f.write(body)
+            body = compressed.getvalue()
+        deadline = self.policy.start()
+        attempt = 0
+        while True:
+            attempt += 1
+            retry = True
+            try:
+                response = self.session.post(
+                    self.url, data=body, headers=self.headers,
+                    verify=self.verify, timeout=self.timeout)
+                if response.status_code < 300:
+                    with self.cond:
+                        self.sent += 1
+                    return
+                error = Exception("HEC answered %s: %s" % (response.status_code, response.text[:200]))
+                retry = response.status_code in RETRY_STATUSES
+            except (ConnectionError, Timeout) as e:
+                error = e
+            if not retry or not self.policy.backoff(attempt, deadline):
+                raise error
+            self.logger.debug("bin.event_writer: Sending the batch again: %s" % str(error))
+
+    def flush(self, timeout=None):
+        """Send every buffered event and wait until HEC has received them.
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait, None waits forever
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            self.enqueue(timeout)
+            while self.pending:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise Exception("%s batches not sent to HTTP Event Collector in time." % len(self.pending))
+                self.cond.wait(remaining)
+
+    def close(self, timeout=None):
+        """Send every buffered event."""
+        self.flush(timeout)
+
+    def stats(self):
+        """Return the batch counters."""
+        with self.cond:
+            return {'sent': self.sent, 'dropped': self.dropped, 'pending': len(self.pending)}
+
+
+def get_writer_config():
+    """Return the [event_output] stanza of config.conf merged with the defaults."""
+    return get_stanza('event_output', DEFAULT_CONFIG)
+
+
+def get_writer(config=None, source=''):
+    """Build the event writer configured in the [event_output] stanza.
+
+    Parameters
+    ----------
+    config : dict
+        The [event_output] configuration, read from config.conf when missing
+    source : str
+        Default source of the HEC events
+    """
+    if config is None:
+        config = get_writer_config()
+    if config['output'] == 'hec':
+        return HecWriter(
+            config['url'], config['token'],
+            index=config['index'],
+            source=config['source'] or source,
+            sourcetype=config['sourcetype'],
+            verify=str(config['verify']) == 'true',
+            compress=str(config['gzip']) == 'true',
+            batch_bytes=int(config['batch_bytes']),
+            max_pending=int(config['max_pending']),
+            max_attempts=int(config['max_attempts']),
+            timeout=float(config['timeout']))
+    return StdoutWriter(flush_bytes=int(config['flush_bytes']))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Concurrent execution of independent requests.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+import time
+
+
+def fan_out(tasks, max_workers=4, timeout=None, groups=None, max_per_group=None):
+    """Run independent callables concurrently in a bounded pool of threads.
+
+    A failed or timed out task does not affect the rest, so callers always
+    get the partial results. Tasks are started in the order of `tasks`,
+    skipping those whose group already runs `max_per_group` tasks.
+
+    Parameters
+    ----------
+    tasks : dict
+        Callables without arguments indexed by name
+    max_workers : int
+        Maximum number of tasks running at the same time
+    timeout : float
+        Seconds to wait for all the tasks, None waits forever
+    groups : dict
+        Group of every task, e.g. the upstream it calls, by name
+    max_per_group : int
+        Maximum number of tasks of the same group running at the same time
+
+    Returns
+    -------
+    tuple
+        A dict with the results and a dict with the errors, both by name
+    """
+    results = {}
+    errors = {}
+    pending = list(tasks.items())
+    lock = threading.Lock()
+    finished = threading.Condition(lock)
+    state = {'running': 0}
+    active = {}
+
+    def next_task():
+        for index, (name, task) in enumerate(pending):
+            group = groups.get(name) if groups else None
+            if max_per_group is None or active.get(group, 0) < max_per_group:
+                return index, group
+        return None, None
+
+    def worker():
+        while True:
+            with lock:
+                while True:
+                    if not pending:
+                        state['running'] -= 1
+                        finished.notify_all()
+                        return
+                    index, group = next_task()
+                    if index is not None:
+                        break
+                    # Every pending task belongs to a busy group
+                    finished.wait()
+                name, task = pending.pop(index)
+                active[group] = active.get(group, 0) + 1
+            try:
+                result = task()
+                with lock:
+                    results[name] = result
+            except Exception as e:
+                with lock:
+                    errors[name] = e
+            finally:
+                with lock:
+                    active[group] -= 1
+                    finished.notify_all()
+
+    workers = min(max_workers, len(pending))
+    state['running'] = workers
+    for i in range(workers):
+        thread = threading.Thread(target=worker, name='wazuh-fan-out-%d' % i)
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.time() + timeout if timeout is not None else None
+    with lock:
+        while state['running'] > 0:
+            if deadline is None:
+                finished.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            finished.wait(remaining)
+        for name in tasks:
+            if name not in results and name not in errors:
+                errors[name] = Exception('Timed out after %s seconds.' % timeout)
+        # Tasks not started yet are discarded, the running ones are abandoned
+        del pending[:]
+        finished.notify_all()
+        return dict(results), dict(errors)
+
+
+def fetch_pages(fetch_page, offsets, max_in_flight=4, retries=2):
+    """Fetch paginated windows concurrently and yield them in order.
+
+    At most `max_in_flight` windows are requested or waiting to be consumed
+    at the same time, so memory stays bounded by the window size. A failed
+    window is retried on its own before giving up.
+
+    Parameters
+    ----------
+    fetch_page : callable
+        Receives an offset and returns the page starting at it
+    offsets : list
+        The offsets of the windows to fetch
+    max_in_flight : int
+        Maximum number of windows requested at the same time
+    retries : int
+        Extra attempts for each failed window
+    """
+    offsets = list(offsets)
+    results = {}
+    ready = threading.Condition(threading.Lock())
+
+    def run(offset):
+        attempt = 0
+        while True:
+            try:
+                outcome = (True, fetch_page(offset))
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > retries:
+                    outcome = (False, e)
+                    break
+        with ready:
+            results[offset] = outcome
+            ready.notify_all()
+
+    def start(offset):
+        thread = threading.Thread(target=run, args=(offset,), name='wazuh-page-%s' % offset)
+        thread.daemon = True
+        thread.start()
+
+    started = 0
+    while started < len(offsets) and started < max_in_flight:
+        start(offsets[started])
+        started += 1
+    for offset in offsets:
+        with ready:
+            while offset not in results:
+                ready.wait()
+            ok, value = results.pop(offset)
+        if started < len(offsets):
+            start(offsets[started])
+            started += 1
+        if not ok:
+            raise value
+        yield value
@@ -15,15 +15,144 @@ Find more information about this on the LICENSE file.
 
 from __future__ import absolute_import
 from __future__ import print_function
-import jsonbak
+import codec
 import requestsbak
 import datetime
+import os
+import re
+import threading
+import time
 from db import database
 from log import log
+from http_pool import get_session
+from atomic_file import write_json
+from admission import admit, BACKGROUND
+from metrics import get_metrics
+from fan_out import fan_out
+from event_writer import get_writer
+from long_running import LongRunningProcess
+from item_stream import iter_response_items, record_type
+from app_config import get_stanza
+from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
 import sys
 
 db = database()
 logger = log()
+session = get_session()
+writer = get_writer(source='get_agents_status')
+# Set when splunkd stops reading the events
+output_closed = threading.Event()
+# Read once from stdin, splunkd only sends it when the script starts
+session_key = None
+
+DEFAULT_CONFIG = {
+    'max_workers': '8',
+    'deadline': '300',
+    'timeout': '1',
+    'incremental': 'false',
+    'full_snapshot_interval': '86400',
+    'mode': 'cron',
+    'min_interval': '60',
+    'max_interval': '900',
+    'max_duty_cycle': '0.1',
+    'churn_threshold': '0.05'
+}
+
+# Pidfile of the persistent collector
+PID_PATH = make_splunkhome_path(['var', 'run', 'splunk', 'SplunkAppForWazuh', 'get_agents_status.pid'])
+
+# Directory of the checkpoints of the incremental mode
+CHECKPOINT_PATH = make_splunkhome_path(['var', 'lib', 'splunk', 'modinputs', 'SplunkAppForWazuh'])
+
+# Fields requested for every agent, kept as a tuple until the agent is written
+AGENT_FIELDS = ['id', 'ip', 'manager', 'status']
+AgentRecord = record_type('AgentRecord', AGENT_FIELDS)
+
+
+class Checkpoint():
+    """Status, manager, ip and cluster last emitted for every agent of an API."""
+
+    def __init__(self, api_id):
+        """Constructor."""
+        self.path = os.path.join(
+            CHECKPOINT_PATH, 'agents_status_%s.json' % re.sub(r'[^\w.-]', '_', str(api_id)))
+        self.last_full = 0
+        self.agents = {}
+
+    def load(self):
+        """Read the checkpoint, starting from scratch when it's missing or corrupt."""
+        try:
+            with open(self.path) as f:
+                data = codec.load(f)
+            self.last_full = data['last_full']
+            self.agents = data['agents']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self.last_full = 0
+            self.agents = {}
+
+    def update(self, seen, full, started):
+        """Remember the agents of a run whose events were delivered.
+
+        Parameters
+        ----------
+        seen : dict
+            Fingerprint of every agent received in the run, by id
+        full : bool
+            Whether the run emitted every agent
+        started : float
+            Start of the run, as a timestamp
+        """
+        self.agents = seen
+        if full:
+            self.last_full = started
+
+    def save(self):
+        """Write the checkpoint to disk."""
+        try:
+            os.makedirs(CHECKPOINT_PATH)
+        except OSError:
+            # Created meanwhile by the worker of another API
+            if not os.path.isdir(CHECKPOINT_PATH):
+                raise
+        write_json(self.path, {'last_full': self.last_full, 'agents': self.agents})
+
+
+def fingerprint(agent, cluster_name):
+    """Return the fields of an agent whose change must be emitted.
+
+    Parameters
+    ----------
+    agent : AgentRecord
+        The agent as returned by the Wazuh API
+    cluster_name : str
+        Name of the cluster of the API, None when it's disabled
+    """
+    return '%s|%s|%s|%s' % (agent.status, agent.manager, agent.ip, cluster_name)
+
+
+def agent_events(agents, cluster_name, date):
+    """Build the event of every agent when it's about to be written.
+
+    Parameters
+    ----------
+    agents : list
+        AgentRecord of the agents to emit
+    cluster_name : str
+        Name of the cluster of the API, None when it's disabled
+    date : str
+        Timestamp of the run
+    """
+    for agent in agents:
+        event = {}
+        for key, value in zip(AGENT_FIELDS, agent):
+            if value is not None:
+                event[key] = value
+        if cluster_name is not None:
+            event["cluster"] = {"name": cluster_name}
+        if agent.manager is not None:
+            event["manager"] = {"name": agent.manager}
+        event["timestamp"] = date
+        yield event
 
 
 def get_apis():
@@ -33,82 +162,337 @@ def get_apis():
         session_key = getSplunkSessionKey()
         data_temp = db.all(session_key)
     except Exception as e:
-        return jsonbak.dumps({'error': str(e)})
+        return codec.dumps({'error': str(e)})
     return data_temp
 
 
-def check_status():
-    """Check status of agents."""
+def get_polling_config():
+    """Return the [agents_status] stanza of config.conf merged with the defaults."""
+    return get_stanza('agents_status', DEFAULT_CONFIG)
+
+
+def emit(records, deadline):
+    """Hand a page of events to the writer unless the run is over.
+
+    Parameters
+    ----------
+    records : iterable
+        The events to emit
+    deadline : float
+        End of the run, as a timestamp
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise Exception("Run deadline reached, events discarded.")
+    try:
+        writer.write_records(records, timeout=remaining)
+    except (IOError, OSError):
+        output_closed.set()
+        raise
+
+
+def dropped_batches():
+    """Return the batches the writer gave up sending, 0 for stdout."""
+    return writer.stats()['dropped'] if hasattr(writer, 'stats') else 0
+
+
+def flush_output(deadline, dropped):
+    """Write the events still buffered at the end of a run.
+
+    Returns whether every event of the run was delivered.
+
+    Parameters
+    ----------
+    deadline : float
+        End of the run, as a timestamp
+    dropped : int
+        Batches dropped by the writer before the run
+    """
+    try:
+        writer.flush(timeout=max(deadline - time.time(), 1))
+    except (IOError, OSError) as e:
+        output_closed.set()
+        logger.error("bin.get_agents_status: Error writing events: %s" % str(e))
+        return False
+    except Exception as e:
+        logger.error("bin.get_agents_status: Error writing events: %s" % str(e))
+        return False
+    if dropped_batches() > dropped:
+        logger.error("bin.get_agents_status: %s batches of events dropped." % (dropped_batches() - dropped))
+        return False
+    return True
+
+
+def poll_api(api, date, deadline, timeout, checkpoint=None, emit_all=True):
+    """Request the status of the agents of an API and emit them page by page.
+
+    With a checkpoint, the agents whose status, manager, ip or cluster
+    changed since the last run are counted, and unless `emit_all` is set
+    only those are emitted. Once every page is emitted, the summary holds
+    the fingerprints in `seen`, for the checkpoint to be updated when the
+    events are delivered.
+
+    Parameters
+    ----------
+    api : dict
+        The API entry of the KV store
+    date : str
+        Timestamp of the run
+    deadline : float
+        End of the run, as a timestamp
+    timeout : float
+        Timeout of every request
+    checkpoint : Checkpoint
+        The agents emitted in the previous runs
+    emit_all : bool
+        Emit every agent, not only the changed ones
+    """
+    start = time.time()
+    summary = {'agents': 0, 'pages': 0, 'emitted': 0, 'changed': 0, 'full': emit_all, 'started': start}
+    opt_password = api["passapi"]
+    opt_username = api["userapi"]
+    opt_base_url = api["url"]
+    opt_base_port = api["portapi"]
+    url = str(opt_base_url) + ":" + str(opt_base_port)
+    api_id = api.get("_key", url)
+    auth = requestsbak.auth.HTTPBasicAuth(opt_username, opt_password)
+    get_metrics().register_api(url, api_id)
+    verify = False
+    seen = {}
+    # The first run of a checkpoint has nothing to compare with
+    count_changes = checkpoint is not None and bool(checkpoint.agents)
+    try:
+        final_url_cluster = url + '/cluster/status'
+        admit(url, BACKGROUND)
+        request_cluster_status = session.get(
+            final_url_cluster,
+            auth=auth,
+            timeout=timeout,
+            verify=verify).json()
+        cluster_name = None
+        if request_cluster_status["data"]["enabled"] == "yes":
+            final_url_cluster_name = url + '/cluster/node'
+            admit(url, BACKGROUND)
+            request_cluster_name = session.get(
+                final_url_cluster_name,
+                timeout=timeout,
+                auth=auth,
+                verify=verify).json()
+            cluster_name = request_cluster_name["data"]["cluster"]
+        agents_url_total_items = url + '/agents?limit=1&q=id!=000'
+        admit(url, BACKGROUND)
+        request_agents = session.get(
+            agents_url_total_items,
+            auth=auth, timeout=timeout,
+            verify=verify).json()
+        total_items = request_agents["data"]["totalItems"]
+        limit = 500
+        offset = 0
+
+        while offset < total_items:
+            if time.time() >= deadline:
+                raise Exception("Run deadline reached after %s of %s agents." % (offset, total_items))
+            agents_url = url + \
+                '/agents?select=' + ','.join(AGENT_FIELDS) + '&offset='+str(offset)+'&limit='+str(limit)
+            # The page is parsed as it's received, keeping only the fields of every agent
+            admit(url, BACKGROUND)
+            response = session.get(
+                agents_url, auth=auth, timeout=timeout, verify=verify, stream=True)
+            offset = offset + limit
+            received = 0
+            changed = []
+            page_seen = {}
+            for item in iter_response_items(response):
+                agent = AgentRecord.from_item(item)
+                received += 1
+                if checkpoint is not None:
+                    current = fingerprint(agent, cluster_name)
+                    page_seen[agent.id] = current
+                    if checkpoint.agents.get(agent.id) == current:
+                        if not emit_all:
+                            continue
+                    elif count_changes:
+                        summary['changed'] += 1
+                changed.append(agent)
+            if changed:
+                emit(agent_events(changed, cluster_name, date), deadline)
+            # Only the agents of pages handed to the writer can be checkpointed
+            seen.update(page_seen)
+            summary['pages'] += 1
+            summary['agents'] += received
+            summary['emitted'] += len(changed)
+        if checkpoint is not None:
+            summary['seen'] = seen
+    finally:
+        summary['elapsed'] = time.time() - start
+        logger.info("bin.get_agents_status: API %s: %s agents seen, %s emitted (%s), %s pages, %.2f seconds." % (
+            api_id, summary['agents'], summary['emitted'], 'full' if summary['full'] else 'changes only',
+            summary['pages'], summary['elapsed']))
+    return summary
+
+
+def update_checkpoints(results, run_checkpoints, persist):
+    """Record the agents of the APIs fully polled, once their events are delivered.
+
+    Parameters
+    ----------
+    results : dict
+        Summary of every API polled, by API id
+    run_checkpoints : dict
+        Checkpoint used to poll every API, by API id
+    persist : bool
+        Write the checkpoints to disk
+    """
+    for api_id, summary in results.items():
+        checkpoint = run_checkpoints.get(api_id)
+        if checkpoint is None or 'seen' not in summary:
+            continue
+        checkpoint.update(summary['seen'], summary['full'], summary['started'])
+        try:
+            if persist:
+                checkpoint.save()
+        except Exception as e:
+            logger.error("bin.get_agents_status: Error saving checkpoint of API %s: %s" % (api_id, str(e)))
+
+
+def check_status(config, checkpoints=None):
+    """Check status of agents, polling every API in its own worker.
+
+    Returns the summary of every API polled.
+
+    Parameters
+    ----------
+    config : dict
+        The [agents_status] configuration
+    checkpoints : dict
+        Checkpoints kept between runs by the persistent collector, by API id
+    """
+    results = {}
     try:
         logger.debug("bin.get_agents_status: Checking agents status.")
+        run_timeout = float(config['deadline'])
+        deadline = time.time() + run_timeout
+        timeout = float(config['timeout'])
+        incremental = str(config['incremental']) == 'true'
+        full_snapshot_interval = float(config['full_snapshot_interval'])
         apis = get_apis()
-        apis = jsonbak.loads(apis) #get_apis() returns a JSON string, it needs to be converted as a dictionary
+        apis = codec.loads(apis) #get_apis() returns a JSON string, it needs to be converted as a dictionary
         date = str(datetime.datetime.utcnow())[:-7]
-        # obtains
-        for api in apis:
-            opt_password = api["passapi"]
-            opt_username = api["userapi"]
-            opt_base_url = api["url"]
-            opt_base_port = api["portapi"]
-            agent_list = {}
-            url = str(opt_base_url) + ":" + str(opt_base_port)
-            auth = requestsbak.auth.HTTPBasicAuth(opt_username, opt_password)
-            verify = False
-            agents_url_total_items = url + '/agents?limit=1&q=id!=000'
-            try:
-                request_agents = requestsbak.get(
-                    agents_url_total_items,
-                    auth=auth, timeout=1,
-                    verify=verify).json()
-                total_items = request_agents["data"]["totalItems"]
-                limit = 500
-                offset = 0
-                params = {}
-                params['q'] = 'id!=000'
-                
-                while offset < total_items:
-                    agents_url = url + \
-                        '/agents?select=id,ip,manager,status&offset='+str(offset)+'&limit='+str(limit)
-                    request_agents = requestsbak.get(
-                        agents_url, auth=auth, timeout=1, verify=verify).json()
-
-                    agent_list = request_agents["data"]["items"]
-                    final_url_cluster = url + '/cluster/status'
-                    request_cluster_status = requestsbak.get(
-                        final_url_cluster,
-                        auth=auth,
-                        timeout=1,
-                        verify=verify).json()
-                    cluster_status = request_cluster_status["data"]["enabled"]
-                    final_url_cluster_name = url + '/cluster/node'
-                    request_cluster_name = requestsbak.get(
-                        final_url_cluster_name,
-                        timeout=1,
-                        auth=auth,
-                        verify=verify).json()
-                    offset = offset + limit
-                    for item in agent_list:
-                        if cluster_status == "yes":
-                            item["cluster"] = {}
-                            item["cluster"]["name"] = request_cluster_name["data"]["cluster"]
-                        if 'manager' in item:
-                            manager_name = item["manager"]
-                            item["manager"] = {}
-                            item["manager"]["name"] = manager_name
-                        item["timestamp"] = date
-                        print(jsonbak.dumps(item))
-            except Exception as e:
-                logger.error("Error requesting agents status: %s" % str(e))
-                pass
+        dropped = dropped_batches()
+        tasks = {}
+        run_checkpoints = {}
+
+        def task(api_id, api):
+            checkpoint = None
+            if checkpoints is not None or incremental:
+                checkpoint = checkpoints.get(api_id) if checkpoints is not None else None
+                if checkpoint is None:
+                    checkpoint = Checkpoint(api_id)
+                    if incremental:
+                        checkpoint.load()
+                    if checkpoints is not None:
+                        checkpoints[api_id] = checkpoint
+                run_checkpoints[api_id] = checkpoint
+            emit_all = not incremental or time.time() - checkpoint.last_full >= full_snapshot_interval
+            return lambda: poll_api(api, date, deadline, timeout, checkpoint, emit_all)
+
+        for index, api in enumerate(apis):
+            api_id = api.get("_key", str(index))
+            tasks[api_id] = task(api_id, api)
+        results, errors = fan_out(tasks, max_workers=max(int(config['max_workers']), 1), timeout=run_timeout)
+        if flush_output(deadline, dropped):
+            update_checkpoints(results, run_checkpoints, incremental)
+        for summary in results.values():
+            summary.pop('seen', None)
+        for api_id, error in errors.items():
+            logger.error("Error requesting agents status of API %s: %s" % (api_id, str(error)))
+        logger.info("bin.get_agents_status: Run finished: %s of %s APIs polled, %s agents." % (
+            len(results), len(tasks), sum(summary['agents'] for summary in results.values())))
     except Exception as e:
         logger.error("Error requesting agents status: %s" % str(e))
         pass
+    try:
+        get_metrics().save('get_agents_status')
+    except Exception as e:
+        logger.error("bin.get_agents_status: Error saving metrics: %s" % str(e))
+    return results
+
+
+def next_interval(config, results):
+    """Return the seconds to wait before the next run of the persistent collector.
+
+    The interval shrinks from `max_interval` towards `min_interval` as the
+    share of agents that changed approaches `churn_threshold`. It never
+    gets so short that polling would take more than `max_duty_cycle` of
+    the time, so large fleets are polled less often.
+
+    Parameters
+    ----------
+    config : dict
+        The [agents_status] configuration
+    results : dict
+        Summary of every API polled in the last run
+    """
+    min_interval = float(config['min_interval'])
+    max_interval = float(config['max_interval'])
+    agents = sum(summary['agents'] for summary in results.values())
+    changed = sum(summary['changed'] for summary in results.values())
+    elapsed = max([summary['elapsed'] for summary in results.values()] or [0])
+    churn = float(changed) / agents if agents else 0.0
+    pressure = min(churn / float(config['churn_threshold']), 1.0)
+    interval = max_interval - (max_interval - min_interval) * pressure
+    interval = max(interval, elapsed / float(config['max_duty_cycle']))
+    return min(max(interval, min_interval), max_interval)
+
+
+class Collector(LongRunningProcess):
+    """Poll the agents status from a single long-running process.
+
+    Keeps the connection pools, the configuration and the agent checkpoints
+    between runs.
+    """
+
+    name = 'bin.get_agents_status'
+
+    def __init__(self, config):
+        """Constructor."""
+        LongRunningProcess.__init__(self, PID_PATH)
+        self.config = config
+        self.checkpoints = {}
+
+    def run(self):
+        """Poll the APIs until splunkd stops the collector."""
+        if not self.lock():
+            logger.debug("bin.get_agents_status: Another collector is running.")
+            return
+        self.handle_signals()
+        logger.info("bin.get_agents_status: Collector started with pid %s." % os.getpid())
+        try:
+            while not self.stop.is_set():
+                results = check_status(self.config, self.checkpoints)
+                if output_closed.is_set():
+                    logger.info("bin.get_agents_status: Output closed by splunkd, stopping the collector.")
+                    break
+                interval = next_interval(self.config, results)
+                logger.debug("bin.get_agents_status: Next run in %.0f seconds." % interval)
+                self.wait(interval)
+        finally:
+            self.unlock()
+            logger.info("bin.get_agents_status: Collector stopped.")
 
 
 def getSplunkSessionKey():
     """Get the session key, it needs to configure in the inputs.conf that executes this script the following parameter: passAuth = splunk-system-user"""
-    logger.debug("bin.get_agents_status: Getting Splunk session key.")
-    session_key = sys.stdin.readline().strip()
+    global session_key
+    if session_key is None:
+        logger.debug("bin.get_agents_status: Getting Splunk session key.")
+        session_key = sys.stdin.readline().strip()
     return session_key
 
-check_status()
\ No newline at end of file
+
+if __name__ == '__main__':
+    polling_config = get_polling_config()
+    if polling_config['mode'] == 'persistent' and os.name == 'posix':
+        Collector(polling_config).run()
+    else:
+        check_status(polling_config)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Shared HTTP connection pools.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+import time
+import requestsbak
+from requestsbak.adapters import HTTPAdapter
+from metrics import get_metrics, response_failed
+from app_config import get_stanza
+
+# Sessions available in the process: one for the Wazuh APIs and one for splunkd
+WAZUH = 'wazuh'
+SPLUNKD = 'splunkd'
+
+DEFAULT_CONFIG = {
+    'pool_connections': '10',
+    'pool_maxsize': '20',
+    'pool_block': 'false'
+}
+
+
+
+class InstrumentedSession(requestsbak.Session):
+    """Session that records the latency, size and outcome of every request."""
+
+    def request(self, method, url, *args, **kwargs):
+        """Send a request and record it in the process metrics."""
+        start = time.time()
+        try:
+            response = requestsbak.Session.request(self, method, url, *args, **kwargs)
+        except Exception:
+            get_metrics().record(url, method, time.time() - start, None, True)
+            raise
+        size = response.headers.get('Content-Length')
+        if size is not None and size.isdigit():
+            size = int(size)
+        elif response._content_consumed:
+            size = len(response.content or b'')
+        else:
+            size = None
+        get_metrics().record(url, method, time.time() - start, size, response_failed(response))
+        return response
+
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_pool_config():
+    """Return the [http_pool] stanza of config.conf merged with the defaults."""
+    return get_stanza('http_pool', DEFAULT_CONFIG)
+
+
+def get_session(name=WAZUH):
+    """Return the process wide session for a kind of upstream.
+
+    Every session keeps a keep-alive pool per host, so controllers and
+    scripts reuse TCP and TLS connections instead of opening new ones.
+
+    Parameters
+    ----------
+    name : str
+        WAZUH or SPLUNKD
+    """
+    session = _sessions.get(name)
+    if session is not None:
+        return session
+    with _lock:
+        if name not in _sessions:
+            config = get_pool_config()
+            adapter = HTTPAdapter(
+                pool_connections=int(config['pool_connections']),
+                pool_maxsize=int(config['pool_maxsize']),
+                pool_block=str(config['pool_block']) == 'true')
+            session = InstrumentedSession() if name == WAZUH else requestsbak.Session()
+            session.trust_env = False
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[name] = session
+        return _sessions[name]
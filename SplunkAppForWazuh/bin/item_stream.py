@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Incremental parsing of the items of Wazuh API responses.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import codecs
+import re
+from collections import namedtuple
+import codec
+from jsonbak.decoder import JSONDecoder
+
+# Bytes read from the socket at a time
+CHUNK_SIZE = 65536
+
+# Parsed text kept before dropping the part already consumed
+COMPACT_SIZE = 262144
+
+ITEMS_START = re.compile(r'"items"\s*:\s*\[')
+ERROR = re.compile(r'"error"\s*:\s*(\d+)')
+TOTAL_ITEMS = re.compile(r'"totalItems"\s*:\s*(\d+)')
+SEPARATORS = ' \t\n\r,'
+
+
+class ItemStream():
+    """Iterate over data.items of a Wazuh API response while it's received.
+
+    Only the item being parsed and the text not consumed yet are kept in
+    memory, so a page costs the same whatever its size. The error code and
+    totalItems, which the API writes before the items, are available once
+    the iteration has started, or at the end if the API writes them after
+    the items.
+    """
+
+    def __init__(self, chunks):
+        """Constructor.
+
+        Parameters
+        ----------
+        chunks : iterable
+            Bytes of the response body, e.g. response.iter_content(CHUNK_SIZE)
+        """
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = JSONDecoder()
+        self.text = ''
+        self.exhausted = False
+        self.error = None
+        self.message = None
+        self.total_items = None
+
+    def read(self):
+        """Append the next chunk to the text. Return False at the end of the body."""
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            self.text += self.utf8.decode(b'', True)
+            return False
+        self.text += self.utf8.decode(chunk)
+        return True
+
+    def __iter__(self):
+        """Yield every item of data.items."""
+        while True:
+            match = ITEMS_START.search(self.text)
+            if match is not None:
+                break
+            if not self.read():
+                # Errors and responses without items are small, parse them whole
+                response = codec.loads(self.text)
+                self.error = response.get('error')
+                self.message = response.get('message')
+                if isinstance(response.get('data'), dict):
+                    self.total_items = response['data'].get('totalItems')
+                return
+        head = self.text[:match.start()]
+        error = ERROR.search(head)
+        self.error = int(error.group(1)) if error else 0
+        total_items = TOTAL_ITEMS.search(head)
+        if total_items:
+            self.total_items = int(total_items.group(1))
+        self.text = self.text[match.end():]
+        pos = 0
+        while True:
+            length = len(self.text)
+            while pos < length and self.text[pos] in SEPARATORS:
+                pos += 1
+            if pos >= length:
+                if not self.read():
+                    raise ValueError("Response ended inside data.items.")
+                continue
+            if self.text[pos] == ']':
+                self.finish(pos + 1)
+                return
+            try:
+                item, end = self.decoder.raw_decode(self.text, pos)
+            except ValueError:
+                if self.read():
+                    continue
+                raise
+            # A number cut by the end of the text, e.g. at "3." or "1e", may
+            # continue in the next chunk
+            if (end == length or self.text[end] not in SEPARATORS + ']') and self.read():
+                continue
+            yield item
+            pos = end
+            if pos > COMPACT_SIZE:
+                self.text = self.text[pos:]
+                pos = 0
+
+    def finish(self, pos):
+        """Read the rest of the body, so the connection can be reused.
+
+        Parameters
+        ----------
+        pos : int
+            Position in the text right after data.items
+        """
+        self.text = self.text[pos:]
+        while self.read():
+            pass
+        if self.total_items is None:
+            total_items = TOTAL_ITEMS.search(self.text)
+            if total_items:
+                self.total_items = int(total_items.group(1))
+        self.text = ''
+
+
+def iter_response_items(response):
+    """Yield the items of a response requested with stream=True.
+
+    Raises an exception when the Wazuh API answers with an error.
+
+    Parameters
+    ----------
+    response : requestsbak.Response
+        The streamed response
+    """
+    stream = ItemStream(response.iter_content(CHUNK_SIZE))
+    try:
+        for item in stream:
+            yield item
+        if stream.error:
+            raise Exception(stream.message or "Wazuh API error %s." % stream.error)
+    finally:
+        response.close()
+
+
+def record_type(name, fields):
+    """Return a tuple based class holding the given fields of an item.
+
+    Parameters
+    ----------
+    name : str
+        The class name
+    fields : list
+        The keys of the items to keep
+    """
+    record = namedtuple(name, fields, rename=True)
+    keys = tuple(fields)
+
+    def from_item(item):
+        return record(*[item.get(key) for key in keys])
+    record.from_item = staticmethod(from_item)
+    return record
@@ -12,12 +12,63 @@ the Free Software Foundation; either version 2 of the License, or
 Find more information about this on the LICENSE file.
 """
 
-import jsonbak
-import requestsbak
+import codec
+import hashlib
+import os
+from collections import OrderedDict
 from log import log
+from http_pool import get_session, SPLUNKD
 # from splunk import AuthorizationFailed as AuthorizationFailed
 import splunk
 from splunk import entity, rest
+from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
+
+# Documents the KV store accepts in a batch_save request by default
+BATCH_SAVE_SIZE = 1000
+
+# Keys or fingerprints per KV store query, so the query fits in the URL
+QUERY_BATCH_SIZE = 100
+
+# Keys of a job request that don't identify what it does
+JOB_ROUTING_KEYS = ('id', 'apiId', 'method', 'endpoint')
+
+# Touched when jobs are added, so a persistent scheduler reloads the queue
+CHANGE_SIGNAL_PATH = make_splunkhome_path(['var', 'run', 'splunk', 'SplunkAppForWazuh', 'jobs_queue.signal'])
+
+
+def signal_change():
+    """Update the modification time of the change signal."""
+    try:
+        if not os.path.isdir(os.path.dirname(CHANGE_SIGNAL_PATH)):
+            os.makedirs(os.path.dirname(CHANGE_SIGNAL_PATH))
+        with open(CHANGE_SIGNAL_PATH, 'a'):
+            os.utime(CHANGE_SIGNAL_PATH, None)
+    except (IOError, OSError):
+        # Without the signal the scheduler finds the job when it resyncs
+        pass
+
+
+def job_fingerprint(req):
+    """Return a digest of the API, method, endpoint and parameters of a job request.
+
+    Parameters
+    ----------
+    req : dict
+        The request of the job, as sent by the UI
+    """
+    api_id = req.get('id', req.get('apiId'))
+    method = str(req.get('method') or 'GET').upper()
+    params = dict((key, value) for key, value in req.items() if key not in JOB_ROUTING_KEYS)
+    canonical = codec.dumps([api_id, method, req.get('endpoint'), params], sort_keys=True)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def last_change():
+    """Return the modification time of the change signal, 0 if it's missing."""
+    try:
+        return os.stat(CHANGE_SIGNAL_PATH).st_mtime
+    except (IOError, OSError):
+        return 0
 
 
 class JobsQueue():
@@ -27,8 +78,7 @@ class JobsQueue():
         """Constructor."""
         try:
             self.logger = log()
-            self.session = requestsbak.Session()
-            self.session.trust_env = False
+            self.session = get_session(SPLUNKD)
             self.kvstoreUri = entity.buildEndpoint(
                 entityClass=["storage", "collections", "data"],
                 entityName="jobs",
@@ -43,6 +93,9 @@ class JobsQueue():
     def insert_job(self, job, session_key=False):
         """Insert a job.
 
+        If the same request is already pending, no job is added: the
+        pending one is brought forward when the new job is due earlier.
+
         Parameters
         ----------
         dic : job
@@ -55,13 +108,115 @@ class JobsQueue():
             self.logger.debug("bin.jobs_queu: Inserting job.")
             kvstoreUri = self.kvstoreUri+'?output_mode=json'
             auth_key = session_key if session_key else splunk.getSessionKey()
-            job = jsonbak.dumps(job)
+            job = dict(job, fingerprint=job_fingerprint(job['job']))
+            pending = self.find_pending([job['fingerprint']], auth_key).get(job['fingerprint'])
+            if pending is not None:
+                self.logger.debug("bin.jobs_queue: Job merged with the pending job %s." % pending['_key'])
+                if job['exec_time'] < pending['exec_time']:
+                    pending['exec_time'] = job['exec_time']
+                    self.update_job(self.stored_job(pending), auth_key)
+                    signal_change()
+                return codec.dumps({'_key': pending['_key']})
+            job = codec.dumps(job)
             result = self.session.post(kvstoreUri, data=job, headers={
                                        "Authorization": "Splunk %s" % auth_key, "Content-Type": "application/json"}, verify=False).json()
-            return jsonbak.dumps(result)
+            signal_change()
+            return codec.dumps(result)
         except Exception as e:
             self.logger.error('bin.jobs_queu: Error inserting a job in JobsQueue module: %s ' % (e))
-            return jsonbak.dumps({"error": str(e)})
+            return codec.dumps({"error": str(e)})
+
+    def insert_jobs(self, jobs, session_key=False):
+        """Insert several jobs with batch_save requests.
+
+        Jobs with the same request, among them or already pending, are
+        merged into one due at the earliest exec_time. Returns the keys of
+        the inserted or merged jobs.
+
+        Parameters
+        ----------
+        list : jobs
+            The jobs information
+        str : session_key
+            The authorized session key
+
+        """
+        try:
+            self.logger.debug("bin.jobs_queue: Inserting %s jobs." % len(jobs))
+            kvstoreUri = self.kvstoreUri+'/batch_save?output_mode=json'
+            auth_key = session_key if session_key else splunk.getSessionKey()
+            merged = OrderedDict()
+            for job in jobs:
+                job = dict(job, fingerprint=job_fingerprint(job['job']))
+                previous = merged.get(job['fingerprint'])
+                if previous is None or job['exec_time'] < previous['exec_time']:
+                    merged[job['fingerprint']] = job
+            pending = self.find_pending(merged.keys(), auth_key)
+            jobs = []
+            keys = []
+            for fingerprint, job in merged.items():
+                if fingerprint not in pending:
+                    jobs.append(job)
+                elif job['exec_time'] < pending[fingerprint]['exec_time']:
+                    jobs.append(dict(self.stored_job(pending[fingerprint]), exec_time=job['exec_time']))
+                else:
+                    keys.append(pending[fingerprint]['_key'])
+            for start in range(0, len(jobs), BATCH_SAVE_SIZE):
+                batch = codec.dumps(jobs[start:start + BATCH_SAVE_SIZE])
+                result = self.session.post(kvstoreUri, data=batch, headers={
+                                           "Authorization": "Splunk %s" % auth_key, "Content-Type": "application/json"}, verify=False)
+                if result.status_code not in (200, 201):
+                    msg = codec.loads(result.text)
+                    raise Exception(msg['messages'][0]['text'])
+                keys.extend(codec.loads(result.text))
+            if jobs:
+                signal_change()
+            return keys
+        except Exception as e:
+            self.logger.error('bin.jobs_queue: Error inserting jobs in JobsQueue module: %s ' % (e))
+            raise e
+
+    def find_pending(self, fingerprints, session_key=False):
+        """Get the pending jobs with the given fingerprints, the earliest for each one.
+
+        When the KV store can't be queried no job is returned, so the new
+        jobs are inserted rather than lost.
+
+        Parameters
+        ----------
+        list : fingerprints
+            Fingerprints of job requests
+        str : session_key
+            The authorized session key
+
+        """
+        kvstoreUri = self.kvstoreUri+'?output_mode=json'
+        auth_key = session_key if session_key else splunk.getSessionKey()
+        fingerprints = list(fingerprints)
+        found = {}
+        try:
+            for start in range(0, len(fingerprints), QUERY_BATCH_SIZE):
+                query = {"done": False, "$or": [{"fingerprint": fingerprint} for fingerprint in fingerprints[start:start + QUERY_BATCH_SIZE]]}
+                result = self.session.get(kvstoreUri, params={'query': codec.dumps(query), 'sort': 'exec_time'}, headers={
+                                          "Authorization": "Splunk %s" % auth_key, "Content-Type": "application/json"}, verify=False).json()
+                if not isinstance(result, list):
+                    raise Exception(result['messages'][0]['text'])
+                for job in result:
+                    found.setdefault(job['fingerprint'], job)
+        except Exception as e:
+            self.logger.error("bin.jobs_queue: Error looking for duplicated jobs in JobsQueue module: %s" % (e))
+            return {}
+        return found
+
+    def stored_job(self, job):
+        """Return a job read from the KV store without its metadata but the key.
+
+        Parameters
+        ----------
+        dic : job
+            The job as returned by the KV store
+        """
+        return dict((key, value) for key, value in job.items() if key == '_key' or not key.startswith('_'))
 
     def update_job(self, job, session_key=False):
         """Update an already inserted API.
@@ -78,7 +233,7 @@ class JobsQueue():
                 raise Exception('Missing Key')
             id = job['_key']
             del job['_key']
-            job = jsonbak.dumps(job)
+            job = codec.dumps(job)
             kvstoreUri = self.kvstoreUri+'/'+id+'?output_mode=json'
             auth_key = session_key if session_key else splunk.getSessionKey()
             result = self.session.post(kvstoreUri, data=job, headers={
@@ -111,33 +266,74 @@ class JobsQueue():
             if result.status_code == 200:
                 return 'Job removed.'
             else:
-                msg = jsonbak.loads(result.text)
+                msg = codec.loads(result.text)
                 text = msg['messages'][0]['text']
                 raise Exception(text)
         except Exception as e:
             self.logger.error("bin.jobs_queu: Error removing a Job in JobsQueue module: %s" % (e))
             raise e
 
-    def get_jobs(self, session_key=False):
-        """Get all jobs.
+    def remove_jobs(self, keys, session_key=False):
+        """Remove several jobs with a query on their keys.
+
+        Parameters
+        ----------
+        list : keys
+            The keys of the jobs to remove
+        str : session_key
+            The authorized session key
+
+        """
+        try:
+            self.logger.debug("bin.jobs_queue: Removing %s jobs." % len(keys))
+            kvstoreUri = self.kvstoreUri+'?output_mode=json'
+            auth_key = session_key if session_key else splunk.getSessionKey()
+            keys = [str(key) for key in keys if key]
+            for start in range(0, len(keys), QUERY_BATCH_SIZE):
+                query = {"$or": [{"_key": key} for key in keys[start:start + QUERY_BATCH_SIZE]]}
+                result = self.session.delete(kvstoreUri, params={'query': codec.dumps(query)}, headers={
+                                             "Authorization": "Splunk %s" % auth_key, "Content-Type": "application/json"}, verify=False)
+                if result.status_code != 200:
+                    msg = codec.loads(result.text)
+                    raise Exception(msg['messages'][0]['text'])
+            return 'Jobs removed.'
+        except Exception as e:
+            self.logger.error("bin.jobs_queue: Error removing jobs in JobsQueue module: %s" % (e))
+            raise e
+
+    def get_jobs(self, session_key=False, due_before=None, limit=None):
+        """Get all jobs, or only the pending ones due before a given time.
+
+        The filter, the sort and the limit are applied by the KV store,
+        using the acceleration on (done, exec_time) of collections.conf.
 
         Parameters
         ----------
         str : session_key
             The authorized session key
+        float : due_before
+            Only return the jobs not done whose exec_time is earlier
+        int : limit
+            Maximum number of jobs to return, oldest exec_time first
 
         """
         try:
             self.logger.debug("bin.jobs_queue: Getting all jobs.")
             kvstoreUri = self.kvstoreUri+'?output_mode=json'
             auth_key = session_key if session_key else splunk.getSessionKey()
-            result = self.session.get(kvstoreUri, headers={
+            params = {}
+            if due_before is not None:
+                params['query'] = codec.dumps({"done": False, "exec_time": {"$lt": due_before}})
+                params['sort'] = 'exec_time'
+            if limit:
+                params['limit'] = int(limit)
+            result = self.session.get(kvstoreUri, params=params, headers={
                                       "Authorization": "Splunk %s" % auth_key, "Content-Type": "application/json"}, verify=False).json()
             if 'messages' in result:
                 r = result['messages'][0]
                 if r['type'] == 'ERROR' and r['text'] == 'KV Store is initializing. Please try again later.':
                     result = []
-            return jsonbak.dumps(result)
+            return codec.dumps(result)
         except Exception as e:
             self.logger.error('bin.jobs_queu: Error getting the jobs queue in JobsQueue module: %s ' % (e))
             raise e
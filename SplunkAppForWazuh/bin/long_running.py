@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Base of the scripted inputs that keep running between schedules.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import os
+import signal
+import threading
+import time
+from log import log
+
+
+class LongRunningProcess():
+    """A scripted input that runs until splunkd stops it.
+
+    Only one instance runs at a time: the pidfile is locked while it's
+    alive, so the runs started by the input schedule meanwhile exit
+    straight away, and the schedule starts it again if it dies.
+    """
+
+    # Prefix of the log messages
+    name = 'bin.long_running'
+
+    def __init__(self, pid_path):
+        """Constructor.
+
+        Parameters
+        ----------
+        pid_path : str
+            The pidfile locked while the process runs
+        """
+        self.logger = log()
+        self.pid_path = pid_path
+        self.stop = threading.Event()
+        self.parent = os.getppid()
+        self.pidfile = None
+
+    def lock(self):
+        """Take the pidfile lock, return False if another process holds it."""
+        import fcntl
+        if not os.path.isdir(os.path.dirname(self.pid_path)):
+            os.makedirs(os.path.dirname(self.pid_path))
+        self.pidfile = open(self.pid_path, 'a+')
+        try:
+            fcntl.flock(self.pidfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self.pidfile.close()
+            self.pidfile = None
+            return False
+        self.pidfile.seek(0)
+        self.pidfile.truncate()
+        self.pidfile.write(str(os.getpid()))
+        self.pidfile.flush()
+        return True
+
+    def unlock(self):
+        """Release the pidfile lock."""
+        if self.pidfile is not None:
+            self.pidfile.close()
+            self.pidfile = None
+
+    def handle_signal(self, signum, frame):
+        """Stop the process when splunkd asks for it."""
+        self.logger.info("%s: Signal %s received, stopping." % (self.name, signum))
+        self.stop.set()
+
+    def handle_signals(self):
+        """Stop the process on SIGTERM and SIGINT."""
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+
+    def parent_alive(self):
+        """Check if splunkd, which started the process, is still running."""
+        return os.getppid() == self.parent
+
+    def wait(self, seconds):
+        """Sleep for a while, waking up early to stop."""
+        end = time.time() + seconds
+        while not self.stop.is_set():
+            if not self.parent_alive():
+                self.logger.info("%s: splunkd is gone, stopping." % self.name)
+                self.stop.set()
+                break
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            self.stop.wait(min(remaining, 1))
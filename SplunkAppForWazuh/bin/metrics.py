@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Wazuh API upstream metrics.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import os
+import re
+import threading
+import codec
+from atomic_file import write_json
+from raw_json import error_code
+from requestsbak.compat import urlsplit
+from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Directory where the scripts leave the metrics of their runs
+METRICS_PATH = make_splunkhome_path(['var', 'run', 'splunk', 'SplunkAppForWazuh'])
+
+# Rules to turn an endpoint into its template, applied in order
+ENDPOINT_TEMPLATES = [
+    (re.compile(r'^/agents/groups/[^/]+'), '/agents/groups/:group_id'),
+    (re.compile(r'^/agents/group/[^/]+'), '/agents/group/:group_id'),
+    (re.compile(r'^/agents/name/[^/]+'), '/agents/name/:agent_name'),
+    (re.compile(r'^/(agents|syscollector|syscheck|rootcheck|sca|ciscat|active-response)/\d+'), r'/\1/:agent_id'),
+    (re.compile(r'^/agents/:agent_id/group/(?!is_sync)[^/]+'), '/agents/:agent_id/group/:group_id'),
+    (re.compile(r'^/agents/:agent_id/config/[^/]+/[^/]+'), '/agents/:agent_id/config/:component/:configuration'),
+    (re.compile(r'^/sca/:agent_id/checks/[^/]+'), '/sca/:agent_id/checks/:id'),
+    (re.compile(r'^/cluster/nodes/[^/]+'), '/cluster/nodes/:node_name'),
+    (re.compile(r'^/cluster/(?!status|node$|nodes|config|configuration|healthcheck|restart)[^/]+'), '/cluster/:node_id'),
+    (re.compile(r'^/rules/\d+'), '/rules/:rule_id'),
+    (re.compile(r'^/decoders/(?!files|parents)[^/]+'), '/decoders/:decoder_name'),
+    (re.compile(r'/files/[^/]+$'), '/files/:filename')
+]
+
+
+def endpoint_template(endpoint):
+    """Replace the variable parts of an endpoint by their names.
+
+    Parameters
+    ----------
+    endpoint : str
+        The Wazuh API endpoint
+    """
+    endpoint = endpoint.split('?')[0].rstrip('/') or '/'
+    for pattern, template in ENDPOINT_TEMPLATES:
+        endpoint = pattern.sub(template, endpoint, count=1)
+    return endpoint
+
+
+def quantile(buckets, counts, q):
+    """Estimate a quantile from the cumulative counts of a histogram.
+
+    Parameters
+    ----------
+    buckets : tuple
+        Upper bounds of the buckets
+    counts : list
+        Observations of each bucket, plus one for the +Inf bucket
+    q : float
+        The quantile, between 0 and 1
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0
+    for i, count in enumerate(counts):
+        if cumulative + count >= rank:
+            if i == len(buckets):
+                return buckets[-1]
+            upper = buckets[i]
+            fraction = (rank - cumulative) / float(count) if count else 0
+            return lower + (upper - lower) * fraction
+        cumulative += count
+        lower = buckets[i] if i < len(buckets) else lower
+    return buckets[-1]
+
+
+def new_series():
+    """Return an empty set of counters."""
+    return {
+        'count': 0,
+        'errors': 0,
+        'latency_sum': 0.0,
+        'latency': [0] * (len(LATENCY_BUCKETS) + 1),
+        'size_sum': 0,
+        'size': [0] * (len(SIZE_BUCKETS) + 1)
+    }
+
+
+def observe(counts, buckets, value):
+    """Add a value to the counts of a histogram."""
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            counts[i] += 1
+            return
+    counts[-1] += 1
+
+
+def merge_series(target, source):
+    """Add the counters of a series to another one."""
+    for key in ('count', 'errors', 'latency_sum', 'size_sum'):
+        target[key] += source[key]
+    for key in ('latency', 'size'):
+        target[key] = [a + b for a, b in zip(target[key], source[key])]
+
+
+class Metrics():
+    """Latency, payload size and error histograms of the upstream calls.
+
+    Series are labeled by API, method and endpoint template.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.series = {}
+        self.api_ids = {}
+
+    def register_api(self, url, api_id):
+        """Label the calls made to an url with an API id.
+
+        Parameters
+        ----------
+        url : str
+            The API url
+        api_id : str
+            The API id
+        """
+        parts = urlsplit(url)
+        self.api_ids['%s://%s' % (parts.scheme, parts.netloc.lower())] = api_id
+
+    def record(self, url, method, elapsed, size, error):
+        """Record an upstream call.
+
+        Parameters
+        ----------
+        url : str
+            The requested url
+        method : str
+            The HTTP method
+        elapsed : float
+            Seconds spent in the call
+        size : int
+            Bytes of the response body
+        error : bool
+            Whether the call failed
+        """
+        parts = urlsplit(url)
+        base = '%s://%s' % (parts.scheme, parts.netloc.lower())
+        key = (self.api_ids.get(base, base), method.upper(), endpoint_template(parts.path))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = new_series()
+            series['count'] += 1
+            if error:
+                series['errors'] += 1
+            series['latency_sum'] += elapsed
+            observe(series['latency'], LATENCY_BUCKETS, elapsed)
+            if size is not None:
+                series['size_sum'] += size
+                observe(series['size'], SIZE_BUCKETS, size)
+
+    def snapshot(self, reset=False):
+        """Return a copy of the series as a list of labeled dicts.
+
+        Parameters
+        ----------
+        reset : bool
+            Start the series from zero after copying them
+        """
+        with self.lock:
+            items = [
+                {'api': k[0], 'method': k[1], 'endpoint': k[2],
+                 'series': dict((name, list(v) if isinstance(v, list) else v) for name, v in s.items())}
+                for k, s in self.series.items()]
+            if reset:
+                self.series = {}
+            return items
+
+    def save(self, source):
+        """Merge the series of this process into the metrics file of a script.
+
+        Parameters
+        ----------
+        source : str
+            The script name
+        """
+        path = os.path.join(METRICS_PATH, 'metrics_%s.json' % source)
+        merged = {}
+        try:
+            with open(path) as f:
+                for item in codec.load(f):
+                    merged[(item['api'], item['method'], item['endpoint'])] = item['series']
+        except (IOError, OSError, ValueError):
+            pass
+        for item in self.snapshot(reset=True):
+            key = (item['api'], item['method'], item['endpoint'])
+            if key in merged:
+                merge_series(merged[key], item['series'])
+            else:
+                merged[key] = item['series']
+        if not os.path.isdir(METRICS_PATH):
+            os.makedirs(METRICS_PATH)
+        write_json(path, [
+            {'api': k[0], 'method': k[1], 'endpoint': k[2], 'series': s}
+            for k, s in merged.items()])
+
+
+def collect(in_process_source='web'):
+    """Return the series of this process and of every script, labeled by source.
+
+    Parameters
+    ----------
+    in_process_source : str
+        The source label of the series of this process
+    """
+    items = []
+    for item in get_metrics().snapshot():
+        item['source'] = in_process_source
+        items.append(item)
+    if os.path.isdir(METRICS_PATH):
+        for name in sorted(os.listdir(METRICS_PATH)):
+            if not (name.startswith('metrics_') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(METRICS_PATH, name)) as f:
+                    for item in codec.load(f):
+                        item['source'] = name[len('metrics_'):-len('.json')]
+                        items.append(item)
+            except (IOError, OSError, ValueError):
+                continue
+    return items
+
+
+def summarize(items):
+    """Return the series with their error rate and latency and size quantiles.
+
+    Parameters
+    ----------
+    items : list
+        Series returned by collect()
+    """
+    result = []
+    for item in items:
+        s = item['series']
+        count = s['count']
+        result.append({
+            'source': item['source'], 'api': item['api'],
+            'method': item['method'], 'endpoint': item['endpoint'],
+            'count': count,
+            'errors': s['errors'],
+            'error_rate': round(float(s['errors']) / count, 4) if count else 0.0,
+            'latency': {
+                'avg': s['latency_sum'] / count if count else None,
+                'p50': quantile(LATENCY_BUCKETS, s['latency'], 0.5),
+                'p95': quantile(LATENCY_BUCKETS, s['latency'], 0.95),
+                'p99': quantile(LATENCY_BUCKETS, s['latency'], 0.99)
+            },
+            'size': {
+                'avg': float(s['size_sum']) / sum(s['size']) if sum(s['size']) else None,
+                'p50': quantile(SIZE_BUCKETS, s['size'], 0.5),
+                'p95': quantile(SIZE_BUCKETS, s['size'], 0.95),
+                'p99': quantile(SIZE_BUCKETS, s['size'], 0.99)
+            }
+        })
+    return result
+
+
+def escape_label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_histogram(lines, name, labels, buckets, counts, total_sum):
+    """Append the lines of a histogram in Prometheus text format."""
+    cumulative = 0
+    for bound, count in zip(list(buckets) + ['+Inf'], counts):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, cumulative))
+    lines.append('%s_sum{%s} %s' % (name, labels, total_sum))
+    lines.append('%s_count{%s} %s' % (name, labels, cumulative))
+
+
+def to_prometheus(items):
+    """Return the series in Prometheus text exposition format.
+
+    Parameters
+    ----------
+    items : list
+        Series returned by collect()
+    """
+    lines = [
+        '# HELP wazuh_api_request_duration_seconds Latency of the Wazuh API calls.',
+        '# TYPE wazuh_api_request_duration_seconds histogram']
+    for item in items:
+        labels = 'source="%s",api="%s",method="%s",endpoint="%s"' % tuple(
+            escape_label(item[k]) for k in ('source', 'api', 'method', 'endpoint'))
+        s = item['series']
+        prometheus_histogram(lines, 'wazuh_api_request_duration_seconds', labels, LATENCY_BUCKETS, s['latency'], s['latency_sum'])
+    lines.extend([
+        '# HELP wazuh_api_response_size_bytes Body size of the Wazuh API responses.',
+        '# TYPE wazuh_api_response_size_bytes histogram'])
+    for item in items:
+        labels = 'source="%s",api="%s",method="%s",endpoint="%s"' % tuple(
+            escape_label(item[k]) for k in ('source', 'api', 'method', 'endpoint'))
+        s = item['series']
+        prometheus_histogram(lines, 'wazuh_api_response_size_bytes', labels, SIZE_BUCKETS, s['size'], s['size_sum'])
+    lines.extend([
+        '# HELP wazuh_api_request_errors_total Failed Wazuh API calls.',
+        '# TYPE wazuh_api_request_errors_total counter'])
+    for item in items:
+        labels = 'source="%s",api="%s",method="%s",endpoint="%s"' % tuple(
+            escape_label(item[k]) for k in ('source', 'api', 'method', 'endpoint'))
+        lines.append('wazuh_api_request_errors_total{%s} %s' % (labels, item['series']['errors']))
+    return '\n'.join(lines) + '\n'
+
+
+def response_failed(response):
+    """Check if a Wazuh API response is an error, looking only at the start of the body.
+
+    Parameters
+    ----------
+    response : requestsbak.Response
+        The upstream response
+    """
+    if response.status_code >= 400:
+        return True
+    if response.raw is not None and not response._content_consumed:
+        return False
+    return bool(error_code(response.content))
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """Return the process wide metrics registry."""
+    return _metrics
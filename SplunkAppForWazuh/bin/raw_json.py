@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Undecoded Wazuh API responses.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import re
+import codec
+
+# Keys hidden by api.clean_keys. A body without any of them is relayed as is.
+REDACTION_MARKERS = (b'"internal_key"', b'"key"', b'"wmodules"', b'"integration"')
+
+# The Wazuh API writes the error code as the first key of every response
+ERROR_CODE = re.compile(br'^\s*\{\s*"error"\s*:\s*(\d+)')
+
+
+def error_code(body):
+    """Read the error code from the start of a response body, None if it's not there.
+
+    Parameters
+    ----------
+    body : bytes
+        The response body
+    """
+    match = ERROR_CODE.match(body[:64]) if body else None
+    return int(match.group(1)) if match else None
+
+
+def needs_redaction(body):
+    """Check if a response body may contain keys that must be hidden.
+
+    Parameters
+    ----------
+    body : bytes
+        The response body
+    """
+    for marker in REDACTION_MARKERS:
+        if marker in body:
+            return True
+    return False
+
+
+class RawResponse():
+    """A Wazuh API response kept as the bytes to send to the browser.
+
+    The body is only decoded when a caller needs the parsed response.
+    """
+
+    def __init__(self, body, data=None):
+        """Constructor.
+
+        Parameters
+        ----------
+        body : bytes
+            The serialized response
+        data : dict
+            The parsed response, when it's already known
+        """
+        self.body = body
+        self.data = data
+        self.error = data['error'] if data is not None else error_code(body)
+
+    def json(self):
+        """Return the parsed response."""
+        if self.data is None:
+            self.data = codec.loads(self.body)
+        return self.data
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Wazuh API response cache.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from app_config import get_stanza
+from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
+
+# Time to live (seconds) for the most requested endpoints. Every other GET
+# uses the `default_ttl` value from the [cache] stanza of config.conf.
+ENDPOINT_TTLS = {
+    '/agents/summary': 10,
+    '/agents/summary/os': 30,
+    '/manager/info': 30,
+    '/manager/status': 10,
+    '/cluster/status': 15,
+    '/cluster/node': 30,
+    '/cluster/nodes': 15,
+    '/version': 60,
+    '/rules/pci': 60,
+    '/rules/gdpr': 60,
+    '/rules/hipaa': 60,
+    '/rules/nist-800-53': 60
+}
+
+# Files touched by the scripts of the app after they write to an API, for
+# the app server to drop what it cached from that API before
+STAMPS_PATH = make_splunkhome_path(['var', 'run', 'splunk', 'SplunkAppForWazuh', 'cache'])
+
+DEFAULT_CONFIG = {
+    'enabled': 'true',
+    'max_entries': '1000',
+    'default_ttl': '0'
+}
+
+
+class ResponseCache():
+    """In-process LRU cache for Wazuh API GET responses.
+
+    Entries are keyed by (API id, endpoint, normalized params) and expire
+    after a per-endpoint TTL. Any write request against an API drops every
+    entry cached for it, and so does a write signaled by another process
+    through `stamps_path`.
+    """
+
+    def __init__(self, max_entries=1000, default_ttl=0, ttls=None, enabled=True, stamps_path=None):
+        """Constructor."""
+        self.stamps_path = stamps_path
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.ttls = ttls if ttls is not None else ENDPOINT_TTLS
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def normalize_params(self, params):
+        """Return a hashable, order independent version of the params.
+
+        Parameters
+        ----------
+        params : dict
+            The request's query parameters
+        """
+        if not params:
+            return ()
+        return tuple(sorted((str(k), str(v)) for k, v in params.items()))
+
+    def ttl_for(self, endpoint):
+        """Get the time to live for an endpoint.
+
+        Parameters
+        ----------
+        endpoint : str
+            The Wazuh API endpoint
+        """
+        endpoint = endpoint.split('?')[0].rstrip('/') or '/'
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def get(self, api_id, endpoint, params):
+        """Return a cached response or None.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        endpoint : str
+            The Wazuh API endpoint
+        params : dict
+            The request's query parameters
+        """
+        if not self.enabled:
+            return None
+        key = (api_id, endpoint, self.normalize_params(params))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, created, response = entry
+            if expires < time.time() or written_since(api_id, created, self.stamps_path):
+                del self.entries[key]
+                self.misses += 1
+                return None
+            # Move the entry to the end to keep the LRU order
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return response
+
+    def set(self, api_id, endpoint, params, response):
+        """Store a response if its endpoint is cacheable.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        endpoint : str
+            The Wazuh API endpoint
+        params : dict
+            The request's query parameters
+        response : dict
+            The already cleaned Wazuh API response
+        """
+        if not self.enabled:
+            return
+        ttl = self.ttl_for(endpoint)
+        if ttl <= 0:
+            return
+        key = (api_id, endpoint, self.normalize_params(params))
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            now = time.time()
+            self.entries[key] = (now + ttl, now, response)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, api_id, prefixes=None):
+        """Drop the entries cached for an API.
+
+        Parameters
+        ----------
+        api_id : str
+            The API id
+        prefixes : tuple
+            Only drop the endpoints starting with one of these
+        """
+        with self.lock:
+            keys = [k for k in self.entries
+                    if k[0] == api_id and (prefixes is None or k[1].startswith(prefixes))]
+            for k in keys:
+                del self.entries[k]
+            self.invalidations += 1
+
+    def clear(self):
+        """Drop every cached entry."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return the cache counters."""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(float(self.hits) / total, 4) if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'ttls': self.ttls,
+                'default_ttl': self.default_ttl
+            }
+
+
+def stamp_path(api_id, path=STAMPS_PATH):
+    """Return the file touched when another process writes to an API.
+
+    Parameters
+    ----------
+    api_id : str
+        The API id
+    path : str
+        Directory of the stamps
+    """
+    return os.path.join(path, hashlib.md5(str(api_id).encode('utf-8')).hexdigest() + '.stamp')
+
+
+def signal_write(api_id, path=STAMPS_PATH):
+    """Tell the app server that a write request may have changed an API.
+
+    Parameters
+    ----------
+    api_id : str
+        The API id
+    path : str
+        Directory of the stamps
+    """
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        stamp = stamp_path(api_id, path)
+        open(stamp, 'a').close()
+        os.utime(stamp, None)
+    except (IOError, OSError):
+        pass
+
+
+def written_since(api_id, since, path=STAMPS_PATH):
+    """Check if another process signaled a write to an API after a time.
+
+    Parameters
+    ----------
+    api_id : str
+        The API id
+    since : float
+        Timestamp
+    path : str
+        Directory of the stamps, None to skip the check
+    """
+    if path is None:
+        return False
+    try:
+        # Some file systems round mtime down to the second
+        return os.path.getmtime(stamp_path(api_id, path)) >= since - 1
+    except (IOError, OSError):
+        return False
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process wide response cache, reading the [cache] stanza the first time."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = get_stanza('cache', DEFAULT_CONFIG)
+                _cache = ResponseCache(
+                    max_entries=int(config['max_entries']),
+                    default_ttl=int(config['default_ttl']),
+                    enabled=str(config['enabled']) == 'true',
+                    stamps_path=STAMPS_PATH)
+    return _cache
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Retry policy and circuit breakers for Wazuh API calls.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import random
+import threading
+import time
+from app_config import get_stanza
+
+DEFAULT_CONFIG = {
+    'max_attempts': '4',
+    'base_delay': '0.25',
+    'max_delay': '2',
+    'deadline': '30',
+    'failure_threshold': '5',
+    'reset_timeout': '30'
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is refused because the API is failing."""
+    pass
+
+
+class RetryPolicy():
+    """Exponential backoff with full jitter bounded by a deadline."""
+
+    def __init__(self, max_attempts=4, base_delay=0.25, max_delay=2.0, deadline=30.0):
+        """Constructor."""
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def start(self):
+        """Return the deadline of a new sequence of attempts."""
+        return time.time() + self.deadline
+
+    def remaining(self, deadline):
+        """Seconds left before the deadline.
+
+        Parameters
+        ----------
+        deadline : float
+            Timestamp returned by start()
+        """
+        return max(deadline - time.time(), 0)
+
+    def backoff(self, attempt, deadline):
+        """Wait before the next attempt. Return False when no attempt is left.
+
+        Parameters
+        ----------
+        attempt : int
+            Number of attempts already made
+        deadline : float
+            Timestamp returned by start()
+        """
+        if attempt >= self.max_attempts:
+            return False
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        if delay >= self.remaining(deadline):
+            return False
+        time.sleep(delay)
+        return True
+
+
+class CircuitBreaker():
+    """Fail fast while an API keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    refuses requests. Once `reset_timeout` seconds have passed it lets a
+    single request through (half open) to probe whether the API recovered.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        """Constructor."""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.probe_started = 0
+        self.rejected = 0
+
+    def before_request(self):
+        """Raise CircuitOpenError if the request must not be sent."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            # A probe that never reported back must not block the API forever
+            if self.state == self.HALF_OPEN and (not self.probing or time.time() - self.probe_started >= self.reset_timeout):
+                self.probing = True
+                self.probe_started = time.time()
+                return
+            self.rejected += 1
+            retry_after = max(int(self.reset_timeout - (time.time() - self.opened_at)), 1)
+            raise CircuitOpenError(
+                "Wazuh API %s is not responding, retry in %s seconds." % (self.name, retry_after))
+
+    def check_open(self):
+        """Raise CircuitOpenError while the breaker is open, without taking the probe slot."""
+        with self.lock:
+            elapsed = time.time() - self.opened_at
+            if self.state == self.OPEN and elapsed < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(
+                    "Wazuh API %s is not responding, retry in %s seconds." % (self.name, max(int(self.reset_timeout - elapsed), 1)))
+
+    def record_success(self):
+        """Close the breaker after a successful request."""
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        """Count a failed request, opening the breaker when needed."""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+            self.probing = False
+
+    def status(self):
+        """Return the breaker state."""
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opened_at': self.opened_at if self.state != self.CLOSED else None,
+                'rejected': self.rejected
+            }
+
+
+_config = None
+_breakers = {}
+_lock = threading.Lock()
+
+
+def get_config():
+    """Return the [retry] stanza of config.conf merged with the defaults."""
+    global _config
+    if _config is None:
+        _config = get_stanza('retry', DEFAULT_CONFIG)
+    return _config
+
+
+def get_retry_policy():
+    """Return a retry policy built from the configuration."""
+    config = get_config()
+    return RetryPolicy(
+        max_attempts=int(config['max_attempts']),
+        base_delay=float(config['base_delay']),
+        max_delay=float(config['max_delay']),
+        deadline=float(config['deadline']))
+
+
+def get_breaker(name):
+    """Return the process wide circuit breaker of an API.
+
+    Parameters
+    ----------
+    name : str
+        The API url
+    """
+    with _lock:
+        if name not in _breakers:
+            config = get_config()
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(config['failure_threshold']),
+                reset_timeout=float(config['reset_timeout']))
+        return _breakers[name]
+
+
+def breakers_status():
+    """Return the state of every known circuit breaker."""
+    with _lock:
+        breakers = list(_breakers.values())
+    return dict((b.name, b.status()) for b in breakers)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Coalescing of identical concurrent requests.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+
+
+class SingleFlight():
+    """Run a single call for every group of identical concurrent calls.
+
+    The first caller of a key executes the call, the callers arriving while
+    it is in flight wait for it and receive the same result or exception.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.collapsed = 0
+
+    def do(self, key, fn):
+        """Execute fn once for all the concurrent callers of key.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies equivalent calls
+        fn : callable
+            The call to execute
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.collapsed += 1
+                leader = False
+            else:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self.calls[key] = call
+                self.executed += 1
+                leader = True
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise e
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+    def stats(self):
+        """Return the coalescing counters."""
+        with self.lock:
+            return {
+                'in_flight': len(self.calls),
+                'executed': self.executed,
+                'collapsed': self.collapsed
+            }
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight():
+    """Return the process wide single flight group."""
+    return _single_flight
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - JSON codec micro-benchmark.
+
+Compares the JSON backends available to bin/codec.py on the recorded API
+responses of external_files/jsonOfuscatedResponses.js and on agent and
+rule lists shaped like the Wazuh API items. Run it with the Python of
+Splunk so the same backends are found:
+
+    $SPLUNK_HOME/bin/splunk cmd python tests/codec_benchmark.py [--items N]
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import re
+import sys
+import timeit
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_PATH, '..', 'SplunkAppForWazuh', 'bin'))
+
+import codec  # noqa: E402
+
+
+def recorded_responses():
+    """Read the responses of jsonOfuscatedResponses.js as JSON strings."""
+    with open(os.path.join(TESTS_PATH, 'external_files', 'jsonOfuscatedResponses.js')) as f:
+        content = f.read()
+    content = content[:content.index('module.exports')]
+    documents = re.split(r'^const (\w+) = ', content, flags=re.M)[1:]
+    return dict(zip(documents[0::2], (doc.strip() for doc in documents[1::2])))
+
+
+def agent_items(count):
+    """Build a /agents response with flat items."""
+    return [{
+        'id': '%03d' % i,
+        'name': 'agent-%d' % i,
+        'ip': '10.0.%d.%d' % (i // 256 % 256, i % 256),
+        'status': 'Active' if i % 7 else 'Disconnected',
+        'node_name': 'node01',
+        'version': 'Wazuh v3.9.0',
+        'dateAdd': '2019-05-06 10:11:12',
+        'lastKeepAlive': '2019-06-06 10:11:12',
+        'manager': 'wazuh-manager'
+    } for i in range(count)]
+
+
+def rule_items(count):
+    """Build a /rules response with flat items."""
+    return [{
+        'id': 5500 + i,
+        'file': '0095-sshd_rules.xml',
+        'path': 'ruleset/rules',
+        'level': i % 16,
+        'status': 'enabled',
+        'description': 'sshd: authentication failed – attempt %d' % i,
+        'frequency': None,
+        'pci': i % 2 == 0
+    } for i in range(count)]
+
+
+def best_of(fn, number):
+    """Return the best time per call of fn, in microseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the JSON backends of bin/codec.py.')
+    parser.add_argument('--items', type=int, default=5000, help='items of the generated lists')
+    args = parser.parse_args()
+
+    payloads = dict((name, codec.loads(text)) for name, text in recorded_responses().items())
+    payloads['agents'] = {'error': 0, 'data': {'totalItems': args.items, 'items': agent_items(args.items)}}
+    payloads['rules'] = {'error': 0, 'data': {'totalItems': args.items, 'items': rule_items(args.items)}}
+
+    info = codec.backend_info()
+    print('Active backend: %s (accelerated: %s)' % (info['backend'], info['accelerated']))
+    print('%-14s %-8s %14s %14s' % ('payload', 'backend', 'loads (us)', 'dumps (us)'))
+    for name in sorted(payloads):
+        document = payloads[name]
+        text = codec.dumps(document)
+        number = 5 if name in ('agents', 'rules') else 2000
+        for backend in info['available']:
+            loads, dumps = codec.IMPLEMENTATIONS[backend]
+            print('%-14s %-8s %14.1f %14.1f' % (
+                name, backend,
+                best_of(lambda: loads(text), number),
+                best_of(lambda: dumps(document), number)))
+
+    print('')
+    print('One JSON line per item (%d items)' % args.items)
+    print('%-14s %-22s %14s' % ('payload', 'method', 'time (ms)'))
+    for name in ('agents', 'rules'):
+        items = payloads[name]['data']['items']
+        for backend in info['available']:
+            dumps = codec.IMPLEMENTATIONS[backend][1]
+            print('%-14s %-22s %14.2f' % (
+                name, backend + ' per item',
+                best_of(lambda: [dumps(item) for item in items], 5) / 1000))
+        print('%-14s %-22s %14.2f' % (
+            name, 'encode_flat_records', best_of(lambda: codec.encode_flat_records(items), 5) / 1000))
+        print('%-14s %-22s %14.2f' % (
+            name, 'dumps_records', best_of(lambda: codec.dumps_records(items), 5) / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Local stand-in for the Splunk HTTP Event Collector.
+
+Accepts the batches sent by bin/event_writer.py with output = hec in the
+[event_output] stanza of config.conf, so the HEC mode can be exercised
+without a Splunk indexer. It can also answer 503 now and then or answer
+slowly, to check the retries and the back-pressure of the writer:
+
+    python tests/hec_standin.py --port 8088 --token test --busy-every 3 --delay 0.5
+
+and then set url = http://localhost:8088 and token = test.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+from __future__ import print_function
+import argparse
+import gzip
+import io
+import json
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+stats = {'requests': 0, 'batches': 0, 'events': 0, 'busy': 0, 'rejected': 0}
+stats_lock = threading.Lock()
+
+
+def parse_events(body):
+    """Split a HEC body into its JSON events."""
+    decoder = json.JSONDecoder()
+    text = body.decode('utf-8')
+    events = []
+    index = 0
+    while True:
+        while index < len(text) and text[index].isspace():
+            index += 1
+        if index >= len(text):
+            return events
+        event, index = decoder.raw_decode(text, index)
+        events.append(event)
+
+
+class HecHandler(BaseHTTPRequestHandler):
+    """Answer the requests like /services/collector/event does."""
+
+    options = None
+
+    def reply(self, status, text, code):
+        body = json.dumps({'text': text, 'code': code}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        options = self.options
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with stats_lock:
+            stats['requests'] += 1
+            request_number = stats['requests']
+        if options.delay:
+            time.sleep(options.delay)
+        if self.path.rstrip('/') != '/services/collector/event':
+            return self.reply(404, 'Not found', 404)
+        if self.headers.get('Authorization') != 'Splunk %s' % options.token:
+            with stats_lock:
+                stats['rejected'] += 1
+            return self.reply(403, 'Invalid token', 4)
+        if options.busy_every and request_number % options.busy_every == 0:
+            with stats_lock:
+                stats['busy'] += 1
+            return self.reply(503, 'Server is busy', 9)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        try:
+            events = parse_events(body)
+        except ValueError:
+            return self.reply(400, 'Invalid data format', 6)
+        if any('event' not in event for event in events):
+            return self.reply(400, 'Event field is required', 12)
+        with stats_lock:
+            stats['batches'] += 1
+            stats['events'] += len(events)
+            if options.output:
+                with open(options.output, 'a') as f:
+                    for event in events:
+                        f.write(json.dumps(event) + '\n')
+        return self.reply(200, 'Success', 0)
+
+    def log_message(self, format, *args):
+        if not self.options.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Splunk HTTP Event Collector.')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--token', default='test')
+    parser.add_argument('--busy-every', type=int, default=0, help='answer 503 to every Nth request')
+    parser.add_argument('--delay', type=float, default=0, help='seconds to wait before answering')
+    parser.add_argument('--output', help='file where the received events are appended')
+    parser.add_argument('--quiet', action='store_true')
+    HecHandler.options = parser.parse_args()
+    server = HTTPServer(('127.0.0.1', HecHandler.options.port), HecHandler)
+    print('HEC stand-in listening on http://127.0.0.1:%s' % HecHandler.options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
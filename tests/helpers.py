@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Helpers for the unit tests of the bin/ modules.
+
+Importing this module makes SplunkAppForWazuh/bin importable. When the
+tests don't run with the Python of Splunk, the parts of the Splunk SDK
+used by the app are replaced by stand-ins: the configuration is read from
+default/config.conf, $SPLUNK_HOME is a temporary directory and the KV
+store endpoints point to a splunkd that isn't there. CherryPy, bundled
+with Splunk Web, is replaced too when it's not installed.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+
+try:
+    from configparser import RawConfigParser
+except ImportError:
+    from ConfigParser import RawConfigParser
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(TESTS_PATH, '..', 'SplunkAppForWazuh')
+BIN_PATH = os.path.join(APP_PATH, 'bin')
+SPLUNKD = 'https://127.0.0.1:8089'
+
+if BIN_PATH not in sys.path:
+    sys.path.insert(0, BIN_PATH)
+
+# Stands for $SPLUNK_HOME when Splunk isn't installed
+SPLUNK_HOME = tempfile.mkdtemp(prefix='wazuh-splunk-tests-')
+
+
+def add_module(name, **attributes):
+    """Register an empty module, and its parents, with some attributes."""
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        if '.' in name:
+            parent, child = name.rsplit('.', 1)
+            setattr(add_module(parent), child, module)
+    for key, value in attributes.items():
+        setattr(module, key, value)
+    return module
+
+
+def load_controller(name):
+    """Import a module of appserver/controllers, some of them shadow the standard library."""
+    path = os.path.join(APP_PATH, 'appserver', 'controllers', '%s.py' % name)
+    spec = importlib.util.spec_from_file_location('controllers_%s' % name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def getConfStanza(conf, stanza):
+    parser = RawConfigParser()
+    parser.optionxform = str
+    parser.read(os.path.join(APP_PATH, 'default', '%s.conf' % conf))
+    return dict(parser.items(stanza))
+
+
+def make_splunkhome_path(parts):
+    return os.path.join(SPLUNK_HOME, *parts)
+
+
+def buildEndpoint(entityClass, entityName, owner, namespace, hostPath):
+    return '/'.join([hostPath, 'servicesNS', owner, namespace] + entityClass + [entityName])
+
+
+def expose_page(**kwargs):
+    return lambda handler: handler
+
+
+class BaseController(object):
+    pass
+
+
+try:
+    from splunk.clilib import cli_common  # noqa: F401
+except ImportError:
+    # log.py relies on splunkd having imported logging.handlers
+    import logging.handlers  # noqa: F401
+    os.makedirs(make_splunkhome_path(['var', 'log', 'splunk']))
+    add_module('splunk', getSessionKey=lambda: 'session-key')
+    add_module('splunk.clilib.cli_common', getConfStanza=getConfStanza)
+    add_module('splunk.appserver.mrsparkle.lib.util', make_splunkhome_path=make_splunkhome_path)
+    add_module('splunk.appserver.mrsparkle.lib.decorators', expose_page=expose_page)
+    add_module('splunk.appserver.mrsparkle.controllers', BaseController=BaseController)
+    add_module('splunk.entity', buildEndpoint=buildEndpoint)
+    add_module('splunk.rest', makeSplunkdUri=lambda: SPLUNKD + '/')
+
+try:
+    import cherrypy  # noqa: F401
+except ImportError:
+    # Splunk Web bundles CherryPy, the controllers only set response headers
+    add_module('cherrypy', response=types.SimpleNamespace(headers={}, status=200))
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the admission control of bin/admission.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import helpers  # noqa: F401
+from admission import (
+    BusyError, SharedTokenBucket, TokenBucket, BACKGROUND, CLAIM_TTL, INTERACTIVE)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_is_admitted_straight_away(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(bucket.stats()['admitted'], 3)
+
+    def test_interactive_requests_go_first(self):
+        bucket = TokenBucket(rate=20, burst=1, max_wait=5)
+        bucket.acquire()
+        order = []
+
+        def request(priority, name):
+            bucket.acquire(priority)
+            order.append(name)
+
+        threads = []
+        for priority, name in [(BACKGROUND, 'report'), (BACKGROUND, 'queue'), (INTERACTIVE, 'panel')]:
+            thread = threading.Thread(target=request, args=(priority, name))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['panel', 'report', 'queue'])
+
+    def test_full_queue_is_rejected(self):
+        bucket = TokenBucket(rate=0.1, burst=1, max_queue=0)
+        bucket.acquire()
+        self.assertRaises(BusyError, bucket.acquire)
+        self.assertEqual(bucket.stats()['rejected'], 1)
+
+    def test_wait_is_bounded(self):
+        bucket = TokenBucket(rate=0.1, burst=1, max_wait=0.05)
+        bucket.acquire()
+        start = time.time()
+        self.assertRaises(BusyError, bucket.acquire, BACKGROUND)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(bucket.stats()['waiting'], 0)
+
+
+class SharedTokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        state = os.path.join(self.path, 'api.json')
+        # Two buckets on the same state file stand for two processes
+        self.panel = SharedTokenBucket(state, rate=10, burst=1)
+        self.panel.claim = 'splunkweb'
+        self.queue = SharedTokenBucket(state, rate=10, burst=1)
+        self.queue.claim = 'check_queue'
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_tokens_are_shared(self):
+        now = time.time()
+        self.assertEqual(self.panel.take(INTERACTIVE, now), 0)
+        self.assertGreater(self.queue.take(BACKGROUND, now), 0)
+
+    def test_interactive_waiter_holds_back_other_processes(self):
+        now = time.time()
+        self.assertEqual(self.queue.take(BACKGROUND, now), 0)
+        self.assertGreater(self.panel.take(INTERACTIVE, now), 0)
+        # A token is available again, but the panel request is waiting for it
+        self.assertGreater(self.queue.take(BACKGROUND, now + 0.2), 0)
+        self.assertEqual(self.panel.take(INTERACTIVE, now + 0.2), 0)
+        self.assertEqual(self.queue.take(BACKGROUND, now + 0.4), 0)
+
+    def test_claims_expire(self):
+        now = time.time()
+        self.queue.take(BACKGROUND, now)
+        self.panel.take(INTERACTIVE, now)
+        self.assertEqual(self.queue.take(BACKGROUND, now + CLAIM_TTL + 0.1), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the settings reader of bin/app_config.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import unittest
+
+import helpers  # noqa: F401
+import app_config
+
+
+class GetStanzaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.getConfStanza = app_config.cli.getConfStanza
+
+    def tearDown(self):
+        app_config.cli.getConfStanza = self.getConfStanza
+
+    def test_stanza_overrides_the_defaults(self):
+        app_config.cli.getConfStanza = lambda conf, stanza: {'rate': '5'}
+        config = app_config.get_stanza('rate_limit', {'rate': '20', 'burst': '40'})
+        self.assertEqual(config, {'rate': '5', 'burst': '40'})
+
+    def test_defaults_when_the_stanza_cant_be_read(self):
+        defaults = {'rate': '20'}
+
+        def missing(conf, stanza):
+            raise KeyError(stanza)
+        app_config.cli.getConfStanza = missing
+        config = app_config.get_stanza('rate_limit', defaults)
+        self.assertEqual(config, defaults)
+        self.assertIsNot(config, defaults)
+
+
+if __name__ == '__main__':
+    unittest.main()
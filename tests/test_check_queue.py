@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the jobs runner of bin/check_queue.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import io
+import json
+import sys
+import threading
+import time
+import unittest
+
+import helpers  # noqa: F401
+from check_queue import CheckQueue, Scheduler
+from jobs_queue import signal_change
+
+
+class FakeResponse():
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeWazuhAPI():
+    """Session answering every request with success, but for the failing endpoints."""
+
+    def __init__(self, events, failing=(), delay=0):
+        self.events = events
+        self.failing = failing
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def request(self, method, url, **kwargs):
+        endpoint = url.split(':55000', 1)[1]
+        with self.lock:
+            self.events.append(('run', endpoint))
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return FakeResponse({'error': 1 if endpoint in self.failing else 0, 'data': {}})
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+class FakeJobsQueue():
+    """Holds the pending jobs and records the removals, failing the first `failures` of them."""
+
+    def __init__(self, events, failures=0):
+        self.events = events
+        self.failures = failures
+        self.removed = []
+        self.jobs = []
+
+    def get_jobs(self, session_key=False, due_before=None, limit=None):
+        due = sorted([j for j in self.jobs if j['exec_time'] < due_before], key=lambda j: j['exec_time'])
+        return json.dumps(due[:limit])
+
+    def remove_jobs(self, keys, session_key=False):
+        if self.failures:
+            self.failures -= 1
+            raise Exception('KV Store is initializing. Please try again later.')
+        self.events.append(('remove', sorted(keys)))
+        self.removed.extend(keys)
+
+
+class FakeCredentials():
+
+    def get(self, api_id, session_key=None):
+        return {}, 'https://%s:55000' % api_id, None
+
+
+def make_check_queue(events, failing=(), delay=0, failures=0, **config):
+    stdin = sys.stdin
+    sys.stdin = io.StringIO(u'session-key\n')
+    try:
+        cq = CheckQueue()
+    finally:
+        sys.stdin = stdin
+    cq.session = FakeWazuhAPI(events, failing, delay)
+    cq.q = FakeJobsQueue(events, failures)
+    cq.credentials = FakeCredentials()
+    cq.config.update(config)
+    return cq
+
+
+def job(key, endpoint, exec_time=1, api_id='manager1', method='PUT', **params):
+    return {
+        '_key': key,
+        'job': dict(params, apiId=api_id, endpoint=endpoint, method=method),
+        'exec_time': exec_time,
+        'done': False
+    }
+
+
+class CheckTodoJobsTest(unittest.TestCase):
+
+    def test_each_job_runs_once_and_is_removed(self):
+        events = []
+        cq = make_check_queue(events, failing=('/agents/002/restart',))
+        cq.check_todo_jobs([
+            job('a', '/agents/001/restart', 3),
+            job('b', '/agents/002/restart', 1),
+            job('c', '/agents/003/restart', 2)], now=10)
+        runs = [endpoint for kind, endpoint in events if kind == 'run']
+        self.assertEqual(sorted(runs), ['/agents/001/restart', '/agents/002/restart', '/agents/003/restart'])
+        # The failed job stays in the queue for the next run
+        self.assertEqual(sorted(cq.q.removed), ['a', 'c'])
+
+    def test_jobs_are_removed_as_they_finish(self):
+        events = []
+        cq = make_check_queue(events, max_workers='1')
+        cq.check_todo_jobs([job('a', '/agents/001/restart', 1), job('b', '/agents/002/restart', 2)], now=10)
+        self.assertEqual(events, [
+            ('run', '/agents/001/restart'), ('remove', ['a']),
+            ('run', '/agents/002/restart'), ('remove', ['b'])])
+
+    def test_jobs_not_due_dont_run(self):
+        events = []
+        cq = make_check_queue(events)
+        cq.check_todo_jobs([job('a', '/agents/001/restart', 20)], now=10)
+        self.assertEqual(events, [])
+
+    def test_duplicated_requests_run_once(self):
+        events = []
+        cq = make_check_queue(events)
+        cq.check_todo_jobs([
+            job('a', '/agents/001/restart', 1),
+            job('b', '/agents/001/restart', 2),
+            job('a', '/agents/001/restart', 1)], now=10)
+        self.assertEqual([e for e in events if e[0] == 'run'], [('run', '/agents/001/restart')])
+        self.assertEqual(sorted(cq.q.removed), ['a', 'b'])
+
+    def test_duplicates_of_a_failed_job_stay(self):
+        events = []
+        cq = make_check_queue(events, failing=('/agents/001/restart',))
+        cq.check_todo_jobs([job('a', '/agents/001/restart', 1), job('b', '/agents/001/restart', 2)], now=10)
+        self.assertEqual(cq.q.removed, [])
+
+    def test_failed_removals_are_retried(self):
+        events = []
+        cq = make_check_queue(events, failures=1, max_workers='1')
+        cq.check_todo_jobs([job('a', '/agents/001/restart', 1), job('b', '/agents/002/restart', 2)], now=10)
+        self.assertEqual(sorted(cq.q.removed), ['a', 'b'])
+        self.assertEqual(cq.finished, [])
+
+    def test_workers_per_api_are_bounded(self):
+        events = []
+        cq = make_check_queue(events, delay=0.02, max_workers='8', max_per_api='1')
+        cq.check_todo_jobs([job(str(i), '/agents/00%s/restart' % i, i) for i in range(4)], now=10)
+        self.assertEqual(cq.session.peak, 1)
+        self.assertEqual(len(cq.q.removed), 4)
+        self.assertEqual(cq.running, 0)
+        self.assertEqual(cq.running_by_api, {})
+
+    def test_workers_are_shared_by_the_apis(self):
+        events = []
+        cq = make_check_queue(events, delay=0.02, max_workers='2', max_per_api='2')
+        cq.check_todo_jobs([
+            job(str(i), '/agents/00%s/restart' % i, i, api_id='manager%s' % (i % 3)) for i in range(6)], now=10)
+        self.assertEqual(cq.session.peak, 2)
+        self.assertEqual(len(cq.q.removed), 6)
+
+
+class CoalesceRestartsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cq = make_check_queue([])
+
+    def test_restarts_of_an_api_merge_into_one(self):
+        jobs = [job('a', '/agents/003/restart', 1), job('b', '/agents/001/restart', 2),
+                job('c', '/agents/003/restart', 3)]
+        to_run, merged = self.cq.coalesce_restarts(jobs)
+        self.assertEqual(to_run, [{
+            '_key': 'a',
+            'job': {'apiId': 'manager1', 'endpoint': '/agents/restart', 'method': 'POST', 'ids': ['001', '003']},
+            'exec_time': 1,
+            'done': False
+        }])
+        self.assertEqual(merged, {'a': ['b', 'c']})
+
+    def test_restarts_of_different_apis_stay_separate(self):
+        jobs = [job('a', '/agents/001/restart', 1), job('b', '/agents/002/restart', 2, api_id='manager2'),
+                job('c', '/agents/003/restart', 3), job('d', '/agents/004/restart', 4, api_id='manager2')]
+        to_run, merged = self.cq.coalesce_restarts(jobs)
+        self.assertEqual([(j['_key'], j['job']['apiId'], j['job']['ids']) for j in to_run],
+                         [('a', 'manager1', ['001', '003']), ('b', 'manager2', ['002', '004'])])
+        self.assertEqual(merged, {'a': ['c'], 'b': ['d']})
+
+    def test_single_restart_and_other_jobs_are_kept(self):
+        jobs = [job('a', '/agents/001/restart', 1), job('b', '/agents/002/restart', 2, method='GET'),
+                job('c', '/agents/groups', 3), job('d', '/agents/003/restart', 4, api_id='manager2')]
+        to_run, merged = self.cq.coalesce_restarts(jobs)
+        self.assertEqual(to_run, jobs)
+        self.assertEqual(merged, {})
+
+    def test_merged_restarts_are_removed_after_the_bulk_restart(self):
+        events = []
+        cq = make_check_queue(events, coalesce_restarts='true')
+        cq.check_todo_jobs([job('a', '/agents/001/restart', 1), job('b', '/agents/002/restart', 2)], now=10)
+        self.assertEqual([event for event in events if event[0] == 'run'], [('run', '/agents/restart')])
+        self.assertEqual(sorted(cq.q.removed), ['a', 'b'])
+
+
+class JobFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cq = make_check_queue([])
+
+    def test_identical_jobs_run_once(self):
+        events = []
+        cq = make_check_queue(events)
+        cq.check_todo_jobs([job('a', '/agents/001/restart', 1, pretty=True),
+                            job('b', '/agents/001/restart', 2, pretty=True)], now=10)
+        self.assertEqual([event for event in events if event[0] == 'run'], [('run', '/agents/001/restart')])
+        self.assertEqual(sorted(cq.q.removed), ['a', 'b'])
+
+    def test_jobs_differing_in_method_params_or_api_dont_collapse(self):
+        base = job('a', '/agents/001/restart', pretty=True)
+        others = [job('b', '/agents/001/restart', method='POST', pretty=True),
+                  job('c', '/agents/001/restart', pretty=False),
+                  job('d', '/agents/001/restart', api_id='manager2', pretty=True)]
+        fingerprints = set(self.cq.get_job_fingerprint(j) for j in [base] + others)
+        self.assertEqual(len(fingerprints), 4)
+
+    def test_stored_fingerprint_is_used(self):
+        self.assertEqual(self.cq.get_job_fingerprint(dict(job('a', '/agents/001/restart'), fingerprint='f')), 'f')
+
+    def test_malformed_job_falls_back_to_its_key(self):
+        self.assertEqual(self.cq.get_job_fingerprint({'_key': 'a', 'job': None}), 'a')
+
+
+class Clock():
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.cq = make_check_queue(self.events, resync_interval='60')
+        self.batches = []
+        self.cq.check_todo_jobs = lambda jobs, now: self.batches.append(([j['_key'] for j in jobs], now))
+        self.clock = Clock(1000.0)
+        self.scheduler = Scheduler(self.cq, clock=self.clock)
+
+    def add_jobs(self, *jobs):
+        self.cq.q.jobs.extend(jobs)
+        signal_change()
+
+    def finish_runs(self):
+        for thread in self.scheduler.threads:
+            thread.join(5)
+
+    def test_due_jobs_run_in_exec_time_order(self):
+        self.add_jobs(job('c', '/agents/003/restart', 1003), job('a', '/agents/001/restart', 990),
+                      job('b', '/agents/002/restart', 1001), job('d', '/agents/004/restart', 2000))
+        self.scheduler.load()
+        # Jobs due after the next resync are left for it
+        self.assertEqual([entry[2]['_key'] for entry in sorted(self.scheduler.heap)], ['a', 'b', 'c'])
+        self.scheduler.run_due()
+        self.clock.now = 1002.0
+        self.scheduler.run_due()
+        self.finish_runs()
+        self.assertEqual(self.batches, [(['a'], 1000.0), (['b'], 1002.0)])
+        self.assertEqual([entry[2]['_key'] for entry in self.scheduler.heap], ['c'])
+
+    def test_sleeps_until_the_next_job(self):
+        self.add_jobs(job('a', '/agents/001/restart', 1000.2))
+        self.assertAlmostEqual(self.scheduler.tick(), 0.2)
+        self.clock.now = 1000.3
+        # Nothing left, so it only sleeps for the poll interval
+        self.assertEqual(self.scheduler.tick(), self.scheduler.poll_interval)
+        self.finish_runs()
+        self.assertEqual(self.batches, [(['a'], 1000.3)])
+
+    def test_jobs_that_ran_wait_for_the_resync_interval(self):
+        self.add_jobs(job('a', '/agents/001/restart', 990))
+        self.scheduler.load()
+        self.scheduler.run_due()
+        self.finish_runs()
+        # The job failed and is still in the queue
+        self.clock.now = 1010.0
+        self.scheduler.load()
+        self.assertEqual([entry[0] for entry in self.scheduler.heap], [1060.0])
+        self.scheduler.run_due()
+        self.clock.now = 1061.0
+        self.scheduler.load()
+        self.scheduler.run_due()
+        self.finish_runs()
+        self.assertEqual([keys for keys, now in self.batches], [['a'], ['a']])
+
+    def test_running_jobs_are_not_scheduled_again(self):
+        self.add_jobs(job('a', '/agents/001/restart', 990))
+        self.scheduler.load()
+        self.scheduler.running.add('a')
+        self.scheduler.ran = {}
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.heap, [])
+
+    def test_job_added_while_sleeping_is_loaded(self):
+        self.scheduler.tick()
+        self.assertEqual(self.scheduler.heap, [])
+        # Added by the app server meanwhile, well before the next resync
+        self.clock.now = 1001.0
+        self.add_jobs(job('a', '/agents/001/restart', 1001.5))
+        self.assertAlmostEqual(self.scheduler.tick(), 0.5)
+        self.clock.now = 1002.0
+        self.scheduler.tick()
+        self.finish_runs()
+        self.assertEqual(self.batches, [(['a'], 1002.0)])
+
+    def test_resync_after_the_interval_without_signal(self):
+        self.scheduler.tick()
+        self.cq.q.jobs.append(job('a', '/agents/001/restart', 1030))
+        self.clock.now = 1030.0
+        self.scheduler.tick()
+        self.assertEqual(self.scheduler.heap, [])
+        self.clock.now = 1060.0
+        self.scheduler.tick()
+        self.finish_runs()
+        self.assertEqual(self.batches, [(['a'], 1060.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the JSON codec of bin/codec.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import json
+import unittest
+
+import helpers  # noqa: F401
+import codec
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        document = {'data': {'items': [{'id': '001', 'status': 'Active'}], 'totalItems': 1}, 'error': 0}
+        self.assertEqual(codec.loads(codec.dumps(document)), document)
+
+    def test_dumps_compatible_matches_json(self):
+        value = {'rule': {'level': 3, 'pci_dss': ['10.6.1']}, 'score': float('nan'), 'max': float('inf')}
+        self.assertEqual(codec.dumps_compatible(value), json.dumps(value))
+
+    def test_records_match_json(self):
+        records = [{'id': '001', 'ip': '10.0.0.1', 'port': 1514, 'os': {'name': 'Ubuntu'}}, {}]
+        self.assertEqual(
+            [json.loads(record) for record in codec.dumps_records(records)], records)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Tests of the HEC writer of bin/event_writer.py against tests/hec_standin.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import helpers  # noqa: F401
+import hec_standin
+from event_writer import HecWriter
+from retry_policy import RetryPolicy
+
+
+class HecWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmp, 'events.json')
+        for key in hec_standin.stats:
+            hec_standin.stats[key] = 0
+
+    def tearDown(self):
+        if getattr(self, 'server', None) is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def start_hec(self, busy_every=0, delay=0):
+        options = argparse.Namespace(token='test', busy_every=busy_every, delay=delay, output=self.output, quiet=True)
+        handler = type('Handler', (hec_standin.HecHandler,), {'options': options})
+        self.server = hec_standin.HTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def make_writer(self, url, token='test', max_attempts=5, **kwargs):
+        writer = HecWriter(url, token, index='wazuh', sourcetype='_json', batch_bytes=1, **kwargs)
+        writer.policy = RetryPolicy(max_attempts=max_attempts, base_delay=0.01, max_delay=0.05, deadline=10.0)
+        return writer
+
+    def received(self):
+        if not os.path.exists(self.output):
+            return []
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def write_batches(self, writer, batches, size=10, timeout=None):
+        for batch in range(batches):
+            writer.write_records([{'id': batch * size + n} for n in range(size)], timeout=timeout)
+
+    def test_every_event_arrives_once_despite_busy_answers(self):
+        writer = self.make_writer(self.start_hec(busy_every=3))
+        self.write_batches(writer, 20)
+        writer.flush(timeout=30)
+        events = self.received()
+        self.assertEqual(sorted(event['event']['id'] for event in events), list(range(200)))
+        self.assertTrue(all(event['index'] == 'wazuh' for event in events))
+        self.assertGreater(hec_standin.stats['busy'], 0)
+        self.assertEqual(hec_standin.stats['requests'], 20 + hec_standin.stats['busy'])
+        self.assertEqual(writer.stats(), {'sent': 20, 'dropped': 0, 'pending': 0})
+
+    def test_callers_block_while_the_queue_is_full(self):
+        writer = self.make_writer(self.start_hec(delay=0.3), max_pending=1)
+        self.write_batches(writer, 1)
+        # The first batch is still being sent, so there is no room for another one
+        with self.assertRaises(Exception):
+            writer.write_records([{'id': 10}], timeout=0.05)
+        self.assertEqual(writer.stats()['pending'], 1)
+        start = time.time()
+        writer.write_records([{'id': 11}])
+        self.assertGreater(time.time() - start, 0.1)
+        writer.flush(timeout=30)
+        # The events that found no room stayed buffered and were sent later
+        self.assertEqual(sorted(event['event']['id'] for event in self.received()), list(range(12)))
+        self.assertEqual(writer.stats(), {'sent': 2, 'dropped': 0, 'pending': 0})
+
+    def test_batches_are_dropped_when_attempts_are_exhausted(self):
+        writer = self.make_writer(self.start_hec(busy_every=1), max_attempts=2)
+        self.write_batches(writer, 3)
+        writer.flush(timeout=30)
+        self.assertEqual(self.received(), [])
+        self.assertEqual(hec_standin.stats['busy'], 6)
+        self.assertEqual(writer.stats(), {'sent': 0, 'dropped': 3, 'pending': 0})
+
+    def test_rejected_batches_are_not_sent_again(self):
+        writer = self.make_writer(self.start_hec(), token='wrong')
+        self.write_batches(writer, 2)
+        writer.flush(timeout=30)
+        self.assertEqual(hec_standin.stats['rejected'], 2)
+        self.assertEqual(writer.stats(), {'sent': 0, 'dropped': 2, 'pending': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the concurrent execution of bin/fan_out.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+import time
+import unittest
+
+import helpers  # noqa: F401
+from fan_out import fan_out, fetch_pages
+
+
+class FanOutTest(unittest.TestCase):
+
+    def test_results_and_errors_are_split(self):
+        def fail():
+            raise ValueError('Wazuh API down')
+        results, errors = fan_out({'hardware': lambda: 'hw', 'os': fail})
+        self.assertEqual(results, {'hardware': 'hw'})
+        self.assertEqual(list(errors), ['os'])
+        self.assertIsInstance(errors['os'], ValueError)
+
+    def test_workers_are_bounded(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def task():
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+            return True
+
+        results, errors = fan_out(dict((i, task) for i in range(6)), max_workers=2)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(state['peak'], 2)
+
+    def test_groups_are_bounded(self):
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def task(group):
+            def run():
+                with lock:
+                    running[group] = running.get(group, 0) + 1
+                    peaks[group] = max(peaks.get(group, 0), running[group])
+                time.sleep(0.02)
+                with lock:
+                    running[group] -= 1
+            return run
+
+        tasks = dict(('%s-%s' % (group, i), task(group)) for group in 'ab' for i in range(3))
+        groups = dict((name, name[0]) for name in tasks)
+        results, errors = fan_out(tasks, max_workers=4, groups=groups, max_per_group=1)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(peaks, {'a': 1, 'b': 1})
+
+    def test_slow_tasks_time_out(self):
+        start = time.time()
+        results, errors = fan_out({'fast': lambda: 1, 'slow': lambda: time.sleep(1)}, timeout=0.1)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(results, {'fast': 1})
+        self.assertIn('slow', errors)
+
+
+class FetchPagesTest(unittest.TestCase):
+
+    def test_pages_are_yielded_in_order(self):
+        def fetch(offset):
+            time.sleep(0.01 * (3 - offset // 10))
+            return offset
+        self.assertEqual(list(fetch_pages(fetch, [0, 10, 20, 30], max_in_flight=3)), [0, 10, 20, 30])
+
+    def test_failed_pages_are_retried(self):
+        attempts = {}
+
+        def fetch(offset):
+            attempts[offset] = attempts.get(offset, 0) + 1
+            if attempts[offset] < 2:
+                raise IOError('Connection reset')
+            return offset
+        self.assertEqual(list(fetch_pages(fetch, [0, 10], retries=1)), [0, 10])
+
+    def test_page_failing_every_attempt_raises(self):
+        def fetch(offset):
+            raise IOError('Connection reset')
+        self.assertRaises(IOError, list, fetch_pages(fetch, [0], retries=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the checkpoints of bin/get_agents_status.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import json
+import os
+import unittest
+
+import helpers  # noqa: F401
+import atomic_file
+import get_agents_status
+from get_agents_status import Checkpoint
+
+CONFIG = dict(get_agents_status.DEFAULT_CONFIG, incremental='true', deadline='30')
+
+
+class FakeResponse():
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def iter_content(self, size):
+        body = json.dumps(self.data).encode('utf-8')
+        return iter([body[i:i + 10] for i in range(0, len(body), 10)])
+
+    def close(self):
+        pass
+
+
+class FakeWazuhAPI():
+    """Answers the cluster status and the agents pages of a standalone manager."""
+
+    def __init__(self, agents):
+        self.agents = agents
+
+    def get(self, url, **kwargs):
+        if url.endswith('/cluster/status'):
+            return FakeResponse({'error': 0, 'data': {'enabled': 'no'}})
+        data = {'totalItems': len(self.agents)}
+        if kwargs.get('stream'):
+            data['items'] = self.agents
+        return FakeResponse({'error': 0, 'data': data})
+
+
+class FakeDB():
+
+    def all(self, session_key=False):
+        return json.dumps([{'_key': 'manager1', 'url': 'https://wazuh', 'portapi': '55000',
+                            'userapi': 'foo', 'passapi': 'bar'}])
+
+
+class FakeWriter():
+    """Keeps the events, failing the flush or dropping batches when asked to."""
+
+    def __init__(self, fail_flush=False, drop=False):
+        self.fail_flush = fail_flush
+        self.drop = drop
+        self.events = []
+        self.dropped = 0
+
+    def write_records(self, records, timeout=None):
+        self.events.extend(records)
+
+    def flush(self, timeout=None):
+        if self.fail_flush:
+            raise Exception('HTTP Event Collector is not keeping up, 8 batches waiting.')
+        if self.drop:
+            self.dropped += 1
+
+    def stats(self):
+        return {'sent': 0, 'dropped': self.dropped, 'pending': 0}
+
+
+def agent(agent_id, status='Active'):
+    return {'id': agent_id, 'ip': '10.0.0.%s' % int(agent_id), 'manager': 'wazuh-manager', 'status': status}
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((name, getattr(get_agents_status, name))
+                          for name in ('db', 'session', 'writer', 'admit', 'session_key'))
+        self.dump = atomic_file.codec.dump
+        get_agents_status.db = FakeDB()
+        get_agents_status.admit = lambda url, priority: None
+        get_agents_status.session_key = 'session-key'
+        self.checkpoint = Checkpoint('manager1')
+        for path in (self.checkpoint.path, self.checkpoint.path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(get_agents_status, name, value)
+        atomic_file.codec.dump = self.dump
+
+    def run_status(self, agents, writer):
+        get_agents_status.session = FakeWazuhAPI(agents)
+        get_agents_status.writer = writer
+        return get_agents_status.check_status(CONFIG)
+
+    def read_checkpoint(self):
+        with open(self.checkpoint.path) as f:
+            return json.load(f)
+
+    def test_first_run_writes_the_checkpoint(self):
+        writer = FakeWriter()
+        self.run_status([agent('001'), agent('002')], writer)
+        self.assertEqual(len(writer.events), 2)
+        saved = self.read_checkpoint()
+        self.assertEqual(sorted(saved['agents']), ['001', '002'])
+        self.assertGreater(saved['last_full'], 0)
+        self.assertFalse(os.path.exists(self.checkpoint.path + '.tmp'))
+
+    def test_checkpoint_advances_once_delivered(self):
+        self.run_status([agent('001'), agent('002')], FakeWriter())
+        writer = FakeWriter()
+        self.run_status([agent('001'), agent('002', 'Disconnected'), agent('003')], writer)
+        saved = self.read_checkpoint()
+        self.assertEqual(sorted(saved['agents']), ['001', '002', '003'])
+        self.assertTrue(saved['agents']['002'].startswith('Disconnected|'))
+
+    def test_failing_writer_leaves_the_checkpoint_unchanged(self):
+        self.run_status([agent('001'), agent('002')], FakeWriter())
+        with open(self.checkpoint.path, 'rb') as f:
+            before = f.read()
+        for writer in (FakeWriter(fail_flush=True), FakeWriter(drop=True)):
+            self.run_status([agent('001', 'Disconnected'), agent('003')], writer)
+            # The events were handed to the writer, but never delivered
+            self.assertEqual(len(writer.events), 2)
+            with open(self.checkpoint.path, 'rb') as f:
+                self.assertEqual(f.read(), before)
+
+    def test_changes_are_emitted_again_after_a_failed_delivery(self):
+        self.run_status([agent('001'), agent('002')], FakeWriter())
+        self.run_status([agent('001', 'Disconnected'), agent('002')], FakeWriter(fail_flush=True))
+        writer = FakeWriter()
+        self.run_status([agent('001', 'Disconnected'), agent('002')], writer)
+        self.assertEqual([event['id'] for event in writer.events], ['001'])
+
+    def test_interrupted_save_keeps_the_previous_checkpoint(self):
+        self.run_status([agent('001')], FakeWriter())
+        with open(self.checkpoint.path, 'rb') as f:
+            before = f.read()
+
+        def broken_dump(obj, f):
+            f.write('{"last_full": ')
+            raise IOError('No space left on device')
+        atomic_file.codec.dump = broken_dump
+        self.checkpoint.load()
+        self.checkpoint.update({'001': 'x', '002': 'y'}, True, 1.0)
+        with self.assertRaises(IOError):
+            self.checkpoint.save()
+        with open(self.checkpoint.path, 'rb') as f:
+            self.assertEqual(f.read(), before)
+        reloaded = Checkpoint('manager1')
+        reloaded.load()
+        self.assertEqual(list(reloaded.agents), ['001'])
+
+
+if __name__ == '__main__':
+    unittest.main()
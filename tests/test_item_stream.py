@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the incremental parser of bin/item_stream.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import json
+import unittest
+
+import helpers  # noqa: F401
+from item_stream import ItemStream, iter_response_items
+
+ITEMS = [
+    {'id': '000', 'name': 'wazuh-manager', 'os': {'name': 'CentOS', 'version': '7.6'}},
+    {'id': '001', 'name': u'café "main"', 'group': ['default', 'web\\servers'], 'ip': None},
+    -12.5e-3,
+    1234567890,
+    [[1, 2], {'a': {'b': [True, False]}}],
+    u'tab\there ☃'
+]
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def response_body(items, total_items=None, error=0, trailer=''):
+    data = {'totalItems': len(items) if total_items is None else total_items, 'items': items}
+    return ('{"error": %s, "data": %s%s}' % (error, json.dumps(data), trailer)).encode('utf-8')
+
+
+class FakeResponse():
+
+    def __init__(self, body):
+        self.body = body
+        self.closed = False
+
+    def iter_content(self, size):
+        return iter(split(self.body, 7))
+
+    def close(self):
+        self.closed = True
+
+
+class ItemStreamTest(unittest.TestCase):
+
+    def parse(self, body, size):
+        stream = ItemStream(split(body, size))
+        return list(stream), stream
+
+    def test_every_chunk_size(self):
+        body = response_body(ITEMS)
+        for size in range(1, len(body) + 1):
+            items, stream = self.parse(body, size)
+            self.assertEqual(items, ITEMS, size)
+            self.assertEqual(stream.error, 0)
+            self.assertEqual(stream.total_items, len(ITEMS))
+
+    def test_items_straddling_chunks(self):
+        items = [1, 22, 333.5, -4e10, u'esc\\aped \\"quote\\" é', {'nested': {'list': [1, {'x': 'y'}]}}]
+        body = response_body(items)
+        start = body.index(b'[') + 1
+        # Cut the body at every position inside data.items
+        for cut in range(start, body.index(b']}', len(body) - 3)):
+            stream = ItemStream([body[:cut], body[cut:]])
+            self.assertEqual(list(stream), items, cut)
+
+    def test_empty_items(self):
+        items, stream = self.parse(response_body([]), 3)
+        self.assertEqual(items, [])
+        self.assertEqual(stream.error, 0)
+        self.assertEqual(stream.total_items, 0)
+
+    def test_total_items_after_the_items(self):
+        body = b'{"error": 0, "data": {"items": [{"id": "001"}, {"id": "002"}], "totalItems": 1500}}'
+        items, stream = self.parse(body, 5)
+        self.assertEqual(items, [{'id': '001'}, {'id': '002'}])
+        self.assertEqual(stream.total_items, 1500)
+
+    def test_total_items_larger_than_the_page(self):
+        items, stream = self.parse(response_body(ITEMS[:2], total_items=2000), 4)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(stream.total_items, 2000)
+
+    def test_error_body(self):
+        items, stream = self.parse(b'{"error": 1701, "message": "Agent does not exist: 999"}', 6)
+        self.assertEqual(items, [])
+        self.assertEqual(stream.error, 1701)
+        self.assertEqual(stream.message, 'Agent does not exist: 999')
+        self.assertIsNone(stream.total_items)
+
+    def test_truncated_inside_the_items(self):
+        body = response_body(ITEMS)
+        for cut in (body.index(b'[') + 1, body.index(b'wazuh-manager'), len(body) - 3):
+            with self.assertRaises(ValueError):
+                self.parse(body[:cut], 5)
+
+    def test_truncated_before_the_items(self):
+        with self.assertRaises(ValueError):
+            self.parse(b'{"error": 0, "data": {"totalIt', 5)
+
+    def test_iter_response_items(self):
+        response = FakeResponse(response_body(ITEMS))
+        self.assertEqual(list(iter_response_items(response)), ITEMS)
+        self.assertTrue(response.closed)
+
+    def test_iter_response_items_raises_api_errors(self):
+        response = FakeResponse(b'{"error": 1000, "message": "Wazuh-Python Internal Error"}')
+        with self.assertRaises(Exception) as context:
+            list(iter_response_items(response))
+        self.assertEqual(str(context.exception), 'Wazuh-Python Internal Error')
+        self.assertTrue(response.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the KV store jobs queue of bin/jobs_queue.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import json
+import unittest
+
+import helpers
+from jobs_queue import JobsQueue, job_fingerprint
+
+queue_controller = helpers.load_controller('queue')
+
+
+class FakeResponse():
+
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(data)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def matches(document, query):
+    """Evaluate the subset of the KV store query language used by the app.
+
+    Values are compared with their type, like the KV store does, so 0 and
+    False are different.
+    """
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(matches(document, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            if '$lt' in condition and not (field in document and document[field] < condition['$lt']):
+                return False
+        elif field not in document or type(document[field]) != type(condition) or document[field] != condition:
+            return False
+    return True
+
+
+class FakeKVStore():
+    """Session answering the requests of JobsQueue from an in-memory collection."""
+
+    def __init__(self):
+        self.documents = []
+        self.requests = []
+        self.next_key = 0
+
+    def add(self, document):
+        document = dict(document)
+        if '_key' not in document:
+            self.next_key += 1
+            document['_key'] = 'job%s' % self.next_key
+        self.documents.append(document)
+        return document['_key']
+
+    def find(self, key):
+        return next(d for d in self.documents if d['_key'] == key)
+
+    def get(self, url, params=None, **kwargs):
+        self.requests.append(('GET', url, params))
+        params = params or {}
+        query = json.loads(params['query']) if 'query' in params else {}
+        result = [d for d in self.documents if matches(d, query)]
+        if 'sort' in params:
+            result.sort(key=lambda d: d[params['sort']])
+        if 'limit' in params:
+            result = result[:params['limit']]
+        return FakeResponse(result)
+
+    def post(self, url, data=None, **kwargs):
+        self.requests.append(('POST', url, data))
+        path = url.split('?')[0]
+        data = json.loads(data)
+        if path.endswith('/batch_save'):
+            return FakeResponse([self.add(d) if '_key' not in d else self.replace(d) for d in data])
+        if path.endswith('/jobs'):
+            return FakeResponse({'_key': self.add(data)}, 201)
+        key = path.rsplit('/', 1)[1]
+        self.find(key).update(data)
+        return FakeResponse({'_key': key})
+
+    def replace(self, document):
+        self.find(document['_key']).update(document)
+        return document['_key']
+
+    def delete(self, url, params=None, **kwargs):
+        self.requests.append(('DELETE', url, params))
+        query = json.loads(params['query'])
+        self.documents = [d for d in self.documents if not matches(d, query)]
+        return FakeResponse({})
+
+
+class JobsQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kvstore = FakeKVStore()
+        self.queue = JobsQueue()
+        self.queue.session = self.kvstore
+
+    def job(self, endpoint, exec_time, done=False, **params):
+        return {'job': dict(params, apiId='api1', endpoint=endpoint), 'added': 0, 'exec_time': exec_time, 'done': done}
+
+    def test_due_jobs_query(self):
+        self.queue.get_jobs(due_before=100, limit=5)
+        method, url, params = self.kvstore.requests[-1]
+        self.assertEqual(json.loads(params['query']), {'done': False, 'exec_time': {'$lt': 100}})
+        self.assertEqual(params['sort'], 'exec_time')
+        self.assertEqual(params['limit'], 5)
+
+    def test_only_pending_due_jobs_oldest_first(self):
+        for exec_time, done in [(30, False), (10, False), (20, True), (200, False), (5, False)]:
+            self.kvstore.add(self.job('/agents/001/restart', exec_time, done))
+        jobs = json.loads(self.queue.get_jobs(due_before=100, limit=2))
+        self.assertEqual([job['exec_time'] for job in jobs], [5, 10])
+
+    def test_all_jobs_without_filter(self):
+        self.kvstore.add(self.job('/agents/001/restart', 10, True))
+        self.kvstore.add(self.job('/agents/002/restart', 20))
+        self.assertEqual(len(json.loads(self.queue.get_jobs())), 2)
+        self.assertEqual(self.kvstore.requests[-1][2], {})
+
+    def test_jobs_added_by_the_controller_are_found(self):
+        controller = queue_controller.Queue()
+        controller.queue.session = self.kvstore
+        controller.add_job(apiId='api1', endpoint='/agents/001/restart', method='PUT', delay='0')
+        controller.add_jobs(jobs=json.dumps([{'apiId': 'api1', 'endpoint': '/agents/002/restart', 'method': 'PUT', 'delay': 0}]))
+        self.assertEqual([d['done'] for d in self.kvstore.documents], [False, False])
+        jobs = json.loads(self.queue.get_jobs(due_before=1e12))
+        self.assertEqual(len(jobs), 2)
+
+    def test_insert_jobs_merges_identical_requests(self):
+        keys = self.queue.insert_jobs([
+            self.job('/agents/001/restart', 30, method='PUT'),
+            self.job('/agents/001/restart', 10, method='PUT'),
+            self.job('/agents/002/restart', 20, method='PUT')])
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(sorted(d['exec_time'] for d in self.kvstore.documents), [10, 20])
+
+    def test_insert_jobs_brings_pending_jobs_forward(self):
+        pending = self.queue.insert_jobs([self.job('/agents/001/restart', 30, method='PUT')])[0]
+        keys = self.queue.insert_jobs([self.job('/agents/001/restart', 10, method='PUT')])
+        self.assertEqual(keys, [pending])
+        self.assertEqual(len(self.kvstore.documents), 1)
+        self.assertEqual(self.kvstore.find(pending)['exec_time'], 10)
+
+    def test_insert_jobs_keeps_earlier_pending_jobs(self):
+        pending = self.queue.insert_jobs([self.job('/agents/001/restart', 10, method='PUT')])[0]
+        keys = self.queue.insert_jobs([self.job('/agents/001/restart', 30, method='PUT')])
+        self.assertEqual(keys, [pending])
+        self.assertEqual(self.kvstore.find(pending)['exec_time'], 10)
+
+    def test_insert_jobs_ignores_done_jobs(self):
+        self.kvstore.add(self.job('/agents/001/restart', 10, done=True, method='PUT'))
+        self.queue.insert_jobs([self.job('/agents/001/restart', 30, method='PUT')])
+        self.assertEqual(len(self.kvstore.documents), 2)
+
+
+class QueueControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kvstore = FakeKVStore()
+        self.controller = queue_controller.Queue()
+        self.controller.queue.session = self.kvstore
+        self.getConfStanza = queue_controller.cli.getConfStanza
+        self.admin = 'false'
+        queue_controller.cli.getConfStanza = lambda conf, stanza: {'admin': self.admin}
+
+    def tearDown(self):
+        queue_controller.cli.getConfStanza = self.getConfStanza
+
+    def test_writes_need_admin_mode(self):
+        result = json.loads(self.controller.add_job(apiId='api1', endpoint='/agents/001/restart', method='PUT', delay='0'))
+        self.assertEqual(result['error'], 'Forbidden. Enable admin mode.')
+        result = json.loads(self.controller.add_jobs(jobs=json.dumps([
+            {'apiId': 'api1', 'endpoint': '/agents', 'delay': 0},
+            {'apiId': 'api1', 'endpoint': '/agents/001/restart', 'method': 'PUT', 'delay': 0}])))
+        self.assertEqual(result['error'], 'Forbidden. Enable admin mode.')
+        self.assertEqual(self.kvstore.documents, [])
+
+    def test_reads_dont_need_admin_mode(self):
+        result = json.loads(self.controller.add_job(apiId='api1', endpoint='/agents', method='GET', delay='0'))
+        self.assertEqual(result['error'], 0)
+        self.assertEqual(len(self.kvstore.documents), 1)
+
+    def test_writes_with_admin_mode(self):
+        self.admin = 'true'
+        result = json.loads(self.controller.add_jobs(jobs=json.dumps([
+            {'apiId': 'api1', 'endpoint': '/agents/001/restart', 'method': 'PUT', 'delay': 0}])))
+        self.assertEqual(result['error'], 0)
+        self.assertEqual(len(self.kvstore.documents), 1)
+
+
+class JobFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.req = {'apiId': 'manager1', 'endpoint': '/agents/001/restart', 'method': 'PUT', 'wait_for_complete': True}
+
+    def test_identical_requests_match(self):
+        same = {'wait_for_complete': True, 'method': 'PUT', 'endpoint': '/agents/001/restart', 'apiId': 'manager1'}
+        self.assertEqual(job_fingerprint(self.req), job_fingerprint(same))
+
+    def test_method_case_and_api_id_key_dont_matter(self):
+        same = dict(self.req, method='put')
+        del same['apiId']
+        same['id'] = 'manager1'
+        self.assertEqual(job_fingerprint(self.req), job_fingerprint(same))
+
+    def test_missing_method_is_get(self):
+        req = dict(self.req)
+        del req['method']
+        self.assertEqual(job_fingerprint(req), job_fingerprint(dict(self.req, method='GET')))
+
+    def test_different_requests_dont_match(self):
+        fingerprint = job_fingerprint(self.req)
+        for change in ({'method': 'DELETE'}, {'apiId': 'manager2'}, {'endpoint': '/agents/002/restart'},
+                       {'wait_for_complete': False}, {'pretty': True}):
+            self.assertNotEqual(fingerprint, job_fingerprint(dict(self.req, **change)), change)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the upstream metrics of bin/metrics.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import re
+import unittest
+
+import helpers  # noqa: F401
+from metrics import LATENCY_BUCKETS, Metrics, endpoint_template, quantile, summarize, to_prometheus
+
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*\{((?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\[\\"n])*",?)+)\} -?[0-9.e+-]+$')
+COMMENT = re.compile(r'^# (HELP|TYPE) [a-zA-Z_:][a-zA-Z0-9_:]* .+$')
+
+
+class EndpointTemplateTest(unittest.TestCase):
+
+    def test_agent_ids(self):
+        self.assertEqual(endpoint_template('/agents/001'), '/agents/:agent_id')
+        self.assertEqual(endpoint_template('/agents/001/restart'), '/agents/:agent_id/restart')
+        self.assertEqual(endpoint_template('/syscheck/002?limit=1'), '/syscheck/:agent_id')
+        self.assertEqual(endpoint_template('/sca/003/checks/cis_debian'), '/sca/:agent_id/checks/:id')
+        self.assertEqual(endpoint_template('/agents/001/config/logcollector/localfile'),
+                         '/agents/:agent_id/config/:component/:configuration')
+
+    def test_agent_names(self):
+        self.assertEqual(endpoint_template('/agents/name/web-01'), '/agents/name/:agent_name')
+
+    def test_group_paths(self):
+        self.assertEqual(endpoint_template('/agents/groups/default'), '/agents/groups/:group_id')
+        self.assertEqual(endpoint_template('/agents/groups/web/files/agent.conf'),
+                         '/agents/groups/:group_id/files/:filename')
+        self.assertEqual(endpoint_template('/agents/group/web'), '/agents/group/:group_id')
+        self.assertEqual(endpoint_template('/agents/001/group/web'), '/agents/:agent_id/group/:group_id')
+        self.assertEqual(endpoint_template('/agents/001/group/is_sync'), '/agents/:agent_id/group/is_sync')
+
+    def test_fixed_endpoints_are_kept(self):
+        for endpoint in ('/agents/summary', '/cluster/status', '/decoders/files', '/manager/info', '/'):
+            self.assertEqual(endpoint_template(endpoint), endpoint)
+        self.assertEqual(endpoint_template('/agents/'), '/agents')
+
+
+class QuantileTest(unittest.TestCase):
+
+    def counts(self, values):
+        metrics = Metrics()
+        for value in values:
+            metrics.record('https://wazuh:55000/agents', 'GET', value, 10, False)
+        return metrics.snapshot()[0]['series']['latency']
+
+    def test_quantiles(self):
+        # 100 calls: 50 of 8 ms, 45 of 80 ms and 5 of 2 s
+        counts = self.counts([0.008] * 50 + [0.08] * 45 + [2.0] * 5)
+        self.assertAlmostEqual(quantile(LATENCY_BUCKETS, counts, 0.5), 0.01)
+        self.assertAlmostEqual(quantile(LATENCY_BUCKETS, counts, 0.95), 0.1)
+        self.assertAlmostEqual(quantile(LATENCY_BUCKETS, counts, 0.99), 1 + 1.5 * 4 / 5.0)
+        self.assertTrue(0.005 < quantile(LATENCY_BUCKETS, counts, 0.25) < 0.01)
+
+    def test_empty_window(self):
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        for q in (0.5, 0.95, 0.99):
+            self.assertIsNone(quantile(LATENCY_BUCKETS, counts, q))
+
+    def test_single_sample(self):
+        counts = self.counts([0.07])
+        # Interpolated inside the (0.05, 0.1] bucket
+        self.assertAlmostEqual(quantile(LATENCY_BUCKETS, counts, 0.5), 0.075)
+        for q in (0.5, 0.95, 0.99):
+            self.assertTrue(0.05 < quantile(LATENCY_BUCKETS, counts, q) <= 0.1)
+
+    def test_overflow_bucket(self):
+        counts = self.counts([120.0])
+        self.assertEqual(quantile(LATENCY_BUCKETS, counts, 0.99), LATENCY_BUCKETS[-1])
+
+    def test_summarize(self):
+        metrics = Metrics()
+        metrics.register_api('https://wazuh:55000', 'manager1')
+        metrics.record('https://WAZUH:55000/agents/001?pretty', 'get', 0.02, 100, False)
+        metrics.record('https://wazuh:55000/agents/002', 'GET', 0.04, 300, True)
+        items = [dict(item, source='web') for item in metrics.snapshot()]
+        summary = summarize(items)
+        self.assertEqual(len(summary), 1)
+        self.assertEqual((summary[0]['api'], summary[0]['method'], summary[0]['endpoint']),
+                         ('manager1', 'GET', '/agents/:agent_id'))
+        self.assertEqual(summary[0]['error_rate'], 0.5)
+        self.assertAlmostEqual(summary[0]['latency']['avg'], 0.03)
+        self.assertEqual(summary[0]['size']['avg'], 200.0)
+
+
+class PrometheusTest(unittest.TestCase):
+
+    def items(self, endpoint='/agents/:agent_id', api='manager1'):
+        metrics = Metrics()
+        for elapsed, error in ((0.003, False), (0.2, False), (40.0, True)):
+            metrics.record('https://wazuh:55000/agents/001', 'GET', elapsed, 2048, error)
+        item = metrics.snapshot()[0]
+        item.update(source='web', api=api, endpoint=endpoint)
+        return [item]
+
+    def assert_valid(self, text):
+        self.assertTrue(text.endswith('\n'))
+        for line in text.splitlines():
+            self.assertTrue(SAMPLE.match(line) or COMMENT.match(line), line)
+
+    def test_valid_exposition_format(self):
+        text = to_prometheus(self.items())
+        self.assert_valid(text)
+        labels = 'source="web",api="manager1",method="GET",endpoint="/agents/:agent_id"'
+        lines = text.splitlines()
+        self.assertIn('wazuh_api_request_duration_seconds_bucket{%s,le="0.005"} 1' % labels, lines)
+        self.assertIn('wazuh_api_request_duration_seconds_bucket{%s,le="30"} 2' % labels, lines)
+        self.assertIn('wazuh_api_request_duration_seconds_bucket{%s,le="+Inf"} 3' % labels, lines)
+        self.assertIn('wazuh_api_request_duration_seconds_count{%s} 3' % labels, lines)
+        self.assertIn('wazuh_api_response_size_bytes_sum{%s} 6144' % labels, lines)
+        self.assertIn('wazuh_api_request_errors_total{%s} 1' % labels, lines)
+        for name in ('wazuh_api_request_duration_seconds', 'wazuh_api_response_size_bytes'):
+            self.assertIn('# TYPE %s histogram' % name, lines)
+        self.assertIn('# TYPE wazuh_api_request_errors_total counter', lines)
+
+    def test_buckets_are_cumulative(self):
+        buckets = [int(line.rsplit(' ', 1)[1]) for line in to_prometheus(self.items()).splitlines()
+                   if line.startswith('wazuh_api_request_duration_seconds_bucket')]
+        self.assertEqual(buckets, sorted(buckets))
+
+    def test_labels_are_escaped(self):
+        text = to_prometheus(self.items(endpoint='/files/a"b\\c\nd', api='my "api"'))
+        self.assert_valid(text)
+        self.assertIn('api="my \\"api\\"",method="GET",endpoint="/files/a\\"b\\\\c\\nd"', text)
+
+    def test_no_series(self):
+        text = to_prometheus([])
+        self.assert_valid(text)
+        self.assertEqual(len(text.splitlines()), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the undecoded responses of bin/raw_json.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import json
+import unittest
+
+import helpers
+from raw_json import RawResponse, error_code, needs_redaction
+
+api_controller = helpers.load_controller('api')
+
+AGENT = b'{"error": 0, "data": {"id": "001", "name": "web", "internal_key": "c2VjcmV0", "status": "Active"}}'
+CLUSTER = b'{"error":0,"data":{"node_type":"master","key":"9d273b53510fef702b54a92e9cffc82e","name":"node01"}}'
+AWS = (b'{"error":0,"data":{"wmodules":[{"aws-s3":{"buckets":[{"name":"logs","access_key":"AKIA",'
+       b'"secret_key":"s3cr3t"}]}}]}}')
+CLEAN = b'{"error": 0, "data": {"totalItems": 1, "items": [{"id": "000", "name": "manager", "ip": "127.0.0.1"}]}}'
+
+
+class ErrorCodeTest(unittest.TestCase):
+
+    def test_error_code(self):
+        self.assertEqual(error_code(CLEAN), 0)
+        self.assertEqual(error_code(b'{"error": 1701, "message": "Agent does not exist"}'), 1701)
+        self.assertEqual(error_code(b'\n  {  "error":3 }'), 3)
+
+    def test_missing_error_code(self):
+        for body in (b'', None, b'{"data": {}, "error": 0}', b'<html><body>502 Bad Gateway</body></html>',
+                     b'Internal Server Error', b'[{"error": 0}]'):
+            self.assertIsNone(error_code(body), body)
+
+    def test_raw_response(self):
+        response = RawResponse(CLEAN)
+        self.assertEqual(response.error, 0)
+        self.assertIsNone(response.data)
+        self.assertEqual(response.json(), json.loads(CLEAN.decode('utf-8')))
+
+
+class NeedsRedactionTest(unittest.TestCase):
+
+    def test_bodies_with_markers(self):
+        for body in (AGENT, CLUSTER, AWS, b'{"error":0,"data":{"integration":[{"api_key":"x"}]}}'):
+            self.assertTrue(needs_redaction(body), body)
+
+    def test_clean_body(self):
+        self.assertFalse(needs_redaction(CLEAN))
+        # A key that only contains a marker as a substring doesn't count
+        self.assertFalse(needs_redaction(b'{"error":0,"data":{"api_key_id":"x","keys":[]}}'))
+
+
+class RelayBodyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = api_controller.api()
+
+    def test_clean_body_is_relayed_as_is(self):
+        response = self.api.relay_body(CLEAN)
+        self.assertIs(response.body, CLEAN)
+        self.assertEqual(response.error, 0)
+        self.assertIsNone(response.data)
+
+    def test_error_body_is_relayed_as_is(self):
+        body = b'{"error": 1701, "message": "Agent does not exist: 999"}'
+        response = self.api.relay_body(body)
+        self.assertIs(response.body, body)
+        self.assertEqual(response.error, 1701)
+
+    def test_agent_key_is_hidden(self):
+        response = self.api.relay_body(AGENT)
+        self.assertEqual(json.loads(response.body.decode('utf-8'))['data'],
+                         {'id': '001', 'name': 'web', 'internal_key': '********', 'status': 'Active'})
+        self.assertEqual(response.json()['data']['internal_key'], '********')
+        self.assertEqual(response.error, 0)
+
+    def test_cluster_and_aws_keys_are_hidden(self):
+        data = json.loads(self.api.relay_body(CLUSTER).body.decode('utf-8'))['data']
+        self.assertEqual(data['key'], '********')
+        self.assertEqual(data['name'], 'node01')
+        bucket = json.loads(self.api.relay_body(AWS).body.decode('utf-8'))['data']['wmodules'][0]['aws-s3']['buckets'][0]
+        self.assertEqual((bucket['access_key'], bucket['secret_key']), ('********', '********'))
+        self.assertNotIn(b's3cr3t', self.api.relay_body(AWS).body)
+
+    def test_body_with_marker_but_nothing_to_hide(self):
+        body = b'{"error":0,"data":{"items":[{"name":"key","value":1}]}}'
+        response = self.api.relay_body(body)
+        self.assertEqual(json.loads(response.body.decode('utf-8')), json.loads(body.decode('utf-8')))
+
+    def test_non_json_bodies_raise(self):
+        for body in (b'<html><body><h1>502 Bad Gateway</h1></body></html>', b'Internal Server Error',
+                     b'{"error": 0, "data": {"items": [', b''):
+            with self.assertRaises(ValueError):
+                self.api.relay_body(body)
+
+
+if __name__ == '__main__':
+    unittest.main()
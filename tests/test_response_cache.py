@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the response cache of bin/response_cache.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import shutil
+import tempfile
+import time
+import unittest
+
+import helpers  # noqa: F401
+from response_cache import ResponseCache, signal_write
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stamps = tempfile.mkdtemp()
+        self.cache = ResponseCache(
+            max_entries=3, ttls={'/manager/info': 60, '/agents/summary': 0.05, '/rules': 60},
+            stamps_path=self.stamps)
+
+    def tearDown(self):
+        shutil.rmtree(self.stamps)
+
+    def test_params_order_does_not_matter(self):
+        self.cache.set('api', '/manager/info', {'a': 1, 'b': 2}, 'info')
+        self.assertEqual(self.cache.get('api', '/manager/info', {'b': 2, 'a': 1}), 'info')
+        self.assertIsNone(self.cache.get('api', '/manager/info', {'a': 1}))
+
+    def test_endpoints_without_ttl_are_not_cached(self):
+        self.cache.set('api', '/agents', {}, 'agents')
+        self.assertIsNone(self.cache.get('api', '/agents', {}))
+
+    def test_entries_expire(self):
+        self.cache.set('api', '/agents/summary', {}, 'summary')
+        self.assertEqual(self.cache.get('api', '/agents/summary', {}), 'summary')
+        time.sleep(0.06)
+        self.assertIsNone(self.cache.get('api', '/agents/summary', {}))
+
+    def test_least_recently_used_is_evicted(self):
+        for page in range(3):
+            self.cache.set('api', '/manager/info', {'page': page}, page)
+        self.cache.get('api', '/manager/info', {'page': 0})
+        self.cache.set('api', '/manager/info', {'page': 3}, 3)
+        self.assertIsNone(self.cache.get('api', '/manager/info', {'page': 1}))
+        self.assertEqual(self.cache.get('api', '/manager/info', {'page': 0}), 0)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidate_only_drops_the_api(self):
+        self.cache.set('api', '/manager/info', {}, 'info')
+        self.cache.set('other', '/manager/info', {}, 'other info')
+        self.cache.invalidate('api')
+        self.assertIsNone(self.cache.get('api', '/manager/info', {}))
+        self.assertEqual(self.cache.get('other', '/manager/info', {}), 'other info')
+
+    def test_invalidate_by_prefix(self):
+        self.cache.set('api', '/manager/info', {}, 'info')
+        self.cache.set('api', '/rules', {}, 'rules')
+        self.cache.invalidate('api', ('/rules', '/decoders'))
+        self.assertIsNone(self.cache.get('api', '/rules', {}))
+        self.assertEqual(self.cache.get('api', '/manager/info', {}), 'info')
+
+    def test_write_signaled_by_another_process(self):
+        self.cache.set('api', '/manager/info', {}, 'info')
+        self.cache.set('other', '/manager/info', {}, 'other info')
+        signal_write('api', self.stamps)
+        self.assertIsNone(self.cache.get('api', '/manager/info', {}))
+        self.assertEqual(self.cache.get('other', '/manager/info', {}), 'other info')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the circuit breaker of bin/retry_policy.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import time
+import unittest
+
+import helpers  # noqa: F401
+from retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def open_breaker(self, reset_timeout=30.0):
+        breaker = CircuitBreaker('https://wazuh:55000', failure_threshold=2, reset_timeout=reset_timeout)
+        breaker.before_request()
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.record_failure()
+        return breaker
+
+    def half_open_breaker(self):
+        breaker = self.open_breaker(reset_timeout=0.05)
+        time.sleep(0.06)
+        breaker.before_request()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        return breaker
+
+    def test_stays_closed_below_threshold(self):
+        breaker = CircuitBreaker('api', failure_threshold=2)
+        breaker.record_failure()
+        breaker.before_request()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_success_resets_the_failure_count(self):
+        breaker = CircuitBreaker('api', failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_opens_at_threshold_and_rejects(self):
+        breaker = self.open_breaker()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+        self.assertRaises(CircuitOpenError, breaker.check_open)
+        self.assertEqual(breaker.status()['rejected'], 2)
+
+    def test_half_open_allows_a_single_probe(self):
+        breaker = self.half_open_breaker()
+        self.assertTrue(breaker.probing)
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+
+    def test_check_open_does_not_take_the_probe(self):
+        breaker = self.open_breaker(reset_timeout=0.05)
+        time.sleep(0.06)
+        breaker.check_open()
+        breaker.before_request()
+        self.assertTrue(breaker.probing)
+
+    def test_successful_probe_closes(self):
+        breaker = self.half_open_breaker()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertFalse(breaker.probing)
+        breaker.before_request()
+
+    def test_failed_probe_reopens_and_releases_the_slot(self):
+        breaker = self.half_open_breaker()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.probing)
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+
+    def test_half_open_retry_does_not_leave_the_breaker_stuck(self):
+        # A probe answered with a Wazuh socket error is counted before the
+        # retry, so the breaker reopens instead of keeping the slot taken.
+        breaker = self.half_open_breaker()
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+        time.sleep(0.06)
+        breaker.before_request()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_abandoned_probe_expires(self):
+        breaker = self.half_open_breaker()
+        time.sleep(0.06)
+        breaker.before_request()
+        self.assertTrue(breaker.probing)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_gives_up_after_max_attempts(self):
+        policy = RetryPolicy(max_attempts=2, base_delay=0.001, max_delay=0.001)
+        deadline = policy.start()
+        self.assertTrue(policy.backoff(1, deadline))
+        self.assertFalse(policy.backoff(2, deadline))
+
+    def test_gives_up_past_the_deadline(self):
+        policy = RetryPolicy(max_attempts=10, base_delay=1, max_delay=1)
+        self.assertFalse(policy.backoff(1, time.time()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Wazuh app - Unit tests for the request coalescing of bin/single_flight.py.
+
+Copyright (C) 2015-2019 Wazuh, Inc.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+Find more information about this on the LICENSE file.
+"""
+
+import threading
+import time
+import unittest
+
+import helpers  # noqa: F401
+from single_flight import SingleFlight
+
+CALLERS = 5
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_concurrently(self, group, key, fn):
+        """Call group.do from CALLERS threads while fn is blocked, return their outcomes."""
+        outcomes = []
+        lock = threading.Lock()
+
+        def caller():
+            try:
+                outcome = ('result', group.do(key, fn))
+            except Exception as e:
+                outcome = ('error', e)
+            with lock:
+                outcomes.append(outcome)
+
+        threads = [threading.Thread(target=caller) for _ in range(CALLERS)]
+        for thread in threads:
+            thread.start()
+        return threads, outcomes
+
+    def blocked_call(self, outcome):
+        """Return a call that waits for the release event, and that event."""
+        release = threading.Event()
+        started = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return fn, release, started, calls
+
+    def wait_for_followers(self, group):
+        deadline = time.time() + 5
+        while group.stats()['collapsed'] < CALLERS - 1 and time.time() < deadline:
+            time.sleep(0.001)
+
+    def test_concurrent_callers_share_the_result(self):
+        group = SingleFlight()
+        result = {'error': 0, 'data': {}}
+        fn, release, started, calls = self.blocked_call(result)
+        threads, outcomes = self.run_concurrently(group, 'key', fn)
+        started.wait(5)
+        self.wait_for_followers(group)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(outcomes), CALLERS)
+        for kind, value in outcomes:
+            self.assertEqual(kind, 'result')
+            self.assertIs(value, result)
+        self.assertEqual(group.stats(), {'in_flight': 0, 'executed': 1, 'collapsed': CALLERS - 1})
+
+    def test_concurrent_callers_share_the_exception(self):
+        group = SingleFlight()
+        error = ValueError('Wazuh API down')
+        fn, release, started, calls = self.blocked_call(error)
+        threads, outcomes = self.run_concurrently(group, 'key', fn)
+        started.wait(5)
+        self.wait_for_followers(group)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([kind for kind, value in outcomes], ['error'] * CALLERS)
+        for kind, value in outcomes:
+            self.assertIs(value, error)
+
+    def test_calls_after_completion_run_again(self):
+        group = SingleFlight()
+        self.assertEqual(group.do('key', lambda: 1), 1)
+        self.assertEqual(group.do('key', lambda: 2), 2)
+        self.assertEqual(group.stats()['executed'], 2)
+
+    def test_different_keys_are_not_coalesced(self):
+        group = SingleFlight()
+        self.assertEqual(group.do('a', lambda: 'a'), 'a')
+        self.assertEqual(group.do('b', lambda: 'b'), 'b')
+        self.assertEqual(group.stats()['collapsed'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()